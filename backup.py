@@ -0,0 +1,284 @@
+"""
+Backup copies of the database file.
+
+Every time the database file is written, the previous version is kept as a backup
+named after the database file and the time it was replaced (<file name>-<time stamp>).
+
+Backups are stored as reverse deltas (<file name>-<time stamp>.delta): the tables, the
+items that were changed or removed, and the uid of the items that were added, so the
+version in the backup can be rebuilt from the version that replaced it. Older versions
+are rebuilt by applying the deltas one after the other, starting from the database file.
+The delta also contains the generation of the version it applies to, so a broken chain
+is detected. Backups stored as full copies of the database file are still supported.
+
+The retention policy decides which backups are kept:
+
+    - the most recent ones (keep_last)
+    - the most recent one in each hour, for the most recent hours with backups (keep_hourly)
+    - the most recent one in each day, for the most recent days with backups (keep_daily)
+
+A backup is kept if any of the rules selects it. All the other backups are removed.
+A delta that is removed is merged into the next older one, so older versions can still
+be rebuilt.
+"""
+import os
+import re
+import json
+from os.path import basename, dirname, exists
+from typing import Optional
+from crypt import Crypt
+from utils import get_string_timestamp
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, DB_HASH_KEY, DB_DIGESTS_KEY
+from compression import CODEC_NONE, compress, decompress
+from crypt_stream import encrypt_chunks, decrypt_chunks, is_chunked
+from durable import DEFAULT_DURABILITY, AtomicFile
+
+# Separator between the database file name and the time stamp
+BACKUP_SEPARATOR = '-'
+
+# Suffix of the backups stored as reverse deltas
+DELTA_SUFFIX = '.delta'
+
+# Delta keys, in addition to the database keys
+DELTA_BASE_KEY = 'base'
+DELTA_REMOVED_KEY = 'removed'
+
+# Time stamp format (see utils.get_string_timestamp)
+TIMESTAMP_PATTERN = r'\d{14}'
+HOUR_LENGTH = 10
+DAY_LENGTH = 8
+
+# Default retention policy
+DEFAULT_KEEP_LAST = 10
+DEFAULT_KEEP_HOURLY = 24
+DEFAULT_KEEP_DAILY = 30
+
+
+def backup_file_name(file_name: str, time_stamp: Optional[str] = None) -> str:
+    """
+    Return the name of a backup file
+    :param file_name: database file name
+    :param time_stamp: time stamp (current time if not specified)
+    :return: backup file name
+    """
+    return file_name + BACKUP_SEPARATOR + (get_string_timestamp() if time_stamp is None else time_stamp)
+
+
+def delta_file_name(file_name: str, time_stamp: str) -> str:
+    """
+    Return the name of a backup file stored as a delta
+    :param file_name: database file name
+    :param time_stamp: time stamp
+    :return: backup file name
+    """
+    return backup_file_name(file_name, time_stamp) + DELTA_SUFFIX
+
+
+def is_delta(file_name: str, time_stamp: str) -> bool:
+    """
+    Check whether a backup is stored as a delta
+    :param file_name: database file name
+    :param time_stamp: backup time stamp
+    :return: True if it is, False if it's a full copy
+    """
+    return exists(delta_file_name(file_name, time_stamp))
+
+
+def list_backups(file_name: str) -> list[str]:
+    """
+    Return the time stamps of the backups of a database file
+    :param file_name: database file name
+    :return: time stamps, most recent first
+    """
+    pattern = re.compile(re.escape(basename(file_name) + BACKUP_SEPARATOR) +
+                         f'({TIMESTAMP_PATTERN})({re.escape(DELTA_SUFFIX)})?$')
+    match_list = [pattern.match(x) for x in os.listdir(dirname(file_name) or '.')]
+    return sorted({x.group(1) for x in match_list if x}, reverse=True)
+
+
+def remove_backup(file_name: str, time_stamp: str):
+    """
+    Remove a backup
+    :param file_name: database file name
+    :param time_stamp: backup time stamp
+    """
+    os.remove(delta_file_name(file_name, time_stamp) if is_delta(file_name, time_stamp)
+              else backup_file_name(file_name, time_stamp))
+
+
+def make_delta(old_data: dict, old_items: dict, added: list, base: str) -> dict:
+    """
+    Build a reverse delta
+    :param old_data: tables, generation and hash of the old version
+    :param old_items: old version of the items changed or removed, by uid
+    :param added: uid of the items added by the new version
+    :param base: generation of the new version
+    :return: delta
+    """
+    return {DB_GENERATION_KEY: old_data.get(DB_GENERATION_KEY), DB_HASH_KEY: old_data.get(DB_HASH_KEY),
+            DB_TAGS_KEY: old_data[DB_TAGS_KEY], DB_FIELDS_KEY: old_data[DB_FIELDS_KEY],
+            DB_ITEMS_KEY: {str(uid): json_item for uid, json_item in old_items.items()},
+            DELTA_REMOVED_KEY: sorted(int(x) for x in added), DELTA_BASE_KEY: base}
+
+
+def apply_delta(json_data: dict, delta: dict):
+    """
+    Apply a reverse delta to the dictionary representation of a database
+    :param json_data: database dictionary (new version), modified in place
+    :param delta: delta
+    :raise: ValueError if the delta does not apply to this version
+    """
+    if delta[DELTA_BASE_KEY] != json_data.get(DB_GENERATION_KEY):
+        raise ValueError(f'broken backup chain: delta for generation {delta[DELTA_BASE_KEY]} '
+                         f'applied to generation {json_data.get(DB_GENERATION_KEY)}')
+    items = json_data[DB_ITEMS_KEY]
+    digests = json_data.get(DB_DIGESTS_KEY, {})
+    for uid in delta[DELTA_REMOVED_KEY]:
+        items.pop(str(uid), None)
+        digests.pop(str(uid), None)
+    items.update(delta[DB_ITEMS_KEY])
+    for uid in delta[DB_ITEMS_KEY]:
+        digests.pop(uid, None)
+    for key in [DB_TAGS_KEY, DB_FIELDS_KEY, DB_GENERATION_KEY, DB_HASH_KEY]:
+        json_data[key] = delta[key]
+
+
+def merge_deltas(newer: dict, older: dict) -> dict:
+    """
+    Merge two consecutive deltas into one that goes from the base of the newer
+    delta to the version in the older one
+    :param newer: newer delta
+    :param older: older delta (applies to the version in the newer delta)
+    :return: merged delta
+    :raise: ValueError if the deltas are not consecutive
+    """
+    if older[DELTA_BASE_KEY] != newer[DB_GENERATION_KEY]:
+        raise ValueError('deltas are not consecutive')
+    removed = {str(x) for x in older[DELTA_REMOVED_KEY]}
+    items = {k: v for k, v in newer[DB_ITEMS_KEY].items() if k not in removed}
+    items.update(older[DB_ITEMS_KEY])
+    removed |= {str(x) for x in newer[DELTA_REMOVED_KEY]}
+    merged = dict(older)
+    merged[DB_ITEMS_KEY] = items
+    merged[DELTA_REMOVED_KEY] = sorted(int(x) for x in removed if x not in items)
+    merged[DELTA_BASE_KEY] = newer[DELTA_BASE_KEY]
+    return merged
+
+
+def write_delta(file_name: str, time_stamp: str, delta: dict, crypt: Optional[Crypt] = None,
+                codec: Optional[str] = None, durability=DEFAULT_DURABILITY):
+    """
+    Write a delta to a backup file, compressed and encrypted in the same way as the database file.
+    An existing delta (e.g. when merging) is replaced in a single step.
+    :param file_name: database file name
+    :param time_stamp: backup time stamp
+    :param delta: delta
+    :param crypt: encryption key (optional)
+    :param codec: compression codec (optional)
+    :param durability: what is flushed to disk (see durable.py)
+    """
+    data = compress(json.dumps(delta).encode(), codec or CODEC_NONE)
+    with AtomicFile(delta_file_name(file_name, time_stamp), durability) as f_out:
+        f_out.write(data if crypt is None else encrypt_chunks(crypt, data))
+        f_out.commit()
+
+
+def read_delta(file_name: str, time_stamp: str, crypt: Optional[Crypt] = None) -> dict:
+    """
+    Read a delta from a backup file
+    :param file_name: database file name
+    :param time_stamp: backup time stamp
+    :param crypt: decryption key (optional)
+    :return: delta
+    :raise: ValueError if the delta cannot be read
+    """
+    with open(delta_file_name(file_name, time_stamp), 'rb') as f_in:
+        data = f_in.read()
+    f_in.close()
+    try:
+        if crypt is not None:
+            data = decrypt_chunks(crypt, data) if is_chunked(data) else crypt.decrypt_byte2byte(data)
+        return json.loads(decompress(data))
+    except Exception as e:
+        raise ValueError(f'failed to read backup {time_stamp}: {repr(e)}')
+
+
+class RetentionPolicy:
+
+    def __init__(self, keep_last=DEFAULT_KEEP_LAST, keep_hourly=DEFAULT_KEEP_HOURLY, keep_daily=DEFAULT_KEEP_DAILY):
+        """
+        :param keep_last: number of most recent backups to keep
+        :param keep_hourly: number of hours to keep one backup for
+        :param keep_daily: number of days to keep one backup for
+        """
+        self.keep_last = keep_last
+        self.keep_hourly = keep_hourly
+        self.keep_daily = keep_daily
+
+    def __str__(self) -> str:
+        return f'last={self.keep_last}, hourly={self.keep_hourly}, daily={self.keep_daily}'
+
+    def select(self, time_stamp_list: list[str]) -> set[str]:
+        """
+        Select the backups to keep
+        :param time_stamp_list: backup time stamps
+        :return: time stamps of the backups to keep
+        """
+        time_stamp_list = sorted(time_stamp_list, reverse=True)
+        keep = set(time_stamp_list[:self.keep_last])
+        for length, n in [(HOUR_LENGTH, self.keep_hourly), (DAY_LENGTH, self.keep_daily)]:
+            period_list = []
+            for time_stamp in time_stamp_list:
+                if len(period_list) >= n:
+                    break
+                if time_stamp[:length] not in period_list:
+                    period_list.append(time_stamp[:length])
+                    keep.add(time_stamp)
+        return keep
+
+    def prune(self, file_name: str, crypt: Optional[Crypt] = None, codec: Optional[str] = None,
+              durability=DEFAULT_DURABILITY) -> list[str]:
+        """
+        Remove the backups of a database file that are not selected by the policy.
+        Deltas that are removed are merged into the next older delta that is kept.
+        Full copies are kept while there are older deltas that are kept, since
+        these deltas might apply to them.
+        :param file_name: database file name
+        :param crypt: key used to read and write the deltas (optional)
+        :param codec: compression codec used to write the deltas (optional)
+        :param durability: what is flushed to disk when writing the deltas (see durable.py)
+        :return: time stamps of the backups that were removed
+        """
+        time_stamp_list = list_backups(file_name)
+        keep = self.select(time_stamp_list)
+        oldest_delta = min([x for x in keep if is_delta(file_name, x)], default=None)
+        keep |= {x for x in time_stamp_list if oldest_delta and x > oldest_delta and not is_delta(file_name, x)}
+
+        removed = []
+        pending = None
+        for time_stamp in time_stamp_list:
+            if is_delta(file_name, time_stamp):
+                if time_stamp in keep:
+                    if pending is not None:
+                        write_delta(file_name, time_stamp,
+                                    merge_deltas(pending, read_delta(file_name, time_stamp, crypt)),
+                                    crypt, codec, durability)
+                    pending = None
+                elif oldest_delta and time_stamp > oldest_delta:
+                    # Only needed if there are older deltas to merge it into
+                    delta = read_delta(file_name, time_stamp, crypt)
+                    pending = delta if pending is None else merge_deltas(pending, delta)
+            else:
+                pending = None
+            if time_stamp not in keep:
+                remove_backup(file_name, time_stamp)
+                removed.append(time_stamp)
+        return removed
+
+
+if __name__ == '__main__':
+    p = RetentionPolicy(keep_last=2, keep_hourly=2, keep_daily=2)
+    ts_list = ['20240101100000', '20240101100500', '20240101110000', '20240101113000', '20240102090000',
+               '20240102090100', '20240102090200']
+    print(p, sorted(p.select(ts_list)))
+    print(backup_file_name('pw.db'))
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+"""
+Benchmarks used to compare the different ways of storing the database.
+The databases are filled with random data and written to a temporary directory.
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from typing import Callable
+from db import Database, ENGINES
+from crypt import Crypt, DEFAULT_WORKERS as CRYPT_WORKERS, CIPHER_LIST, CIPHER_KEY, DEFAULT_CIPHER
+from crypt import is_aead_token, aead_token_to_bytes
+from uid import clear_all
+from testing import random_database
+from common import FORMAT_JSON, FORMAT_BINARY
+from compression import CODEC_LIST, CODEC_NONE
+from crypt_stream import DEFAULT_WORKERS, encrypt_chunks, decrypt_chunks
+from digest import DEFAULT_WORKERS as DIGEST_WORKERS
+from backup import list_backups, delta_file_name
+from items import Item, FieldCollection
+from durable import DURABILITY_LIST
+from journal import OP_ITEM_PUT
+from storage import ENGINE_FILE, ENGINE_SHARD
+from kdf import LEGACY_PARAMETERS
+from key_agent import KeyAgent, KEY_AGENT_ENV, AGENT_OP_KEY, OP_STOP, request
+
+# Default benchmark parameters
+DEFAULT_ITEMS = 10000
+DEFAULT_REPEAT = 3
+BENCHMARK_FILE = 'benchmark.db'
+BENCHMARK_PASSWORD = 'benchmark'
+
+
+def best_time(function: Callable, repeat: int, *args) -> float:
+    """
+    Run a function several times and return the best execution time
+    :param function: function to run
+    :param repeat: number of runs
+    :param args: function arguments
+    :return: best time in seconds
+    """
+    t_list = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        t_list.append(time.perf_counter() - start)
+    return min(t_list)
+
+
+def read_database(db: Database):
+    """
+    Read a database from scratch. The uid are cleared so the same database can be read several times.
+    :param db: database
+    """
+    clear_all()
+    db.clear()
+    db.read()
+
+
+def create_database(n_items: int, password: str, engine=ENGINE_FILE, cipher=DEFAULT_CIPHER) -> Database:
+    """
+    Create a database with random contents
+    :param n_items: number of items
+    :param password: password
+    :param engine: storage engine
+    :param cipher: cipher used for the sensitive values
+    :return: database
+    """
+    clear_all()
+    db = Database(BENCHMARK_FILE, password, engine=engine, cipher=cipher)
+    random_database(db, n_items)
+    return db
+
+
+def benchmark_formats(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the file size and save/load time of the json and binary formats.
+    The decode time is the time needed to convert the file into a dictionary, before
+    creating any object.
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    print(f'{"format":10s} {"size":>12s} {"save":>8s} {"decode":>8s} {"load":>8s}')
+    for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+        db.file_format = file_format
+        t_save = best_time(db.save, repeat, None, True)
+        size = os.path.getsize(db.file_name)
+        t_decode = best_time(db.load, repeat)
+        t_load = best_time(read_database, repeat, db)
+        print(f'{file_format:10s} {size:12d} {t_save:8.3f} {t_decode:8.3f} {t_load:8.3f}')
+
+
+def benchmark_lazy(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed to open a database in binary format, to open it and get
+    one item, and to open it and list all the items by name (as the item list command does),
+    when reading all the items or only the item index
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.file_format = FORMAT_BINARY
+    db.write()
+    uid = db.item_collection.keys()[n_items // 2]
+
+    def read_item(lazy: bool, get_item: bool, list_items=False):
+        clear_all()
+        db.clear()
+        db.read(lazy=lazy)
+        if get_item:
+            db.item_collection.get(uid)
+        if list_items:
+            for _ in db.item_collection.next_name():
+                pass
+
+    print(f'{"read":10s} {"open":>8s} {"get":>8s} {"list":>8s} {"created":>8s}')
+    for label, lazy in [('full', False), ('lazy', True)]:
+        t_open = best_time(read_item, repeat, lazy, False)
+        t_get = best_time(read_item, repeat, lazy, True)
+        t_list = best_time(read_item, repeat, lazy, False, True)
+        print(f'{label:10s} {t_open:8.3f} {t_get:8.3f} {t_list:8.3f} {len(db.item_collection.data):8d}')
+
+
+def peak_memory(function: Callable, *args) -> tuple[float, float]:
+    """
+    Run a function and return the peak memory allocated while it ran
+    :param function: function to run
+    :param args: function arguments
+    :return: peak memory and memory still allocated at the end, in MB
+    """
+    tracemalloc.start()
+    function(*args)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2 ** 20, size / 2 ** 20
+
+
+def benchmark_memory(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time and peak memory needed to read and write a database in json format,
+    going through the whole database dictionary or streaming the items one at a time
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.write()
+
+    def read_stream(stream: bool):
+        clear_all()
+        db.clear()
+        db.read(stream=stream)
+
+    def write_stream(stream: bool):
+        db.save(force=True) if stream else db.save(db.export(), force=True)
+
+    print(f'{"operation":12s} {"time":>8s} {"peak (MB)":>10s} {"final (MB)":>10s}')
+    for label, stream in [('full', False), ('stream', True)]:
+        t_read = best_time(read_stream, repeat, stream)
+        clear_all()
+        db.clear()
+        peak, size = peak_memory(db.read, False, stream)
+        print(f'{"read " + label:12s} {t_read:8.3f} {peak:10.2f} {size:10.2f}')
+    for label, stream in [('full', False), ('stream', True)]:
+        t_write = best_time(write_stream, repeat, stream)
+        peak, size = peak_memory(write_stream, stream)
+        print(f'{"write " + label:12s} {t_write:8.3f} {peak:10.2f} {size:10.2f}')
+
+
+def benchmark_compression(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the file size and save/load time of each compression codec, with the default
+    compression level and the fastest one, for both file formats
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    print(f'{"format":8s} {"codec":6s} {"level":>5s} {"size":>12s} {"save":>8s} {"load":>8s}')
+    for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+        for codec in CODEC_LIST:
+            for level in [None] if codec == CODEC_NONE else [None, 1]:
+                db.file_format, db.codec, db.level = file_format, codec, level
+                t_save = best_time(db.save, repeat, None, True)
+                size = os.path.getsize(db.file_name)
+                t_load = best_time(read_database, repeat, db)
+                level_str = 'def' if level is None else str(level)
+                print(f'{file_format:8s} {codec:6s} {level_str:>5s} {size:12d} {t_save:8.3f} {t_load:8.3f}')
+
+
+def benchmark_encryption(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed to encrypt and decrypt the contents of a database file in json format
+    as a single token or in chunks, with different chunk sizes and numbers of threads
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password (a default one is used if blank)
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    crypt = db.crypt_key if db.crypt_key else Crypt(BENCHMARK_PASSWORD)
+    data = b''.join([x.encode() for x in db.json_chunks()])
+    print(f'data size {len(data)}, {DEFAULT_WORKERS} threads available')
+
+    print(f'{"chunk size":>10s} {"threads":>8s} {"size":>12s} {"encrypt":>8s} {"decrypt":>8s}')
+    encrypted = crypt.encrypt_byte2byte(data)
+    t_encrypt = best_time(crypt.encrypt_byte2byte, repeat, data)
+    t_decrypt = best_time(crypt.decrypt_byte2byte, repeat, encrypted)
+    print(f'{"single":>10s} {1:8d} {len(encrypted):12d} {t_encrypt:8.3f} {t_decrypt:8.3f}')
+    for chunk_size in [1 << 16, 1 << 18, 1 << 20]:
+        for workers in sorted({1, DEFAULT_WORKERS}):
+            encrypted = encrypt_chunks(crypt, data, chunk_size)
+            t_encrypt = best_time(encrypt_chunks, repeat, crypt, data, chunk_size)
+            t_decrypt = best_time(decrypt_chunks, repeat, crypt, encrypted, workers)
+            print(f'{chunk_size:10d} {workers:8d} {len(encrypted):12d} {t_encrypt:8.3f} {t_decrypt:8.3f}')
+
+
+def benchmark_backup(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Measure the space used by the backups when one item is added before each save, compared
+    with keeping a full copy of each version, and the time needed to save and to restore.
+    Saves are one second apart so each one gets its own backup.
+    :param n_items: number of items
+    :param repeat: number of saves
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.retention = None
+    db.save()
+    full_size = 0
+    t_save = 0.0
+    for n in range(max(repeat, 2)):
+        full_size += os.path.getsize(db.file_name)
+        time.sleep(1)
+        db.item_collection.add(Item(f'new-{n}', [], '', FieldCollection()))
+        t_start = time.perf_counter()
+        db.save()
+        t_save += time.perf_counter() - t_start
+    time_stamp_list = list_backups(db.file_name)
+    delta_size = sum([os.path.getsize(delta_file_name(db.file_name, x)) for x in time_stamp_list])
+    t_rebuild = best_time(db.rebuild, 1, time_stamp_list[-1])
+    print(f'file size {os.path.getsize(db.file_name)}, {len(time_stamp_list)} backups')
+    print(f'full copies {full_size:12d}')
+    print(f'deltas      {delta_size:12d}')
+    print(f'save {t_save / len(time_stamp_list):8.3f}, rebuild oldest {t_rebuild:8.3f}')
+
+
+def benchmark_durability(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the save time with each durability level, and the time needed by several
+    threads to change and write the database at once, with and without group commit
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.retention = None
+    print(f'{"durability":10s} {"save":>8s}')
+    for durability in DURABILITY_LIST:
+        db.durability = durability
+        print(f'{durability:10s} {best_time(db.save, repeat, None, True):8.3f}')
+
+    def write_all(n_threads: int, group: bool):
+        def change_and_write(n: int):
+            with db.lock:
+                db.item_collection.add(Item(f'new-{n}', [], '', FieldCollection()))
+            if group:
+                db.write()
+            else:
+                db.save(None, True)
+        thread_list = [threading.Thread(target=change_and_write, args=(n,)) for n in range(n_threads)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+
+    print(f'{"threads":>7s} {"separate":>8s} {"group":>8s}')
+    for n_threads in [2, 8]:
+        t_separate = best_time(write_all, repeat, n_threads, False)
+        t_group = best_time(write_all, repeat, n_threads, True)
+        print(f'{n_threads:7d} {t_separate:8.3f} {t_group:8.3f}')
+
+
+def benchmark_update(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Measure the time needed to write a change to a single item, and to search the items,
+    after the database was read
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.retention = None
+    db.write()
+    read_database(db)
+    uid = db.item_collection.keys()[0]
+
+    def update_item():
+        item = db.item_collection.get(uid)
+        item.name = f'{item.name}-new'
+        db.record(OP_ITEM_PUT, item.export())
+        db.write()
+
+    def search():
+        db.search('a', item_name_flag=True, tag_flag=True, note_flag=True)
+
+    print(f'{"engine":8s} {"update":>8s} {"search":>8s}')
+    print(f'{engine:8s} {best_time(update_item, repeat):8.4f} {best_time(search, repeat):8.4f}')
+
+
+def benchmark_shards(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the read time with one process and with a pool of four processes, and the time needed
+    to write a change to a single item, for several numbers of shards
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: ignored (the shard engine is used)
+    """
+    print(f'{"shards":>6s} {"save":>8s} {"read 1":>8s} {"read 4":>8s} {"update":>8s}')
+    for shard_count in [1, 4, 16, 64]:
+        db = create_database(n_items, password, ENGINE_SHARD)
+        db.engine.shard_count = shard_count
+        t_save = best_time(db.save, repeat, None, True)
+        t_read = {}
+        for workers in [1, 4]:
+            db.engine.workers = workers
+            t_read[workers] = best_time(read_database, repeat, db)
+        uid = db.item_collection.keys()[0]
+
+        def update_item():
+            item = db.item_collection.get(uid)
+            item.name = f'{item.name}-new'
+            db.record(OP_ITEM_PUT, item.export())
+            db.write()
+
+        print(f'{shard_count:6d} {t_save:8.3f} {t_read[1]:8.3f} {t_read[4]:8.3f} '
+              f'{best_time(update_item, repeat):8.4f}')
+
+
+def benchmark_read_only(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time and memory needed to open a database normally and in read-only mode,
+    followed by a search and the listing of every item name
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.write()
+
+    def open_and_list(read_only: bool):
+        clear_all()
+        ro_db = Database(BENCHMARK_FILE, password, engine=engine, read_only=read_only)
+        ro_db.read()
+        ro_db.search('a')
+        [x.get_name() for x in ro_db.item_collection.next()]
+
+    print(f'{"mode":10s} {"time":>8s} {"peak (MB)":>10s}')
+    for label, read_only in [('normal', False), ('read-only', True)]:
+        t_open = best_time(open_and_list, repeat, read_only)
+        peak, _ = peak_memory(open_and_list, read_only)
+        print(f'{label:10s} {t_open:8.3f} {peak:10.2f}')
+
+
+def benchmark_verify(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Measure the time needed to check every item against its stored hash with one and with
+    several processes, and the time needed to save the database after changing one item
+    with and without reusing the hashes of the items that didn't change
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.write()
+    print(f'{"processes":10s} {"verify":>8s}')
+    for workers in sorted({1, DIGEST_WORKERS}):
+        print(f'{workers:<10d} {best_time(db.verify, repeat, workers):8.3f}')
+
+    uid = db.item_collection.keys()[0]
+    item = db.item_collection.get(uid)
+
+    def change_and_save(reuse: bool):
+        db.record(OP_ITEM_PUT, item.export())
+        if not reuse:
+            db.digest_cache = {}
+        db.save(force=True)
+
+    print(f'{"hashes":10s} {"save":>8s}')
+    for label, reuse in [('computed', False), ('reused', True)]:
+        print(f'{label:10s} {best_time(change_and_save, repeat, reuse):8.3f}')
+
+
+def benchmark_refresh(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed by a reader to find out whether the database changed
+    with the time needed to read it again, and measure the locking overhead of a read
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.write()
+    reader = Database(BENCHMARK_FILE, password, engine=engine, read_only=True)
+    reader.read()
+
+    def read_again():
+        reader.clear()
+        reader.read()
+
+    t_changed = best_time(reader.changed, repeat)
+    t_lock = best_time(lambda: reader.file_lock.acquire() or reader.file_lock.release(), repeat)
+    t_read = best_time(read_again, repeat)
+    print(f'{"check":>10s} {"lock":>10s} {"read":>10s}')
+    print(f'{t_changed * 1e6:8.1f}us {t_lock * 1e6:8.1f}us {t_read:9.3f}s')
+
+
+def benchmark_merge(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed to save the database after changing one item when the stored
+    version didn't change, and when another process changed another item in the meantime,
+    so the changes of both are merged (see Database.merge())
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password, engine)
+    db.write()
+    clear_all()
+    other = Database(BENCHMARK_FILE, password, engine=engine)
+    other.read()
+    uid_list = db.item_collection.keys()
+
+    def change(database: Database, uid: int, n: int):
+        item = database.item_collection.get(uid)
+        item.note = f'change {n}'
+        database.record(OP_ITEM_PUT, item.export())
+
+    def change_and_save(merged: bool, n: int) -> float:
+        if merged:
+            change(other, uid_list[1], n)
+            other.write()
+        change(db, uid_list[0], n)
+        start = time.perf_counter()
+        db.write()
+        return time.perf_counter() - start
+
+    print(f'{"stored":10s} {"save":>8s}')
+    for label, merged in [('unchanged', False), ('changed', True)]:
+        print(f'{label:10s} {min(change_and_save(merged, n) for n in range(repeat)):8.3f}')
+
+
+def benchmark_agent(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed to open an encrypted database with and without a key agent
+    holding the key derived from the password (see key_agent.py)
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password (a default one is used if blank)
+    :param engine: storage engine
+    """
+    password = password or BENCHMARK_PASSWORD
+    db = create_database(n_items, password, engine)
+    db.write()
+
+    def read_database():
+        clear_all()
+        Database(BENCHMARK_FILE, password, engine=engine).read()
+
+    agent = KeyAgent(os.path.abspath('agent.sock'), None)
+    thread = threading.Thread(target=agent.serve, daemon=True)
+    thread.start()
+    print(f'{"agent":10s} {"key":>8s} {"read":>8s}')
+    try:
+        for label, socket_name in [('none', ''), ('running', agent.server_address)]:
+            os.environ[KEY_AGENT_ENV] = socket_name
+            Crypt(password)
+            print(f'{label:10s} {best_time(Crypt, repeat, password):8.3f} {best_time(read_database, repeat):8.3f}')
+    finally:
+        os.environ.pop(KEY_AGENT_ENV)
+        request({AGENT_OP_KEY: OP_STOP}, agent.server_address)
+        thread.join()
+def benchmark_fields(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed to encrypt and decrypt sensitive values one at a time and all at once,
+    with different numbers of threads (see Crypt.encrypt_many()), and the time needed to export
+    the database with the sensitive values decrypted
+    :param n_items: number of items (and of values)
+    :param repeat: number of runs
+    :param password: database password (a default one is used if blank)
+    :param engine: storage engine
+    """
+    password = password or BENCHMARK_PASSWORD
+    crypt = Crypt(password)
+    values = [f'sensitive value {n}' for n in range(n_items)]
+    encrypted = crypt.encrypt_many(values)
+    print(f'{n_items} values, {CRYPT_WORKERS} threads available')
+
+    print(f'{"method":10s} {"threads":>8s} {"encrypt":>8s} {"decrypt":>8s}')
+    t_encrypt = best_time(lambda: [crypt.encrypt_str2str(x) for x in values], repeat)
+    t_decrypt = best_time(lambda: [crypt.decrypt_str2str(x) for x in encrypted], repeat)
+    print(f'{"single":10s} {1:8d} {t_encrypt:8.3f} {t_decrypt:8.3f}')
+    for workers in sorted({1, 4, CRYPT_WORKERS}):
+        t_encrypt = best_time(crypt.encrypt_many, repeat, values, workers)
+        t_decrypt = best_time(crypt.decrypt_many, repeat, encrypted, workers)
+        print(f'{"many":10s} {workers:8d} {t_encrypt:8.3f} {t_decrypt:8.3f}')
+
+    db = create_database(n_items, password, engine)
+    print(f'export {best_time(db.export_to_json, repeat, BENCHMARK_FILE + ".json"):.3f}')
+    os.remove(BENCHMARK_FILE + '.json')
+
+
+def benchmark_ciphers(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the ciphers used for the sensitive values (see crypt.py): the time needed to encrypt
+    and decrypt one value at a time, the size of each value in memory and json (text) and in the
+    binary and SQLite formats (stored), and the size of a database saved in binary format
+    :param n_items: number of items (and of values)
+    :param repeat: number of runs
+    :param password: database password (a default one is used if blank)
+    :param engine: storage engine
+    """
+    password = password or BENCHMARK_PASSWORD
+    values = [f'password-{n:08d}' for n in range(n_items)]
+    print(f'{"cipher":10s} {"encrypt":>8s} {"decrypt":>8s} {"text":>6s} {"stored":>6s} {"file size":>10s}')
+    for cipher in CIPHER_LIST:
+        crypt = Crypt(password, dict(LEGACY_PARAMETERS, **{CIPHER_KEY: cipher}))
+        encrypted = [crypt.encrypt_str2str(x) for x in values]
+        t_encrypt = best_time(lambda: [crypt.encrypt_str2str(x) for x in values], repeat)
+        t_decrypt = best_time(lambda: [crypt.decrypt_str2str(x) for x in encrypted], repeat)
+        text = sum(len(x) for x in encrypted) / len(encrypted)
+        stored = sum(len(aead_token_to_bytes(x)) if is_aead_token(x) else len(x) for x in encrypted) / len(encrypted)
+        db = create_database(n_items, password, engine, cipher)
+        db.file_format = FORMAT_BINARY
+        db.save(None, True)
+        size = sum(os.path.getsize(x) for x in os.listdir('.') if x.startswith(BENCHMARK_FILE))
+        print(f'{cipher:10s} {t_encrypt:8.3f} {t_decrypt:8.3f} {text:6.1f} {stored:6.1f} {size:10d}')
+        for file_name in os.listdir('.'):
+            if file_name.startswith(BENCHMARK_FILE):
+                os.remove(file_name)
+
+
+def benchmark_cache(n_items: int, repeat: int, password: str, engine: str):
+    """
+    Compare the time needed to get the decrypted sensitive values of the fields the first time
+    and when they were decrypted recently (see value_cache.py)
+    :param n_items: number of items
+    :param repeat: number of runs
+    :param password: database password (a default one is used if blank)
+    :param engine: storage engine
+    """
+    db = create_database(n_items, password or BENCHMARK_PASSWORD, engine)
+    crypt = db.crypt_key
+    fields = [x for item in db.item_collection.next() for x in item.next_field() if x.get_sensitive()]
+    crypt.value_cache.max_size = len(fields)
+
+    def get_values():
+        return [x.get_decrypted_value(crypt) for x in fields]
+
+    def get_values_cold():
+        crypt.value_cache.clear()
+        return get_values()
+
+    print(f'{len(fields)} sensitive values')
+    print(f'{"cache":10s} {"time":>8s}')
+    print(f'{"cold":10s} {best_time(get_values_cold, repeat):8.3f}')
+    print(f'{"warm":10s} {best_time(get_values, repeat):8.3f}')
+
+
+BENCHMARKS = {
+    'format': benchmark_formats,
+    'lazy': benchmark_lazy,
+    'memory': benchmark_memory,
+    'compression': benchmark_compression,
+    'encryption': benchmark_encryption,
+    'backup': benchmark_backup,
+    'durability': benchmark_durability,
+    'update': benchmark_update,
+    'shards': benchmark_shards,
+    'read-only': benchmark_read_only,
+    'verify': benchmark_verify,
+    'refresh': benchmark_refresh,
+    'merge': benchmark_merge,
+    'agent': benchmark_agent,
+    'fields': benchmark_fields,
+    'ciphers': benchmark_ciphers,
+    'cache': benchmark_cache,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Database benchmarks')
+
+    parser.add_argument('benchmark',
+                        choices=list(BENCHMARKS.keys()),
+                        help='Benchmark to run')
+
+    parser.add_argument('-n',
+                        dest='n_items',
+                        type=int,
+                        default=DEFAULT_ITEMS,
+                        help='Number of items in the database')
+
+    parser.add_argument('-r',
+                        dest='repeat',
+                        type=int,
+                        default=DEFAULT_REPEAT,
+                        help='Number of runs (the best time is reported)')
+
+    parser.add_argument('-e',
+                        dest='engine',
+                        choices=list(ENGINES.keys()),
+                        default=ENGINE_FILE,
+                        help='Storage engine')
+
+    parser.add_argument('-p',
+                        dest='plain',
+                        action='store_true',
+                        help='Do not encrypt the database')
+
+    args = parser.parse_args()
+
+    # The files are written in a temporary directory that is removed at the end
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            BENCHMARKS[args.benchmark](args.n_items, args.repeat, '' if args.plain else BENCHMARK_PASSWORD,
+                                       args.engine)
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,543 @@
+"""
+Compact binary representation of the database.
+
+The binary format stores the same information as the json dictionary returned by
+Database.export(), but the field names in the items are replaced by references to
+the field table, and all the unique identifiers are stored as integers.
+
+File layout (version 5). All integers are little endian.
+
+    header      magic (4 bytes), version (1 byte), generation (string), content hash (string)
+    tags        count (u32), then uid (u32), item count (u32) and name (string) for each tag
+    fields      count (u32), then uid (u32), sensitive (u8), item count (u32) and name (string) for each field
+    items       count (u32), then length (u32) and item record for each item
+    index       item uid (u32) for each item in ascending order,
+                then record offset (u64) and record length (u32) for each item, in the same order,
+                then the item hash (32 bytes, all zero if unknown) for each item, in the same order,
+                then the names magic (4 bytes), the name length (u32) for each item, in the same order,
+                and the utf-8 bytes of the names
+    footer      index offset (u64), item count (u32), index magic (4 bytes)
+
+    item record uid (u32), timestamp (i64), name (string), note (string),
+                tag count (u16), tag uid (u32) for each tag,
+                field count (u16), then for each field:
+                    field table uid (u32), or zero followed by the field name (string)
+                    sensitive (u8)
+                    value type (u8) and value
+
+    string      length (u32) and utf-8 bytes
+    value       string (type 0), i64 (type 1), f64 (type 2), string (type 3, big integers),
+                or length (u32) and raw bytes (type 4, AES-GCM tokens, see crypt.py)
+
+Items are length-prefixed so a reader can skip over them without decoding them.
+The index and the item counts in the tables allow opening a database without
+reading the items at all (see read_index()), and the item names in the index allow
+listing the items by name without decoding them (see BinaryIndex.item_names()).
+
+Version 1 files have no item counts, index or footer. Version 3 files have no item hashes.
+Version 4 files have no AES-GCM tokens. Files without them are still written as version 4,
+so they can be read by the versions that don't know the AES-GCM tokens.
+The item names were added to the index without changing the version: the index is found
+from the footer, so earlier readers skip them, and they are only read if the names magic
+follows the hashes.
+"""
+import sys
+import struct
+from array import array
+from bisect import bisect_left
+from typing import Generator, Optional
+from crypt import is_aead_token, aead_token_to_bytes, aead_token_from_bytes
+from common import KEY_NAME, KEY_UID
+from common import FIELD_NAME_KEY, FIELD_VALUE_KEY, FIELD_SENSITIVE_KEY
+from common import ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_UID_KEY, ITEM_FIELDS_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, DB_HASH_KEY, DB_COUNTS_KEY
+from common import DB_DIGESTS_KEY
+from common import COUNTS_GENERATION_KEY, COUNTS_TAGS_KEY, COUNTS_FIELDS_KEY, COUNTS_ITEMS_KEY, COUNTS_ITEM_FIELDS_KEY
+
+# Magic number used to detect the format
+BINARY_MAGIC = b'JDBB'
+
+# Format version, and the version written when no value needs the current one
+BINARY_VERSION = 5
+BASE_VERSION = 4
+
+# Size of the item hashes in the index
+DIGEST_SIZE = 32
+NO_DIGEST = bytes(DIGEST_SIZE)
+
+# Magic number at the end of the index footer
+INDEX_MAGIC = b'JDBI'
+
+# Magic number before the item names in the index
+NAMES_MAGIC = b'JDBN'
+
+# Field value types
+VALUE_STR = 0
+VALUE_INT = 1
+VALUE_FLOAT = 2
+VALUE_BIG_INT = 3  # integers that do not fit in 64 bits, stored as strings
+VALUE_AEAD = 4  # AES-GCM tokens, stored as raw bytes (version 5)
+
+# Field table reference used for field names that are not in the table
+NO_FIELD_REF = 0
+
+# Pre-compiled structures
+_U8 = struct.Struct('<B')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+_HEADER = struct.Struct('<4sB')
+_ITEM_HEADER = struct.Struct('<Iq')
+_FIELD_HEADER = struct.Struct('<IB')
+_FOOTER = struct.Struct('<QI4s')
+
+# Integer range for VALUE_INT
+_I64_MIN = -2 ** 63
+_I64_MAX = 2 ** 63 - 1
+
+
+def is_binary(data: bytes) -> bool:
+    """
+    Check whether the data is in binary format
+    :param data: file contents
+    :return: True if it is, False otherwise
+    """
+    return data[:len(BINARY_MAGIC)] == BINARY_MAGIC
+
+
+class BinaryWriter:
+    """
+    Accumulate binary data in a list of byte strings
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def __len__(self) -> int:
+        return sum(len(x) for x in self.chunks)
+
+    def get_value(self) -> bytes:
+        return b''.join(self.chunks)
+
+    def u8(self, value: int):
+        self.chunks.append(_U8.pack(value))
+
+    def u16(self, value: int):
+        self.chunks.append(_U16.pack(value))
+
+    def u32(self, value: int):
+        self.chunks.append(_U32.pack(value))
+
+    def string(self, value: str):
+        data = value.encode()
+        self.chunks.append(_U32.pack(len(data)))
+        self.chunks.append(data)
+
+    def raw(self, data: bytes):
+        self.chunks.append(_U32.pack(len(data)))
+        self.chunks.append(data)
+
+    def value(self, value: str | int | float):
+        """
+        Write a typed field value
+        :param value: value
+        """
+        if is_aead_token(value):
+            self.u8(VALUE_AEAD)
+            self.raw(aead_token_to_bytes(value))
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            self.u8(VALUE_STR)
+            self.string(str(value))
+        elif isinstance(value, float):
+            self.u8(VALUE_FLOAT)
+            self.chunks.append(_F64.pack(value))
+        elif _I64_MIN <= value <= _I64_MAX:
+            self.u8(VALUE_INT)
+            self.chunks.append(_I64.pack(value))
+        else:
+            self.u8(VALUE_BIG_INT)
+            self.string(str(value))
+
+
+class BinaryReader:
+    """
+    Decode binary data sequentially from a buffer
+    """
+
+    def __init__(self, data: bytes | memoryview, offset=0):
+        self.data = data
+        self.offset = offset
+
+    def u8(self) -> int:
+        value = self.data[self.offset]
+        self.offset += 1
+        return value
+
+    def u16(self) -> int:
+        value, = _U16.unpack_from(self.data, self.offset)
+        self.offset += 2
+        return value
+
+    def u32(self) -> int:
+        value, = _U32.unpack_from(self.data, self.offset)
+        self.offset += 4
+        return value
+
+    def string(self) -> str:
+        length, = _U32.unpack_from(self.data, self.offset)
+        start = self.offset + 4
+        self.offset = start + length
+        return str(self.data[start:self.offset], 'utf-8')
+
+    def raw(self) -> bytes:
+        length, = _U32.unpack_from(self.data, self.offset)
+        start = self.offset + 4
+        self.offset = start + length
+        return bytes(self.data[start:self.offset])
+
+    def value(self) -> str | int | float:
+        """
+        Read a typed field value
+        :return: value
+        """
+        value_type = self.u8()
+        if value_type == VALUE_STR:
+            return self.string()
+        elif value_type == VALUE_INT:
+            value, = _I64.unpack_from(self.data, self.offset)
+            self.offset += 8
+            return value
+        elif value_type == VALUE_FLOAT:
+            value, = _F64.unpack_from(self.data, self.offset)
+            self.offset += 8
+            return value
+        elif value_type == VALUE_BIG_INT:
+            return int(self.string())
+        elif value_type == VALUE_AEAD:
+            return aead_token_from_bytes(self.raw())
+        else:
+            raise ValueError(f'unknown value type {value_type}')
+
+
+def encode_item(json_item: dict, field_ref: dict) -> bytes:
+    """
+    Encode an item record
+    :param json_item: item dictionary, as returned by Item.export()
+    :param field_ref: dictionary used to map field names to field table uid
+    :return: item record
+    """
+    w = BinaryWriter()
+    w.chunks.append(_ITEM_HEADER.pack(int(json_item[ITEM_UID_KEY]), int(json_item[ITEM_TIMESTAMP_KEY])))
+    w.string(json_item[ITEM_NAME_KEY])
+    w.string(json_item[ITEM_NOTE_KEY])
+    w.u16(len(json_item[ITEM_TAG_LIST_KEY]))
+    for tag_uid in json_item[ITEM_TAG_LIST_KEY]:
+        w.u32(int(tag_uid))
+    w.u16(len(json_item[ITEM_FIELDS_KEY]))
+    for field in json_item[ITEM_FIELDS_KEY].values():
+        f_name = field[FIELD_NAME_KEY]
+        ref = field_ref.get(f_name, NO_FIELD_REF)
+        w.chunks.append(_FIELD_HEADER.pack(ref, 1 if field[FIELD_SENSITIVE_KEY] else 0))
+        if ref == NO_FIELD_REF:
+            w.string(f_name)
+        w.value(field[FIELD_VALUE_KEY])
+    return w.get_value()
+
+
+def decode_item(data: bytes | memoryview, field_names: dict, offset=0) -> dict:
+    """
+    Decode an item record
+    :param data: buffer containing the record
+    :param field_names: dictionary used to map field table uid to field names
+    :param offset: record offset in the buffer
+    :return: item dictionary, in the same format returned by Item.export()
+    """
+    r = BinaryReader(data, offset)
+    uid, time_stamp = _ITEM_HEADER.unpack_from(data, r.offset)
+    r.offset += _ITEM_HEADER.size
+    name = r.string()
+    note = r.string()
+    tag_list = [r.u32() for _ in range(r.u16())]
+    fields = {}
+    for n in range(r.u16()):
+        ref, sensitive = _FIELD_HEADER.unpack_from(data, r.offset)
+        r.offset += _FIELD_HEADER.size
+        f_name = r.string() if ref == NO_FIELD_REF else field_names[ref]
+        fields[str(n)] = {FIELD_NAME_KEY: f_name, FIELD_VALUE_KEY: r.value(), FIELD_SENSITIVE_KEY: sensitive == 1}
+    return {ITEM_NAME_KEY: name, ITEM_TAG_LIST_KEY: tag_list, ITEM_NOTE_KEY: note,
+            ITEM_TIMESTAMP_KEY: time_stamp, ITEM_UID_KEY: uid, ITEM_FIELDS_KEY: fields}
+
+
+def encode_database(json_data: dict) -> bytes:
+    """
+    Encode the dictionary representation of a database
+    :param json_data: database dictionary, as returned by Database.export()
+    :return: binary data
+    """
+    field_ref = {x[FIELD_NAME_KEY]: int(x[KEY_UID]) for x in json_data[DB_FIELDS_KEY]}
+
+    # Count how many items use each tag and field
+    tag_count = {int(x[KEY_UID]): 0 for x in json_data[DB_TAGS_KEY]}
+    field_count = {x: 0 for x in field_ref.values()}
+    # The current version is only needed for AES-GCM tokens
+    version = BASE_VERSION
+    for json_item in json_data[DB_ITEMS_KEY].values():
+        for tag_uid in json_item[ITEM_TAG_LIST_KEY]:
+            if tag_uid in tag_count:
+                tag_count[tag_uid] += 1
+        for field in json_item[ITEM_FIELDS_KEY].values():
+            if field[FIELD_NAME_KEY] in field_ref:
+                field_count[field_ref[field[FIELD_NAME_KEY]]] += 1
+            if version == BASE_VERSION and is_aead_token(field[FIELD_VALUE_KEY]):
+                version = BINARY_VERSION
+
+    w = BinaryWriter()
+    w.chunks.append(_HEADER.pack(BINARY_MAGIC, version))
+    w.string(json_data.get(DB_GENERATION_KEY) or '')
+    w.string(json_data.get(DB_HASH_KEY) or '')
+
+    w.u32(len(json_data[DB_TAGS_KEY]))
+    for tag in json_data[DB_TAGS_KEY]:
+        w.u32(int(tag[KEY_UID]))
+        w.u32(tag_count[int(tag[KEY_UID])])
+        w.string(tag[KEY_NAME])
+
+    w.u32(len(json_data[DB_FIELDS_KEY]))
+    for field in json_data[DB_FIELDS_KEY]:
+        w.u32(int(field[KEY_UID]))
+        w.u8(1 if field[FIELD_SENSITIVE_KEY] else 0)
+        w.u32(field_count[int(field[KEY_UID])])
+        w.string(field[FIELD_NAME_KEY])
+
+    w.u32(len(json_data[DB_ITEMS_KEY]))
+    offset = len(w)
+    index = []
+    for json_item in json_data[DB_ITEMS_KEY].values():
+        record = encode_item(json_item, field_ref)
+        w.u32(len(record))
+        w.chunks.append(record)
+        index.append((int(json_item[ITEM_UID_KEY]), offset + 4, len(record), json_item[ITEM_NAME_KEY].encode()))
+        offset += 4 + len(record)
+
+    index.sort()
+    w.chunks.append(struct.pack(f'<{len(index)}I', *[x[0] for x in index]))
+    w.chunks.append(struct.pack(f'<{len(index)}Q', *[x[1] for x in index]))
+    w.chunks.append(struct.pack(f'<{len(index)}I', *[x[2] for x in index]))
+    digests = json_data.get(DB_DIGESTS_KEY) or {}
+    w.chunks.append(b''.join(bytes.fromhex(digests[str(x[0])]) if str(x[0]) in digests else NO_DIGEST
+                             for x in index))
+    w.chunks.append(NAMES_MAGIC)
+    w.chunks.append(struct.pack(f'<{len(index)}I', *[len(x[3]) for x in index]))
+    w.chunks.append(b''.join(x[3] for x in index))
+    w.chunks.append(_FOOTER.pack(offset, len(index), INDEX_MAGIC))
+
+    return w.get_value()
+
+
+class BinaryIndex:
+    """
+    Tables and item index of a database in binary format
+    """
+
+    def __init__(self, version: int, generation: Optional[str], content_hash: Optional[str],
+                 tag_list: list, field_list: list, tag_count: dict, field_count: dict):
+        """
+        :param version: format version
+        :param generation: database generation
+        :param content_hash: hash of the database contents
+        :param tag_list: tag table, in the same format returned by Table.export()
+        :param field_list: field table, in the same format returned by Table.export()
+        :param tag_count: number of items using each tag (indexed by tag uid)
+        :param field_count: number of items using each field (indexed by field uid)
+        """
+        self.version = version
+        self.generation = generation
+        self.content_hash = content_hash
+        self.tag_list = tag_list
+        self.field_list = field_list
+        self.tag_count = tag_count
+        self.field_count = field_count
+        self.field_names = {x[KEY_UID]: x[KEY_NAME] for x in field_list}
+        # Item uid in ascending order, and the offset and length of the corresponding records
+        self.uid_list = array('I')
+        self.offset_list = array('Q')
+        self.length_list = array('I')
+        # Hash of each item, by uid (see digest.py)
+        self.digests: dict[int, bytes] = {}
+        # Offset of the item names (None if the index has no names)
+        self.names_offset: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self.uid_list)
+
+    def find(self, uid: int) -> int:
+        """
+        Return the position of an item in the index
+        :param uid: item uid
+        :return: position, or -1 if the item is not in the index
+        """
+        n = bisect_left(self.uid_list, uid)
+        return n if n < len(self.uid_list) and self.uid_list[n] == uid else -1
+
+    def decode_item(self, data: bytes | memoryview, uid: int) -> dict:
+        """
+        Decode a single item
+        :param data: binary data
+        :param uid: item uid
+        :return: item dictionary, in the same format returned by Item.export()
+        :raise: KeyError if the item is not in the index
+        """
+        n = self.find(uid)
+        if n < 0:
+            raise KeyError(f'{uid} does not exist')
+        return decode_item(data, self.field_names, self.offset_list[n])
+
+    def item_names(self, data: bytes | memoryview) -> Optional[list[str]]:
+        """
+        Return the item names stored in the index, without decoding the items
+        :param data: binary data
+        :return: name of each item, in the same order as the uid, or None if the index has no names
+        """
+        if self.names_offset is None:
+            return None
+        n = len(self.uid_list)
+        length_list = _read_array(data, self.names_offset, 'I', n)
+        offset = self.names_offset + 4 * n
+        names = []
+        for length in length_list:
+            names.append(str(data[offset:offset + length], 'utf-8'))
+            offset += length
+        return names
+
+
+def decode_tables(r: BinaryReader) -> BinaryIndex:
+    """
+    Decode the header and the tag and field tables. The item index is not read.
+    :param r: reader positioned at the start of the data
+    :return: index with the tables (the item counts are empty for version 1)
+    :raise: ValueError if the data is not in binary format
+    """
+    magic, version = _HEADER.unpack_from(r.data, r.offset)
+    if magic != BINARY_MAGIC:
+        raise ValueError('not a binary database')
+    if version not in [1, 2, 3, 4, BINARY_VERSION]:
+        raise ValueError(f'unsupported binary format version {version}')
+    r.offset += _HEADER.size
+    generation = r.string() or None
+    content_hash = (r.string() if version > 2 else '') or None
+    tag_list, tag_count = [], {}
+    for _ in range(r.u32()):
+        uid = r.u32()
+        if version > 1:
+            tag_count[uid] = r.u32()
+        tag_list.append({KEY_NAME: r.string(), KEY_UID: uid})
+    field_list, field_count = [], {}
+    for _ in range(r.u32()):
+        uid = r.u32()
+        sensitive = r.u8() == 1
+        if version > 1:
+            field_count[uid] = r.u32()
+        field_list.append({KEY_NAME: r.string(), KEY_UID: uid, FIELD_SENSITIVE_KEY: sensitive})
+    return BinaryIndex(version, generation, content_hash, tag_list, field_list, tag_count, field_count)
+
+
+def _read_array(data: bytes | memoryview, offset: int, type_code: str, n: int) -> array:
+    """
+    Read an array of little endian integers
+    :param data: binary data
+    :param offset: array offset
+    :param type_code: array type code
+    :param n: number of elements
+    :return: array
+    """
+    a = array(type_code)
+    a.frombytes(data[offset:offset + n * a.itemsize])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def read_index(data: bytes | memoryview) -> Optional[BinaryIndex]:
+    """
+    Read the tables and the item index without reading the items
+    :param data: binary data
+    :return: index, or None if the data has no index (version 1)
+    :raise: ValueError if the data is not in binary format
+    """
+    index = decode_tables(BinaryReader(data))
+    if index.version < 2:
+        return None
+    index_offset, n, magic = _FOOTER.unpack_from(data, len(data) - _FOOTER.size)
+    if magic != INDEX_MAGIC:
+        raise ValueError('bad index footer')
+    index.uid_list = _read_array(data, index_offset, 'I', n)
+    index.offset_list = _read_array(data, index_offset + 4 * n, 'Q', n)
+    index.length_list = _read_array(data, index_offset + 12 * n, 'I', n)
+    if index.version > 3:
+        offset = index_offset + 16 * n
+        for uid in index.uid_list:
+            digest = bytes(data[offset:offset + DIGEST_SIZE])
+            if digest != NO_DIGEST:
+                index.digests[uid] = digest
+            offset += DIGEST_SIZE
+        if data[offset:offset + len(NAMES_MAGIC)] == NAMES_MAGIC and offset < len(data) - _FOOTER.size:
+            index.names_offset = offset + len(NAMES_MAGIC)
+    return index
+
+
+def next_record(r: BinaryReader) -> Generator[tuple[int, int], None, None]:
+    """
+    Iterate over the item records without decoding them
+    :param r: reader positioned at the start of the item section
+    :return: tuple with the record offset and length
+    """
+    for _ in range(r.u32()):
+        length = r.u32()
+        yield r.offset, length
+        r.offset += length
+
+
+def decode_database(data: bytes | memoryview) -> dict:
+    """
+    Decode a database in binary format. The item counts in the tables are returned as the
+    counters of the database (see Database.counts()), except for version 1 files, and the
+    item hashes are returned as well, except for files older than version 4.
+    :param data: binary data
+    :return: database dictionary, in the same format returned by Database.export()
+    :raise: ValueError
+    """
+    r = BinaryReader(data)
+    index = decode_tables(r)
+    items = {}
+    for offset, _ in next_record(r):
+        json_item = decode_item(data, index.field_names, offset)
+        items[str(json_item[ITEM_UID_KEY])] = json_item
+    json_data = {DB_TAGS_KEY: index.tag_list, DB_FIELDS_KEY: index.field_list, DB_ITEMS_KEY: items,
+                 DB_GENERATION_KEY: index.generation, DB_HASH_KEY: index.content_hash}
+    if index.version > 3:
+        json_data[DB_DIGESTS_KEY] = {str(uid): digest.hex() for uid, digest in read_index(data).digests.items()}
+    if index.version > 1:
+        json_data[DB_COUNTS_KEY] = {COUNTS_GENERATION_KEY: index.generation,
+                                    COUNTS_TAGS_KEY: {str(x): n for x, n in index.tag_count.items()},
+                                    COUNTS_FIELDS_KEY: {str(x): n for x, n in index.field_count.items()},
+                                    COUNTS_ITEMS_KEY: len(items),
+                                    COUNTS_ITEM_FIELDS_KEY: sum(index.field_count.values())}
+    return json_data
+
+
+if __name__ == '__main__':
+    d = {DB_TAGS_KEY: [{KEY_NAME: 'web', KEY_UID: 10}],
+         DB_FIELDS_KEY: [{KEY_NAME: 'user', KEY_UID: 100, FIELD_SENSITIVE_KEY: False}],
+         DB_ITEMS_KEY: {'1000': {ITEM_NAME_KEY: 'item', ITEM_TAG_LIST_KEY: [10], ITEM_NOTE_KEY: 'note',
+                                 ITEM_TIMESTAMP_KEY: 12345, ITEM_UID_KEY: 1000,
+                                 ITEM_FIELDS_KEY: {'5000': {FIELD_NAME_KEY: 'user', FIELD_VALUE_KEY: 'joe',
+                                                            FIELD_SENSITIVE_KEY: False},
+                                                   '5001': {FIELD_NAME_KEY: 'pin', FIELD_VALUE_KEY: 1234,
+                                                            FIELD_SENSITIVE_KEY: True}}}},
+         DB_GENERATION_KEY: 'abc'}
+    b = encode_database(d)
+    print(len(b), b)
+    print(decode_database(b))
+    i = read_index(b)
+    print(i.tag_count, i.field_count, i.uid_list, i.offset_list, i.length_list, i.decode_item(b, 1000))
@@ -3,9 +3,18 @@ from os.path import exists
 from typing import Optional
 
 from db import Database, DEFAULT_DATABASE_NAME
+from compaction import Compactor, DEFAULT_MAX_JOURNAL_SIZE, DEFAULT_MAX_JOURNAL_RECORDS
 from items import Item, Field, FieldCollection
+from journal import RENAME_OLD_KEY
+from journal import OP_TAG_ADD, OP_TAG_RENAME, OP_TAG_DELETE, OP_FIELD_ADD, OP_FIELD_DELETE
+from journal import OP_ITEM_PUT, OP_ITEM_DELETE
+from common import KEY_NAME, KEY_UID, FIELD_NAME_KEY, FIELD_SENSITIVE_KEY, ITEM_UID_KEY, FORMAT_JSON
+from compression import CODEC_NONE
+from durable import DEFAULT_DURABILITY
+from storage import ENGINE_FILE
+from kdf import DEFAULT_KDF, DEFAULT_TARGET_TIME, KDF_PBKDF2, new_parameters, calibrate
 from utils import get_password, get_timestamp, timestamp_to_string, print_line, sensitive_mark, trace
-from uid import TagTableUid, FieldTableUid, FieldUid, ItemUid
+from uid import TagTableUid, FieldTableUid, FieldUid, ItemUid, clear_all
 
 
 class CommandProcessor:
@@ -16,18 +25,49 @@ class CommandProcessor:
         """
         self.file_name = ''  # database file name
         self.db = None  # database object
+        self.compactor = None  # journal compactor
+        # Journal compaction settings. Compaction runs in the background only if enabled.
+        self.background_compaction = False
+        self.max_journal_size = DEFAULT_MAX_JOURNAL_SIZE
+        self.max_journal_records = DEFAULT_MAX_JOURNAL_RECORDS
+        # Key derivation function and cost used for new databases (default cost if None, see database_calibrate())
+        self.kdf_algorithm = DEFAULT_KDF
+        self.kdf_cost: Optional[int] = None
 
     def db_loaded(self, msg_flag=True) -> bool:
         """
-        Check whether there's a database in memory
+        Check whether there's a database in memory. A database opened in read-only mode
+        is read again if another process changed it. If it cannot be read again, it's
+        removed from memory, since it was left empty.
         :return: True if that's the case, False otherwise
         """
         if self.db is None:
             if msg_flag:
                 self.error('no database loaded', None)
             return False
-        else:
-            return True
+        if self.db.read_only:
+            try:
+                if self.db.refresh():
+                    print(f'Database {self.file_name} changed, read again')
+            except Exception as e:
+                self.error(f'cannot read database {self.file_name} again', e)
+                self.stop_compactor()
+                self.db = None
+                return False
+        return True
+
+    def db_writable(self) -> bool:
+        """
+        Check whether there's a database in memory that can be modified
+        :return: True if that's the case, False otherwise
+        """
+        if not self.db_loaded():
+            return False
+        assert isinstance(self.db, Database)
+        if self.db.read_only:
+            self.error(f'database {self.file_name} is read-only')
+            return False
+        return True
 
     @staticmethod
     def error(label: str, e: Optional[Exception] = None):
@@ -42,9 +82,28 @@ class CommandProcessor:
         else:
             print(f'Error: {label} - {e}')
 
+    def start_compactor(self):
+        """
+        Create the compactor for the database in memory, replacing the previous one.
+        The compactor runs in the background when journaling and background compaction are enabled.
+        """
+        self.stop_compactor()
+        assert isinstance(self.db, Database)
+        self.compactor = Compactor(self.db, max_size=self.max_journal_size, max_records=self.max_journal_records)
+        if self.background_compaction and self.db.journal_enabled:
+            self.compactor.start()
+
+    def stop_compactor(self):
+        """
+        Stop the compactor, if running
+        """
+        if self.compactor is not None:
+            self.compactor.stop()
+            self.compactor = None
+
     @staticmethod
-    def confirm() -> bool:
-        print('There is a database already in memory')
+    def confirm(message='There is a database already in memory') -> bool:
+        print(message)
         answer = input('Do you want to overwrite it (yes/no)? ')
         return answer == 'yes'
 
@@ -52,16 +111,25 @@ class CommandProcessor:
     # Database commands
     # -----------------------------------------------------------------
 
-    def database_create(self, file_name=DEFAULT_DATABASE_NAME):
+    def database_create(self, file_name=DEFAULT_DATABASE_NAME, journal=False, file_format: Optional[str] = None,
+                        codec: Optional[str] = None, level: Optional[int] = None, durability=DEFAULT_DURABILITY,
+                        engine=ENGINE_FILE, cipher: Optional[str] = None):
         """
         Create an empty database
         :param file_name: database file name
+        :param journal: save changes to a journal?
+        :param file_format: file format (json by default)
+        :param codec: compression codec (no compression by default)
+        :param level: compression level (codec default if not specified)
+        :param durability: what is flushed to disk when writing (see durable.py)
+        :param engine: storage engine (see storage.py)
+        :param cipher: cipher used for the sensitive values (see crypt.py, Fernet by default)
         """
-        trace('database_create', file_name)
+        trace('database_create', file_name, journal, file_format, codec, level, durability, engine, cipher)
 
         # Check whether there's a database already in memory
         # and ask for confirmation to overwrite if that's the case.
-        if self.db_loaded(msg_flag=False) and not self.confirm():
+        if self.db is not None and not self.confirm():
             return
 
         # Check whether the file exists already.
@@ -70,38 +138,135 @@ class CommandProcessor:
             self.error(f'database {file_name} already exists')
         else:
             self.file_name = file_name
-            self.db = Database(file_name, get_password())
+            self.db = Database(file_name, get_password(), journal=journal, file_format=file_format,
+                               codec=codec, level=level, durability=durability, engine=engine,
+                               kdf=new_parameters(self.kdf_algorithm, self.kdf_cost), cipher=cipher)
+            self.start_compactor()
 
-    def database_read(self, file_name: str):
+    def database_read(self, file_name: str, journal=False, file_format: Optional[str] = None, lazy=False,
+                      codec: Optional[str] = None, level: Optional[int] = None, durability=DEFAULT_DURABILITY,
+                      engine=ENGINE_FILE, read_only=False):
         """
         Read database into memory
         :param file_name: database file name
+        :param journal: save changes to a journal?
+        :param file_format: file format used when writing (same as the file by default)
+        :param lazy: create the items on first access? (binary files only)
+        :param codec: compression codec used when writing (same as the file by default)
+        :param level: compression level (codec default if not specified)
+        :param durability: what is flushed to disk when writing (see durable.py)
+        :param engine: storage engine (see storage.py)
+        :param read_only: open for lookups only? (the commands that modify the database are refused)
         :return:
         """
-        trace('database_read', file_name)
+        trace('database_read', file_name, journal, file_format, lazy, codec, level, durability, engine, read_only)
 
         # Check whether there's a database already in memory
         # and ask for confirmation to overwrite if that's the case.
-        if self.db_loaded(msg_flag=False) and not self.confirm():
+        if self.db is not None and not self.confirm():
             return
 
         # Read the database
         try:
-            self.db = Database(file_name, get_password())
+            self.db = Database(file_name, get_password(), journal=journal, file_format=file_format,
+                               codec=codec, level=level, durability=durability, engine=engine, read_only=read_only)
             self.file_name = file_name
-            self.db.read()
+            self.db.read(lazy=lazy)
+            if read_only:
+                self.stop_compactor()
+            else:
+                self.start_compactor()
         except Exception as e:
             self.error(f'failed to read database {file_name}', e)
 
     def database_write(self):
         trace('database_write')
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
-                self.db.write()
+                if not self.db.write():
+                    print('Nothing to write')
             except Exception as e:
                 self.error('cannot write database', e)
 
+    def database_compact(self):
+        """
+        Fold the journal into the database file
+        """
+        trace('database_compact')
+        if self.db_writable():
+            assert isinstance(self.compactor, Compactor)
+            try:
+                if not self.compactor.compact():
+                    print('Nothing to compact')
+            except Exception as e:
+                self.error('cannot compact database', e)
+
+    def database_verify(self):
+        """
+        Check the stored database against the item hashes and the content hash stored with it
+        """
+        trace('database_verify')
+        if self.db_loaded():
+            assert isinstance(self.db, Database)
+            try:
+                root_ok, corrupted, missing = self.db.verify()
+            except Exception as e:
+                self.error('cannot verify database', e)
+                return
+            for uid in corrupted:
+                print(f'Item {uid} does not match its hash')
+            if missing:
+                print(f'{len(missing)} items without a stored hash were not checked')
+            if root_ok is None:
+                print('Content hash not checked')
+            elif not root_ok:
+                print('Content hash does not match')
+            if not corrupted and root_ok is not False:
+                print('No corrupted items found')
+
+    def database_calibrate(self, algorithm=DEFAULT_KDF, target_time=DEFAULT_TARGET_TIME):
+        """
+        Find the cost of the key derivation function that makes unlocking a database take a given time
+        on this machine, and use it for the databases created afterwards. The existing databases keep
+        the parameters they were created with.
+        :param algorithm: key derivation function (see kdf.py)
+        :param target_time: time needed to unlock a database (seconds)
+        """
+        trace('database_calibrate', algorithm, target_time)
+        try:
+            cost, t = calibrate(algorithm, target_time)
+        except Exception as e:
+            self.error('cannot calibrate', e)
+            return
+        self.kdf_algorithm, self.kdf_cost = algorithm, cost
+        unit = 'iterations' if algorithm == KDF_PBKDF2 else 'n'
+        print(f'{algorithm} with {unit}={cost} takes {t * 1000:.0f} ms, used for new databases')
+
+    def database_restore(self, time_stamp: Optional[str] = None):
+        """
+        Restore the version of the database in a backup, or list the backups
+        :param time_stamp: backup time stamp (list the backups if not specified)
+        """
+        trace('database_restore', time_stamp)
+        if self.db_loaded():
+            assert isinstance(self.db, Database)
+            if time_stamp is None:
+                for ts, description in self.db.list_backups():
+                    print(f'{ts} {description}')
+                return
+            if not self.db_writable():
+                return
+            if not self.confirm(f'The database will be replaced by the backup {time_stamp}'):
+                return
+            try:
+                self.db.restore(time_stamp)
+                clear_all()
+                self.db.clear()
+                self.db.read()
+            except Exception as e:
+                self.error(f'cannot restore backup {time_stamp}', e)
+
     def database_export(self, file_name: str):
         trace('database_export', file_name)
         if self.db_loaded():
@@ -150,10 +315,11 @@ class CommandProcessor:
         :param name:
         :return:
         """
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 self.db.tag_table.add(name)
+                self.db.record(OP_TAG_ADD, {KEY_NAME: name, KEY_UID: self.db.tag_table.get_uid(name)})
             except Exception as e:
                 self.error(f'cannot add tag {name}', e)
 
@@ -164,10 +330,11 @@ class CommandProcessor:
         :param new_name: new tag name
         :return:
         """
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 self.db.tag_table.rename(old_name, new_name)
+                self.db.record(OP_TAG_RENAME, {RENAME_OLD_KEY: old_name, KEY_NAME: new_name})
             except Exception as e:
                 self.error(f'cannot rename tag {old_name} to {new_name}', e)
 
@@ -177,10 +344,11 @@ class CommandProcessor:
         :param name: tag name
         :return:
         """
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 self.db.tag_table.remove(name=name)
+                self.db.record(OP_TAG_DELETE, {KEY_NAME: name})
             except Exception as e:
                 self.error(f'cannot delete tag {name}', e)
 
@@ -236,10 +404,12 @@ class CommandProcessor:
         :return:
         """
         trace('field_add', name, sensitive_flag)
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 self.db.field_table.add(name=name, sensitive=sensitive_flag)
+                self.db.record(OP_FIELD_ADD, {FIELD_NAME_KEY: name, FIELD_SENSITIVE_KEY: sensitive_flag,
+                                              KEY_UID: self.db.field_table.get_uid(name)})
             except Exception as e:
                 self.error('cannot add field {name}', e)
 
@@ -249,10 +419,11 @@ class CommandProcessor:
         :param name: field name
         """
         trace('field_delete', name)
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 self.db.field_table.remove(name=name)
+                self.db.record(OP_FIELD_DELETE, {FIELD_NAME_KEY: name})
             except Exception as e:
                 self.error('cannot remove field {name}', e)
 
@@ -271,14 +442,13 @@ class CommandProcessor:
 
     def item_list(self):
         """
-        List all items
+        List all items. Items read lazily are not created to get their names.
         """
         trace('item_list')
         if self.db_loaded():
             assert isinstance(self.db, Database)
-            for item in self.db.item_collection.next():
-                assert isinstance(item, Item)
-                print(f'{item.get_id()} - {item.name}')
+            for uid, name in self.db.item_collection.next_name():
+                print(f'{uid} - {name}')
 
     def item_print(self, uid: int, show_sensitive: bool):
         """
@@ -350,10 +520,11 @@ class CommandProcessor:
         :param uid: item uid
         """
         trace(f'item_delete {uid}')
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 self.db.item_collection.remove(uid)
+                self.db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid})
             except Exception as e:
                 self.error('error while removing item', e)
 
@@ -367,7 +538,7 @@ class CommandProcessor:
         :param multiline_note:
         """
         trace('item_create')
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
 
             # Make sure the name is specified
@@ -398,6 +569,7 @@ class CommandProcessor:
                 item = Item(item_name, tag_uid_list, note, fc, time_stamp=get_timestamp())
                 # item.dump()
                 self.db.item_collection.add(item)
+                self.db.record(OP_ITEM_PUT, item.export())
                 print(f'Added item {item.get_id()}')
             except Exception as e:
                 self.error(f'Error while adding item {item_name}', e)
@@ -446,7 +618,7 @@ class CommandProcessor:
         :param add_flag: allow adding items? (used for tags only)
         """
         trace('item_edit', uid)
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 item = self.db.item_collection.get(uid)
@@ -517,6 +689,7 @@ class CommandProcessor:
                 new_item = Item(new_name, new_tag_list, new_note, fc, time_stamp=get_timestamp(), uid=item.get_id())
                 new_item.dump()
                 self.db.item_collection.update(new_item)
+                self.db.record(OP_ITEM_PUT, new_item.export())
             except Exception as e:
                 self.error('error when creating item', e)
                 return
@@ -528,7 +701,7 @@ class CommandProcessor:
         :param uid: item uid
         """
         trace('item_copy', uid)
-        if self.db_loaded():
+        if self.db_writable():
             assert isinstance(self.db, Database)
             try:
                 item = self.db.item_collection.get(uid)
@@ -542,6 +715,7 @@ class CommandProcessor:
                                 uid=ItemUid.get_uid())
                 trace('new item', new_item)
                 self.db.item_collection.add(new_item)
+                self.db.record(OP_ITEM_PUT, new_item.export())
                 print(f'create item {new_item.get_id()} from {item.get_id()}')
             except Exception as e:
                 print('cannot make copy of item', e)
@@ -572,6 +746,10 @@ class CommandProcessor:
         Command that will be called when the program exits
         """
         trace(f'quit_command {self.file_name}', keyboard_interrupt)
+        self.stop_compactor()
+        # Forget the sensitive values decrypted during the session
+        if self.db is not None and self.db.crypt_key is not None:
+            self.db.crypt_key.value_cache.clear()
 
     def report(self):
         """
@@ -581,6 +759,12 @@ class CommandProcessor:
             print(f'Tag table:         {len(self.db.tag_table)}')
             print(f'Field table:       {len(self.db.field_table)}')
             print(f'Items collection:  {len(self.db.item_collection)}')
+            print(f'Item fields:       {self.db.field_table.total()}')
+            print(f'Journal:           {len(self.db.journal)} records, {self.db.journal.size()} bytes')
+            print(f'File format:       {self.db.file_format or FORMAT_JSON}, compression {self.db.codec or CODEC_NONE}')
+            print(f'Durability:        {self.db.durability}')
+            print(f'Storage engine:    {self.db.engine.name}{", read-only" if self.db.read_only else ""}')
+            print(f'Backups:           {len(self.db.list_backups())}, retention {self.db.retention}')
             print('Unique identifiers')
             print(f'\tTag table    {TagTableUid.to_str()}')
             print(f'\tField table  {FieldTableUid.to_str()}')
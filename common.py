@@ -21,5 +21,32 @@ ITEM_TIMESTAMP_KEY = 'timestamp'
 ITEM_UID_KEY = KEY_UID
 ITEM_FIELDS_KEY = 'fields'
 
+# The database is stored on disk as a json dictionary with three keys
+DB_TAGS_KEY = 'tags'
+DB_FIELDS_KEY = 'fields'
+DB_ITEMS_KEY = 'items'
+
+# Key used to store the snapshot generation. The journal is tied to a given generation.
+DB_GENERATION_KEY = 'generation'
+
+# Key used to store the hash of the database contents (see digest.py)
+DB_HASH_KEY = 'hash'
+
+# Key used to store the table counters and totals, so they don't need to be computed when reading
+# (see Database.counts()). They are only valid for the generation they were written with.
+DB_COUNTS_KEY = 'counts'
+COUNTS_GENERATION_KEY = DB_GENERATION_KEY
+COUNTS_TAGS_KEY = DB_TAGS_KEY
+COUNTS_FIELDS_KEY = DB_FIELDS_KEY
+COUNTS_ITEMS_KEY = DB_ITEMS_KEY
+COUNTS_ITEM_FIELDS_KEY = 'item_fields'
+
+# Key used to store the hash of each item, by uid, to check them individually (see digest.py)
+DB_DIGESTS_KEY = 'digests'
+
+# Database file formats
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+
 # Default database name
 DEFAULT_DATABASE_NAME = 'pw.db'
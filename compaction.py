@@ -0,0 +1,99 @@
+"""
+Journal compaction. The journal is folded into a new generation of the database file
+when it grows past a given size or number of records, either on demand or from a
+background thread.
+"""
+import threading
+from typing import Optional
+from db import Database
+from utils import trace
+
+# Default compaction triggers
+DEFAULT_MAX_JOURNAL_SIZE = 1024 * 1024  # bytes
+DEFAULT_MAX_JOURNAL_RECORDS = 1000
+
+# Default time between checks when running in the background (seconds)
+DEFAULT_CHECK_INTERVAL = 30.0
+
+
+class Compactor:
+
+    def __init__(self, db: Database, max_size=DEFAULT_MAX_JOURNAL_SIZE, max_records=DEFAULT_MAX_JOURNAL_RECORDS,
+                 interval=DEFAULT_CHECK_INTERVAL):
+        """
+        :param db: database
+        :param max_size: compact when the journal reaches this size in bytes (zero to disable)
+        :param max_records: compact when the journal reaches this number of records (zero to disable)
+        :param interval: time between checks when running in the background (seconds)
+        """
+        self.db = db
+        self.max_size = max_size
+        self.max_records = max_records
+        self.interval = interval
+        self.thread = None
+        self.stop_event = threading.Event()
+        # Last error found by the background thread
+        self.error: Optional[Exception] = None
+
+    def needed(self) -> bool:
+        """
+        Check whether the journal reached any of the compaction triggers
+        :return: True if compaction is needed, False otherwise
+        """
+        journal = self.db.journal
+        if not journal.is_current():
+            return False
+        if self.max_size and journal.size() >= self.max_size:
+            return True
+        return bool(self.max_records and len(journal) >= self.max_records)
+
+    def compact(self) -> bool:
+        """
+        Fold the journal into a new generation of the database file.
+        The in-memory database is not used, so changes that were not written yet are
+        not included. They will be appended to the new journal on the next write.
+        The new file replaces the old one in a single rename, so a failure leaves either
+        the old file and its journal or the new file (with a stale journal that is ignored).
+        :return: True if the journal was compacted, False if there was nothing to do
+        """
+        with self.db.file_lock.exclusive(), self.db.lock:
+            if not self.db.journal.is_current():
+                return False
+            trace('compact', self.db.file_name, len(self.db.journal))
+            self.db.save(self.db.load())
+            return True
+
+    def run(self):
+        """
+        Background thread loop
+        """
+        while not self.stop_event.wait(self.interval):
+            try:
+                if self.needed():
+                    self.compact()
+            except Exception as e:
+                self.error = e
+
+    def start(self):
+        """
+        Start compacting in the background
+        """
+        if self.thread is None:
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self.run, name='compactor', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, waiting for any compaction in progress to finish
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+
+if __name__ == '__main__':
+    from common import DEFAULT_DATABASE_NAME
+    c = Compactor(Database(DEFAULT_DATABASE_NAME))
+    print('needed', c.needed())
@@ -0,0 +1,214 @@
+"""
+Compression stage applied to the database file contents before encryption.
+
+Compressed data starts with a small header, so the codec can be detected when reading:
+
+    header      magic (4 bytes), codec (1 byte)
+    payload     data compressed with the codec
+
+Data without the header is not compressed. The compressors and decompressors from
+the zlib, lzma and bz2 modules are used incrementally, so the data can also be
+compressed or decompressed one chunk at a time (see CompressWriter and DecompressReader).
+"""
+import io
+import bz2
+import lzma
+import zlib
+from typing import BinaryIO, Optional
+
+# Codec names
+CODEC_NONE = 'none'
+CODEC_ZLIB = 'zlib'
+CODEC_LZMA = 'lzma'
+CODEC_BZ2 = 'bz2'
+
+# Codec identifiers stored in the header
+CODEC_ID = {CODEC_ZLIB: 1, CODEC_LZMA: 2, CODEC_BZ2: 3}
+CODEC_LIST = [CODEC_NONE] + list(CODEC_ID.keys())
+
+# Header
+COMPRESSION_MAGIC = b'JDBZ'
+HEADER_SIZE = len(COMPRESSION_MAGIC) + 1
+
+# Number of bytes decompressed at a time
+CHUNK_SIZE = 1 << 16
+
+
+def is_compressed(data: bytes) -> bool:
+    """
+    Check whether the data starts with a compression header
+    :param data: data (or at least its first bytes)
+    :return: True if it does, False otherwise
+    """
+    return data[:len(COMPRESSION_MAGIC)] == COMPRESSION_MAGIC
+
+
+def get_codec(data: bytes) -> str:
+    """
+    Return the codec used to compress the data
+    :param data: data (or at least its first bytes)
+    :return: codec name
+    :raise: ValueError if the codec is unknown
+    """
+    if not is_compressed(data):
+        return CODEC_NONE
+    codec_id = data[len(COMPRESSION_MAGIC)] if len(data) >= HEADER_SIZE else None
+    for codec in CODEC_ID:
+        if CODEC_ID[codec] == codec_id:
+            return codec
+    raise ValueError(f'unknown compression codec {codec_id}')
+
+
+def header(codec: str) -> bytes:
+    """
+    Return the header for a codec
+    :param codec: codec name
+    :return: header
+    """
+    return COMPRESSION_MAGIC + bytes([CODEC_ID[codec]])
+
+
+def compressor(codec: str, level: Optional[int] = None):
+    """
+    Return a compressor object for a codec
+    :param codec: codec name
+    :param level: compression level (codec default if not specified)
+    :return: compressor (with compress() and flush() methods)
+    :raise: ValueError if the codec is unknown
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level)
+    elif codec == CODEC_LZMA:
+        return lzma.LZMACompressor(preset=level)
+    elif codec == CODEC_BZ2:
+        return bz2.BZ2Compressor(9 if level is None else level)
+    else:
+        raise ValueError(f'unknown compression codec {codec}')
+
+
+def decompressor(codec: str):
+    """
+    Return a decompressor object for a codec
+    :param codec: codec name
+    :return: decompressor (with a decompress() method and an eof attribute)
+    :raise: ValueError if the codec is unknown
+    """
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    elif codec == CODEC_LZMA:
+        return lzma.LZMADecompressor()
+    elif codec == CODEC_BZ2:
+        return bz2.BZ2Decompressor()
+    else:
+        raise ValueError(f'unknown compression codec {codec}')
+
+
+def compress(data: bytes, codec: str, level: Optional[int] = None) -> bytes:
+    """
+    Compress data and prepend the header
+    :param data: data to compress
+    :param codec: codec name (the data is returned unchanged if it's CODEC_NONE)
+    :param level: compression level (codec default if not specified)
+    :return: compressed data
+    """
+    if codec == CODEC_NONE:
+        return data
+    c = compressor(codec, level)
+    return header(codec) + c.compress(data) + c.flush()
+
+
+def decompress(data: bytes) -> bytes:
+    """
+    Decompress data, using the codec in the header
+    :param data: data to decompress (returned unchanged if it's not compressed)
+    :return: decompressed data
+    :raise: ValueError if the data cannot be decompressed
+    """
+    codec = get_codec(data)
+    if codec == CODEC_NONE:
+        return data
+    d = decompressor(codec)
+    try:
+        output = d.decompress(data[HEADER_SIZE:])
+    except Exception as e:
+        raise ValueError(f'failed to decompress data: {repr(e)}')
+    if not d.eof:
+        raise ValueError('failed to decompress data: truncated data')
+    return output
+
+
+class CompressWriter:
+    """
+    Write compressed data to a binary stream, one chunk at a time.
+    The header is written first. close() must be called to write the last chunk,
+    but the underlying stream is left open.
+    """
+
+    def __init__(self, f_out: BinaryIO, codec: str, level: Optional[int] = None):
+        """
+        :param f_out: output stream
+        :param codec: codec name
+        :param level: compression level (codec default if not specified)
+        """
+        self.f_out = f_out
+        self.compressor = compressor(codec, level)
+        self.f_out.write(header(codec))
+
+    def write(self, data: bytes):
+        self.f_out.write(self.compressor.compress(data))
+
+    def close(self):
+        self.f_out.write(self.compressor.flush())
+
+
+class DecompressReader(io.RawIOBase):
+    """
+    Read decompressed data from a binary stream with a compression header, one chunk at a time.
+    Use io.BufferedReader() on top of it to get the usual read functions.
+    """
+
+    def __init__(self, f_in: BinaryIO):
+        """
+        :param f_in: input stream, positioned at the compression header
+        :raise: ValueError if the codec is unknown
+        """
+        super().__init__()
+        self.f_in = f_in
+        self.decompressor = decompressor(get_codec(f_in.read(HEADER_SIZE)))
+        self.buffer = b''
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        """
+        Fill a buffer with decompressed data
+        :param b: buffer
+        :return: number of bytes read (zero at the end of the data)
+        :raise: ValueError if the data cannot be decompressed
+        """
+        while len(self.buffer) - self.pos < len(b) and not self.decompressor.eof:
+            data = self.f_in.read(CHUNK_SIZE)
+            if not data:
+                raise ValueError('failed to decompress data: truncated data')
+            try:
+                self.buffer = self.buffer[self.pos:] + self.decompressor.decompress(data)
+                self.pos = 0
+            except Exception as e:
+                raise ValueError(f'failed to decompress data: {repr(e)}')
+        n = min(len(b), len(self.buffer) - self.pos)
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.f_in.close()
+        super().close()
+
+
+if __name__ == '__main__':
+    text = b'some text that will be compressed ' * 100
+    for c_name in CODEC_LIST:
+        compressed = compress(text, c_name)
+        print(c_name, len(text), len(compressed), get_codec(compressed), decompress(compressed) == text)
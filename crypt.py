@@ -1,38 +1,149 @@
+"""
+Encryption of the database contents and of the sensitive field values.
+
+Files, shards and journal records are encrypted with Fernet. Sensitive field values are kept
+encrypted in memory, as tokens in text form, with one of two ciphers chosen when the database
+is created and stored with the key derivation parameters (see kdf.py):
+
+    fernet      Fernet tokens (AES-CBC with HMAC-SHA256), base64 encoded
+    aesgcm      version (1 byte), nonce (12 bytes), ciphertext and tag (16 bytes), base64 encoded
+
+AES-GCM tokens are shorter and faster to process, and the binary and SQLite formats store them
+as raw bytes (see aead_token_to_bytes()). Values are decrypted with the cipher that produced them,
+whatever the cipher of the database, so both kinds of tokens can be mixed.
+"""
+import os
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Sequence
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from kdf import LEGACY_PARAMETERS, derive_key, describe
+from key_agent import get_key, put_key
+from value_cache import ValueCache
 
 # Character encoding
 CHARACTER_ENCODING = 'utf-8'
 
+# Default number of threads used to encrypt or decrypt many values
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 8)
+
+# Minimum number of values given to each thread, below which threads are not worth starting
+MIN_VALUES_PER_WORKER = 256
+
+# Ciphers used for the sensitive field values
+CIPHER_FERNET = 'fernet'
+CIPHER_AES_GCM = 'aesgcm'
+CIPHER_LIST = [CIPHER_FERNET, CIPHER_AES_GCM]
+DEFAULT_CIPHER = CIPHER_FERNET
+
+# Key of the cipher in the parameters stored with the database (Fernet if missing)
+CIPHER_KEY = 'cipher'
+
+# AES-GCM tokens. The version byte makes the text form start with AEAD_PREFIX,
+# while Fernet tokens start with 'g'.
+AEAD_VERSION = 0x91
+AEAD_NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
+AEAD_PREFIX = 'k'
+AEAD_MIN_SIZE = 1 + AEAD_NONCE_SIZE + AEAD_TAG_SIZE
+
+# Context used to derive the AES-GCM key from the database key
+AEAD_KEY_INFO = b'sensitive field values'
+
+
+def is_aead_token(value) -> bool:
+    """
+    Check whether a value is an AES-GCM token in text form, exactly as returned by aead_token_from_bytes()
+    :param value: value
+    :return: True if that's the case, False otherwise
+    """
+    if not isinstance(value, str) or not value.startswith(AEAD_PREFIX) or len(value) % 4 != 0:
+        return False
+    try:
+        data = base64.urlsafe_b64decode(value)
+    except ValueError:
+        return False
+    return len(data) >= AEAD_MIN_SIZE and data[0] == AEAD_VERSION and aead_token_from_bytes(data) == value
+
+
+def aead_token_to_bytes(token: str) -> bytes:
+    """
+    Convert an AES-GCM token from text form to raw bytes
+    :param token: token in text form (see is_aead_token())
+    :return: raw token
+    """
+    return base64.urlsafe_b64decode(token)
+
+
+def aead_token_from_bytes(data: bytes) -> str:
+    """
+    Convert an AES-GCM token from raw bytes to text form
+    :param data: raw token
+    :return: token in text form
+    """
+    return base64.urlsafe_b64encode(data).decode()
+
 
 class Crypt:
 
-    def __init__(self, password: str):
+    def __init__(self, password: str, parameters: Optional[dict] = None):
         """
         Implement data encryption and decryption
         :param password:
+        :param parameters: key derivation parameters (see kdf.py, the legacy ones if not specified),
+                           with the cipher used for the sensitive values (see CIPHER_KEY)
+        :raise: ValueError if the parameters are not valid or the cipher is unknown
+        """
+        self.parameters = LEGACY_PARAMETERS if parameters is None else parameters
+        self.cipher = self.parameters.get(CIPHER_KEY, CIPHER_FERNET)
+        if self.cipher not in CIPHER_LIST:
+            raise ValueError(f'unknown cipher {self.cipher}')
+        key = self.generate_crypt_key(password, self.parameters)
+        self.key = Fernet(key)
+        # Separate key for AES-GCM, so the same key is never used by both ciphers
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=AEAD_KEY_INFO)
+        self.aead_key = hkdf.derive(base64.urlsafe_b64decode(key))
+        self.aead = AESGCM(self.aead_key)
+        # Sensitive values decrypted recently (see decrypt_value())
+        self.value_cache = ValueCache()
+
+    def __getstate__(self) -> dict:
+        """
+        Return the state to pickle, when the key is passed to other processes.
+        The AES-GCM cipher cannot be pickled, so it's rebuilt from its key,
+        and the decrypted values are not passed.
+        :return: state
         """
-        self.key = self.generate_crypt_key(password)
+        state = self.__dict__.copy()
+        del state['aead']
+        del state['value_cache']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.aead = AESGCM(self.aead_key)
+        self.value_cache = ValueCache()
 
     @staticmethod
-    def generate_crypt_key(password: str) -> Fernet:
+    def generate_crypt_key(password: str, parameters: dict = LEGACY_PARAMETERS) -> bytes:
         """
         Generate a Fernet key from a string password
-        The salt should be fixed to encrypt/decrypt consistently
+        The salt should be the same to encrypt/decrypt consistently, so the parameters are stored with the data.
+        The key is taken from the key agent if it was already derived during the session (see key_agent.py).
         :param password: password
+        :param parameters: key derivation parameters (see kdf.py)
         :return: key
+        :raise: ValueError if the parameters are not valid
         """
-        password_bytes = password.encode(CHARACTER_ENCODING)
-        salt = b'TDkmQ2TyV6HRw7pW'
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA512(),
-            length=32,
-            salt=salt,
-            iterations=480000,
-        )
-        return Fernet(base64.urlsafe_b64encode(kdf.derive(bytes(password_bytes))))
+        key = get_key(password, describe(parameters))
+        if key is None:
+            key = derive_key(password, parameters)
+            put_key(password, describe(parameters), key)
+        return key
 
     def encrypt_str2byte(self, data: str) -> bytes:
         """
@@ -44,12 +155,32 @@ class Crypt:
 
     def encrypt_str2str(self, data: str) -> str:
         """
-        Encrypt string data message into string
+        Encrypt string data message into string, with the cipher used for the sensitive values
         :param data: data to encrypt
         :return: encrypted message
         """
+        if self.cipher == CIPHER_AES_GCM:
+            nonce = os.urandom(AEAD_NONCE_SIZE)
+            ciphertext = self.aead.encrypt(nonce, data.encode(CHARACTER_ENCODING), None)
+            return aead_token_from_bytes(bytes([AEAD_VERSION]) + nonce + ciphertext)
         return self.key.encrypt(data.encode(CHARACTER_ENCODING)).decode(CHARACTER_ENCODING)
 
+    def encrypt_byte2byte(self, data: bytes) -> bytes:
+        """
+        Encrypt byte data message into bytes
+        :param data: data to encrypt
+        :return: encrypted message
+        """
+        return self.key.encrypt(data)
+
+    def decrypt_byte2byte(self, data: bytes) -> bytes:
+        """
+        Decrypt byte data message into bytes
+        :param data: data to decrypt
+        :return: decrypted data
+        """
+        return self.key.decrypt(data)
+
     def decrypt_byte2str(self, data: bytes) -> str:
         """
         Decrypt byte data message into string
@@ -60,12 +191,77 @@ class Crypt:
 
     def decrypt_str2str(self, data: str) -> str:
         """
-        Decrypt string data message into string
+        Decrypt string data message into string, with the cipher that encrypted it
         :param data: data to decrypt
         :return: decrypted data
+        :raise: InvalidToken if the message cannot be decrypted
         """
+        if data.startswith(AEAD_PREFIX):
+            try:
+                token = aead_token_to_bytes(data)
+                if len(token) < AEAD_MIN_SIZE or token[0] != AEAD_VERSION:
+                    raise InvalidToken
+                nonce = token[1:1 + AEAD_NONCE_SIZE]
+                return self.aead.decrypt(nonce, token[1 + AEAD_NONCE_SIZE:], None).decode(CHARACTER_ENCODING)
+            except (InvalidTag, ValueError):
+                raise InvalidToken
         return self.key.decrypt(data.encode(CHARACTER_ENCODING)).decode(CHARACTER_ENCODING)
 
+    def decrypt_value(self, uid: int, data: str) -> str:
+        """
+        Decrypt a sensitive field value, taking it from the cache of decrypted values
+        if it was decrypted recently (see value_cache.py)
+        :param uid: field uid
+        :param data: encrypted value
+        :return: decrypted value
+        :raise: InvalidToken if the value cannot be decrypted
+        """
+        key = (uid, data)
+        value = self.value_cache.get(key)
+        if value is None:
+            value = self.decrypt_str2str(data)
+            self.value_cache.put(key, value)
+        return value
+
+    def encrypt_many(self, data_list: Sequence[str], workers=DEFAULT_WORKERS) -> list[str]:
+        """
+        Encrypt many string messages into strings (see map())
+        :param data_list: data to encrypt
+        :param workers: maximum number of threads
+        :return: encrypted messages, in the same order
+        """
+        return self.map(self.encrypt_str2str, data_list, workers)
+
+    def decrypt_many(self, data_list: Sequence[str], workers=DEFAULT_WORKERS) -> list[str]:
+        """
+        Decrypt many string messages into strings (see map())
+        :param data_list: data to decrypt
+        :param workers: maximum number of threads
+        :return: decrypted data, in the same order
+        :raise: InvalidToken if any message cannot be decrypted
+        """
+        return self.map(self.decrypt_str2str, data_list, workers)
+
+    @staticmethod
+    def map(func: Callable[[str], str], data_list: Sequence[str], workers=DEFAULT_WORKERS) -> list[str]:
+        """
+        Apply an encryption or decryption function to many values, spread over a pool of threads.
+        OpenSSL releases the GIL while it encrypts, decrypts and authenticates, so the threads
+        run in parallel part of the time. Each thread gets a contiguous slice of the values,
+        and no threads are started for a few values.
+        :param func: function applied to each value
+        :param data_list: values
+        :param workers: maximum number of threads
+        :return: results, in the same order
+        """
+        workers = max(1, min(workers, len(data_list) // MIN_VALUES_PER_WORKER))
+        if workers == 1:
+            return [func(x) for x in data_list]
+        size = -(-len(data_list) // workers)
+        slices = [data_list[n:n + size] for n in range(0, len(data_list), size)]
+        with ThreadPoolExecutor(workers) as executor:
+            return [y for result in executor.map(lambda part: [func(x) for x in part], slices) for y in result]
+
     @staticmethod
     def dump(data: str | bytes):
         print(type(data), '[' + str(data) + ']')
@@ -86,3 +282,11 @@ if __name__ == '__main__':
     m_dec = c.decrypt_str2str(m_enc)
     c.dump(m_dec)
     assert m_in == m_dec
+
+    m_list = [f'{m_in} {n}' for n in range(1000)]
+    assert c.decrypt_many(c.encrypt_many(m_list)) == m_list
+
+    c = Crypt('test', dict(LEGACY_PARAMETERS, cipher=CIPHER_AES_GCM))
+    m_enc = c.encrypt_str2str(m_in)
+    c.dump(m_enc)
+    assert is_aead_token(m_enc) and c.decrypt_str2str(m_enc) == m_in
@@ -0,0 +1,307 @@
+"""
+Chunked encryption of the database file contents.
+
+The data is split into chunks of a fixed size that are encrypted independently, each one
+with its own Fernet token. Chunks can be decrypted as they are read, in parallel, and a
+corrupted chunk is reported by number without affecting the others.
+
+    header      magic (4 bytes), version (1 byte), chunk size (u32),
+                parameters length (u16) and key derivation parameters in json (version 2)
+    chunks      token length (u32) and token for each chunk
+
+The key derivation parameters are those of the key used to encrypt the data (see kdf.py),
+so the key can be derived from the password before reading anything else. They are not
+authenticated, but changing them only gives a key that fails to decrypt the chunks.
+Version 1 headers have no parameters.
+
+The tokens are stored in binary form (without the base64 encoding used by Fernet).
+Each chunk starts with its number (u32) and a flag (u8) set only in the last chunk,
+both authenticated with the data, so chunks that are reordered, duplicated or missing
+are detected. All integers are little endian.
+
+Data without the header is a single Fernet token (see Crypt.encrypt_byte2byte()).
+"""
+import io
+import os
+import json
+import base64
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Generator, Optional
+from crypt import Crypt
+from kdf import check_parameters
+
+# Header
+CHUNK_MAGIC = b'JDBE'
+CHUNK_VERSION = 2
+
+# Default number of bytes of data in each chunk
+DEFAULT_CHUNK_SIZE = 1 << 18
+
+# Default number of threads used to decrypt
+DEFAULT_WORKERS = min(os.cpu_count() or 1, 8)
+
+_HEADER = struct.Struct('<4sBI')
+_PARAMETERS_LENGTH = struct.Struct('<H')
+_LENGTH = struct.Struct('<I')
+_CHUNK_HEADER = struct.Struct('<IB')
+
+
+def is_chunked(data: bytes) -> bool:
+    """
+    Check whether the data was encrypted in chunks
+    :param data: encrypted data (or at least its first bytes)
+    :return: True if it was, False otherwise
+    """
+    return data[:len(CHUNK_MAGIC)] == CHUNK_MAGIC
+
+
+def encrypt_chunk(crypt: Crypt, n: int, data: bytes, last: bool) -> bytes:
+    """
+    Encrypt one chunk
+    :param crypt: encryption key
+    :param n: chunk number
+    :param data: chunk data
+    :param last: last chunk?
+    :return: token length and token
+    """
+    token = base64.urlsafe_b64decode(crypt.encrypt_byte2byte(_CHUNK_HEADER.pack(n, last) + data))
+    return _LENGTH.pack(len(token)) + token
+
+
+def decrypt_chunk(crypt: Crypt, n: int, token: bytes) -> tuple[bytes, bool]:
+    """
+    Decrypt one chunk and check its number
+    :param crypt: decryption key
+    :param n: expected chunk number
+    :param token: token
+    :return: chunk data and last chunk flag
+    :raise: ValueError if the chunk cannot be decrypted or is not the expected one
+    """
+    try:
+        data = crypt.decrypt_byte2byte(base64.urlsafe_b64encode(token))
+        number, last = _CHUNK_HEADER.unpack_from(data)
+    except Exception as e:
+        raise ValueError(f'failed to decrypt chunk {n}: {repr(e)}')
+    if number != n:
+        raise ValueError(f'failed to decrypt chunk {n}: found chunk {number} instead')
+    return data[_CHUNK_HEADER.size:], bool(last)
+
+
+def encode_header(crypt: Crypt, chunk_size: int) -> bytes:
+    """
+    Encode the header
+    :param crypt: encryption key
+    :param chunk_size: number of bytes of data in each chunk
+    :return: header
+    """
+    parameters = json.dumps(crypt.parameters).encode()
+    return _HEADER.pack(CHUNK_MAGIC, CHUNK_VERSION, chunk_size) + _PARAMETERS_LENGTH.pack(len(parameters)) + parameters
+
+
+def read_header(f_in: BinaryIO) -> tuple[int, Optional[dict]]:
+    """
+    Read the header
+    :param f_in: input stream, positioned at the header
+    :return: chunk size and key derivation parameters (None in version 1 headers)
+    :raise: ValueError if the header is not valid
+    """
+    data = f_in.read(_HEADER.size)
+    if len(data) < _HEADER.size or not is_chunked(data):
+        raise ValueError('data not encrypted in chunks')
+    _, version, chunk_size = _HEADER.unpack(data)
+    if version == 1:
+        return chunk_size, None
+    if version != CHUNK_VERSION:
+        raise ValueError(f'unsupported chunk version {version}')
+    try:
+        length = _PARAMETERS_LENGTH.unpack(f_in.read(_PARAMETERS_LENGTH.size))[0]
+        parameters = check_parameters(json.loads(f_in.read(length)))
+    except (struct.error, TypeError, ValueError) as e:
+        raise ValueError(f'bad chunk header: {repr(e)}')
+    return chunk_size, parameters
+
+
+def read_parameters(file_name: str) -> Optional[dict]:
+    """
+    Return the key derivation parameters in the header of a file encrypted in chunks
+    :param file_name: file name
+    :return: parameters (None if the file is not encrypted in chunks or has no parameters)
+    :raise: FileNotFoundError, ValueError if the header is not valid
+    """
+    with open(file_name, 'rb') as f_in:
+        if not is_chunked(f_in.read(len(CHUNK_MAGIC))):
+            return None
+        f_in.seek(0)
+        return read_header(f_in)[1]
+
+
+def next_token(f_in: BinaryIO) -> Generator[bytes, None, None]:
+    """
+    Iterate over the tokens that follow the header
+    :param f_in: input stream, positioned after the header
+    :return: next token
+    :raise: ValueError if the data is truncated
+    """
+    n = 0
+    while True:
+        data = f_in.read(_LENGTH.size)
+        if not data:
+            return
+        if len(data) < _LENGTH.size:
+            raise ValueError(f'failed to decrypt chunk {n}: truncated data')
+        length = _LENGTH.unpack(data)[0]
+        token = f_in.read(length)
+        if len(token) < length:
+            raise ValueError(f'failed to decrypt chunk {n}: truncated data')
+        yield token
+        n += 1
+
+
+def encrypt_chunks(crypt: Crypt, data: bytes, chunk_size=DEFAULT_CHUNK_SIZE) -> bytes:
+    """
+    Encrypt data in chunks
+    :param crypt: encryption key
+    :param data: data to encrypt
+    :param chunk_size: number of bytes of data in each chunk
+    :return: encrypted data
+    """
+    f_out = io.BytesIO()
+    writer = EncryptWriter(f_out, crypt, chunk_size)
+    writer.write(data)
+    writer.close()
+    return f_out.getvalue()
+
+
+def decrypt_chunks(crypt: Crypt, data: bytes, workers=DEFAULT_WORKERS) -> bytes:
+    """
+    Decrypt data encrypted in chunks. The chunks are decrypted in parallel.
+    :param crypt: decryption key
+    :param data: encrypted data
+    :param workers: number of threads
+    :return: decrypted data
+    :raise: ValueError if a chunk cannot be decrypted or chunks are missing
+    """
+    f_in = io.BytesIO(data)
+    read_header(f_in)
+    token_list = list(next_token(f_in))
+    with ThreadPoolExecutor(workers) as executor:
+        chunk_list = list(executor.map(decrypt_chunk, [crypt] * len(token_list), range(len(token_list)), token_list))
+    if not chunk_list or not chunk_list[-1][1] or any(last for _, last in chunk_list[:-1]):
+        raise ValueError('failed to decrypt data: missing chunks')
+    return b''.join([chunk for chunk, _ in chunk_list])
+
+
+class EncryptWriter:
+    """
+    Write data encrypted in chunks to a binary stream. The header is written first.
+    close() must be called to write the last chunk, but the underlying stream is left open.
+    """
+
+    def __init__(self, f_out: BinaryIO, crypt: Crypt, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param f_out: output stream
+        :param crypt: encryption key
+        :param chunk_size: number of bytes of data in each chunk
+        """
+        self.f_out = f_out
+        self.crypt = crypt
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.n = 0
+        self.f_out.write(encode_header(crypt, chunk_size))
+
+    def write(self, data: bytes):
+        self.buffer += data
+        # The last chunk is written by close(), even if it's empty
+        while len(self.buffer) > self.chunk_size:
+            self.f_out.write(encrypt_chunk(self.crypt, self.n, bytes(self.buffer[:self.chunk_size]), False))
+            del self.buffer[:self.chunk_size]
+            self.n += 1
+
+    def close(self):
+        self.f_out.write(encrypt_chunk(self.crypt, self.n, bytes(self.buffer), True))
+        self.buffer = bytearray()
+
+
+class DecryptReader(io.RawIOBase):
+    """
+    Read data encrypted in chunks from a binary stream. The next chunks are decrypted
+    in parallel while the current one is consumed.
+    Use io.BufferedReader() on top of it to get the usual read functions.
+    """
+
+    def __init__(self, f_in: BinaryIO, crypt: Crypt, workers=DEFAULT_WORKERS):
+        """
+        :param f_in: input stream, positioned at the header
+        :param crypt: decryption key
+        :param workers: number of threads
+        :raise: ValueError if the header is not valid
+        """
+        super().__init__()
+        self.f_in = f_in
+        self.crypt = crypt
+        read_header(f_in)
+        self.tokens = next_token(f_in)
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_pending = 2 * workers
+        self.pending = deque()
+        self.n = 0
+        self.last: Optional[bool] = None
+        self.buffer = b''
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def next_chunk(self) -> Optional[bytes]:
+        """
+        Return the next decrypted chunk, and submit the following ones for decryption
+        :return: chunk data (None after the last chunk)
+        :raise: ValueError if a chunk cannot be decrypted or chunks are missing
+        """
+        for token in self.tokens:
+            self.pending.append(self.executor.submit(decrypt_chunk, self.crypt, self.n, token))
+            self.n += 1
+            if len(self.pending) >= self.max_pending:
+                break
+        if not self.pending:
+            if not self.last:
+                raise ValueError('failed to decrypt data: missing chunks')
+            return None
+        if self.last:
+            raise ValueError('failed to decrypt data: data after the last chunk')
+        data, self.last = self.pending.popleft().result()
+        return data
+
+    def readinto(self, b) -> int:
+        """
+        Fill a buffer with decrypted data
+        :param b: buffer
+        :return: number of bytes read (zero at the end of the data)
+        :raise: ValueError if a chunk cannot be decrypted or chunks are missing
+        """
+        while self.pos == len(self.buffer):
+            data = self.next_chunk()
+            if data is None:
+                return 0
+            self.buffer, self.pos = data, 0
+        n = min(len(b), len(self.buffer) - self.pos)
+        b[:n] = self.buffer[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.f_in.close()
+        super().close()
+
+
+if __name__ == '__main__':
+    c = Crypt('test')
+    text = b'some text that will be encrypted ' * 1000
+    encrypted = encrypt_chunks(c, text, chunk_size=1000)
+    print(len(text), len(encrypted), is_chunked(encrypted), decrypt_chunks(c, encrypted) == text)
+    r = io.BufferedReader(DecryptReader(io.BytesIO(encrypted), c))
+    print(r.read() == text)
@@ -1,53 +1,110 @@
-import os
 import re
-import json
-from typing import Optional
-from os.path import exists
-from items import ItemCollection, FieldCollection, Item, Field
+import threading
+from typing import Optional, Generator
+from items import ItemCollection, LazyFieldCollection, Item
 from common import KEY_NAME, KEY_UID
-from common import FIELD_NAME_KEY, FIELD_VALUE_KEY, FIELD_SENSITIVE_KEY
-from common import ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_FIELDS_KEY
+from common import FIELD_NAME_KEY, FIELD_SENSITIVE_KEY
+from common import ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_FIELDS_KEY, ITEM_UID_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, DB_HASH_KEY, DB_COUNTS_KEY
+from common import DB_DIGESTS_KEY
+from common import COUNTS_GENERATION_KEY, COUNTS_TAGS_KEY, COUNTS_FIELDS_KEY, COUNTS_ITEMS_KEY, COUNTS_ITEM_FIELDS_KEY
+from common import FORMAT_JSON
 from common import DEFAULT_DATABASE_NAME
 from tables import TagTable, FieldTable
-from utils import get_string_timestamp
-from crypt import Crypt
+from uid import TagTableUid, FieldTableUid, ItemUid, clear_all
+from crypt import Crypt, CHARACTER_ENCODING, CIPHER_KEY
+from kdf import new_parameters
+from journal import Journal, journal_file_name, make_record, renumber_record, OP_ITEM_PUT, OP_ITEM_DELETE
+from json_stream import encode_object
+from digest import DEFAULT_WORKERS, content_digest, item_digests, item_digest, decode_digests, verify_items
+from merge import merge_entries, duplicate_names
+from backup import RetentionPolicy
+from compression import CODEC_NONE
+from durable import DEFAULT_DURABILITY, GroupCommit
+from file_lock import DEFAULT_LOCK_TIMEOUT, FileLock
+from storage import StorageEngine, ENGINE_FILE, ENGINE_SQLITE, ENGINE_SHARD
+from file_engine import FileEngine
+from sqlite_engine import SqliteEngine
+from shard_engine import ShardEngine
 
-# The database is stored on disk as a json dictionary with three keys
-DB_TAGS_KEY = 'tags'
-DB_FIELDS_KEY = 'fields'
-DB_ITEMS_KEY = 'items'
-
-# Temporary file used when saving data
-TEMP_FILE = 'db.tmp'
+# Available storage engines
+ENGINES = {ENGINE_FILE: FileEngine, ENGINE_SQLITE: SqliteEngine, ENGINE_SHARD: ShardEngine}
 
 
 class Database:
 
-    def __init__(self, file_name, password=''):
+    def __init__(self, file_name, password='', journal=False, file_format: Optional[str] = None,
+                 codec: Optional[str] = None, level: Optional[int] = None, durability=DEFAULT_DURABILITY,
+                 engine=ENGINE_FILE, read_only=False, lock_timeout: Optional[float] = DEFAULT_LOCK_TIMEOUT,
+                 kdf: Optional[dict] = None, cipher: Optional[str] = None):
         """
         :param file_name: database file name
         :param password: password for data encryption (optional)
+        :param journal: append changes to the journal instead of rewriting the file?
+        :param file_format: file format (json or binary). Taken from the file when reading if not specified.
+        :param codec: compression codec (see compression.py). Taken from the file when reading if not specified.
+        :param level: compression level (codec default if not specified)
+        :param durability: what is flushed to disk when writing (see durable.py)
+        :param engine: storage engine name (see ENGINES)
+        :param read_only: open the database for reading only?
+        :param lock_timeout: time to wait for other processes using the database (see file_lock.py)
+        :param kdf: key derivation parameters of a new database (see kdf.py). The stored ones are used
+                    for an existing database. New parameters with the default cost if not specified.
+        :param cipher: cipher used for the sensitive values of a new database (see crypt.py), stored with
+                       the key derivation parameters. The stored one is used for an existing database.
+        :raise: ValueError if the storage engine or the cipher is unknown, or the stored key derivation
+                parameters are not valid
         """
+        if engine not in ENGINES:
+            raise ValueError(f'unknown storage engine {engine}')
         self.file_name = file_name
         self.tag_table = TagTable()
         self.field_table = FieldTable()
         self.item_collection = ItemCollection()
-        # The database will be encrypted if a password is supplied
-        self.crypt_key = Crypt(password) if password else None
-
-    def read_mode(self) -> str:
-        """
-        Return the file write mode depending on whether encryption is enabled
-        :return: write mode
-        """
-        return 'r' if self.crypt_key is None else 'rb'
-
-    def write_mode(self) -> str:
-        """
-        Return the file write mode depending on whether encryption is enabled
-        :return: write mode
-        """
-        return 'w' if self.crypt_key is None else 'wb'
+        # Mutations done since the last read or write
+        self.pending_records = []
+        # Serializes writes and journal compaction
+        self.lock = threading.RLock()
+        self.file_format = file_format
+        self.codec = codec
+        self.level = level
+        # Hash of the contents of the file as it was last read or written
+        self.content_hash: Optional[str] = None
+        # Hash of each item that didn't change since it was read or written (see item_digests())
+        self.digest_cache: dict[int, bytes] = {}
+        # Hash of each item changed since the last read or write, as it was then (None for new items),
+        # and the tables as they were then. Used to merge with the changes of other processes (see merge()).
+        self.base_digests: dict[int, Optional[bytes]] = {}
+        self.base_tables: tuple[list, list] = ([], [])
+        # Backups to keep when the file is written (all of them if None)
+        self.retention: Optional[RetentionPolicy] = RetentionPolicy()
+        self.durability = durability
+        # Read-only databases are never written, so the uid read are not registered
+        self.read_only = read_only
+        # Count the items when reading, even if the counters were stored with the contents
+        self.recount = False
+        # Were the items created on first access when last read? Used to read again (see refresh()).
+        self.lazy = False
+        # Other processes are kept from writing while the database is read or written
+        self.file_lock = FileLock(file_name, lock_timeout)
+        # Signature of the stored version last read or written (see changed())
+        self.signature = None
+        # Saves of the current contents requested by several threads at once are coalesced
+        self.group_commit = GroupCommit(self.commit)
+        # Where the contents are stored
+        self.engine: StorageEngine = ENGINES[engine](self)
+        # The database will be encrypted if a password is supplied, with a key derived as it was when stored
+        self.crypt_key = None
+        if password:
+            parameters = self.engine.kdf_parameters()
+            if parameters is None:
+                parameters = dict(kdf or new_parameters())
+                if cipher is not None:
+                    parameters[CIPHER_KEY] = cipher
+            self.crypt_key = Crypt(password, parameters)
+        # The journal is always replayed when reading, but only written when journaling is enabled
+        self.journal = Journal(journal_file_name(file_name), self.crypt_key, durability=durability)
+        self.journal_enabled = journal
 
     def clear(self):
         """
@@ -57,97 +114,495 @@ class Database:
         self.tag_table = TagTable()
         self.field_table = FieldTable()
         self.item_collection = ItemCollection()
+        self.digest_cache = {}
+        self.base_digests = {}
 
-    def update_tables(self, item: Item):
+    def update_tables(self, item: Item, n=1):
         """
         Increment the counters in the tag and field tables with the item contents
         :param item: item
+        :param n: counter increment (-1 to remove the item from the counters)
         """
         for t_uid in item.get_tags():
-            self.tag_table.increment(uid=t_uid)
-        for field in item.next_field():
-            self.field_table.increment(name=field.get_name())
+            self.tag_table.increment(uid=t_uid, n=n)
+        for name in item.get_field_names():
+            self.field_table.increment(name=name, n=n)
 
-    def read(self):
+    def count_items(self):
         """
-        Read the database file from disk
-        :raise FileNotFoundError, ValueError
+        Compute the counters in the tag and field tables from all the items in the collection
         """
-        with open(self.file_name, self.read_mode()) as f_in:
-            data = f_in.read()
-            if self.crypt_key is not None:
-                assert isinstance(data, bytes)
-                try:
-                    data = self.crypt_key.decrypt_byte2str(data)
-                except Exception as e:
-                    raise ValueError(f'failed to decrypt data: {repr(e)}')
-            try:
-                json_data = json.loads(data)
-            except Exception as e:
-                raise ValueError(f'failed to read the data: {repr(e)}')
-
-            # Read the tag table
-            try:
-                for tag in json_data[DB_TAGS_KEY]:
-                    self.tag_table.add(tag[KEY_NAME], tag[KEY_UID])
-            except Exception as e:
-                self.clear()
-                raise ValueError(f'failed to read tag table: {repr(e)}')
-
-            # Read the field table
-            try:
-                for field in json_data[DB_FIELDS_KEY]:
-                    self.field_table.add(field[FIELD_NAME_KEY], field[FIELD_SENSITIVE_KEY], field[KEY_UID])
-            except Exception as e:
-                self.clear()
-                raise ValueError(f'failed to read field table: {repr(e)}')
-
-            # Read the items
-            try:
-                for item_uid in json_data[DB_ITEMS_KEY]:
-                    json_item = json_data[DB_ITEMS_KEY][item_uid]
-                    # print(json_item)
-                    fc = FieldCollection()
-                    for field_uid in json_item[ITEM_FIELDS_KEY]:
-                        field = json_item[ITEM_FIELDS_KEY][field_uid]
-                        fc.add(Field(field[FIELD_NAME_KEY], field[FIELD_VALUE_KEY], field[FIELD_SENSITIVE_KEY]))
-                    item = Item(json_item[ITEM_NAME_KEY], json_item[ITEM_TAG_LIST_KEY],
-                                json_item[ITEM_NOTE_KEY], fc,
-                                time_stamp=json_item[ITEM_TIMESTAMP_KEY])
-                    self.item_collection.add(item)
+        for item in self.item_collection.data.values():
+            self.update_tables(item)
+
+    def counts(self, generation: str) -> dict:
+        """
+        Return the table counters and the item and field totals, to be stored with the contents
+        written as a given generation, so they can be set when reading instead of counting again
+        (see apply_counts()). They are computed from the items, since the commands that change
+        the items don't update the counters in the tables.
+        :param generation: generation of the contents
+        :return: counter dictionary
+        """
+        tag_count = {x[KEY_UID]: 0 for x in self.tag_table.export()}
+        field_uid = {x[KEY_NAME]: x[KEY_UID] for x in self.field_table.export()}
+        field_count = {x: 0 for x in field_uid.values()}
+        for key in self.item_collection.keys():
+            item = self.item_collection.get(key)
+            for uid in item.get_tags():
+                if uid in tag_count:
+                    tag_count[uid] += 1
+            for name in item.get_field_names():
+                if name in field_uid:
+                    field_count[field_uid[name]] += 1
+        return {COUNTS_GENERATION_KEY: generation,
+                COUNTS_TAGS_KEY: {str(uid): n for uid, n in tag_count.items()},
+                COUNTS_FIELDS_KEY: {str(uid): n for uid, n in field_count.items()},
+                COUNTS_ITEMS_KEY: len(self.item_collection),
+                COUNTS_ITEM_FIELDS_KEY: sum(field_count.values())}
+
+    def apply_counts(self, counts: Optional[dict], generation: Optional[str]) -> bool:
+        """
+        Set the table counters from the counters stored with the contents (see counts()).
+        They are only used if they were written with the same generation as the contents,
+        for the same number of items, and for exactly the tags and fields in the tables.
+        Nothing is set if the items must be counted again (see recount).
+        :param counts: stored counters (None if not stored)
+        :param generation: generation of the contents read
+        :return: True if the counters were set, False if the items must be counted instead
+        """
+        if self.recount or not counts or generation is None or counts.get(COUNTS_GENERATION_KEY) != generation:
+            return False
+        try:
+            tag_count = {int(uid): n for uid, n in counts[COUNTS_TAGS_KEY].items()}
+            field_count = {int(uid): n for uid, n in counts[COUNTS_FIELDS_KEY].items()}
+            if counts[COUNTS_ITEMS_KEY] != len(self.item_collection) \
+                    or set(tag_count) != {x[KEY_UID] for x in self.tag_table.export()} \
+                    or set(field_count) != {x[KEY_UID] for x in self.field_table.export()} \
+                    or sum(field_count.values()) != counts[COUNTS_ITEM_FIELDS_KEY]:
+                return False
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return False
+        for uid, n in tag_count.items():
+            self.tag_table.increment(uid=uid, n=n)
+        for uid, n in field_count.items():
+            self.field_table.increment(uid=uid, n=n)
+        return True
+
+    def add_item_uid(self, uid: int):
+        """
+        Register the uid of an item read from storage, so new items get a different one.
+        Nothing is registered in read-only mode, since no item can be created.
+        :param uid: item uid
+        :raise: ValueError if the uid is already in use
+        """
+        if not self.read_only:
+            ItemUid.add_uid(uid)
+
+    def check_writable(self):
+        """
+        Check that the database can be written
+        :raise: ValueError if it's read-only
+        """
+        if self.read_only:
+            raise ValueError(f'database {self.file_name} is read-only')
+
+    def changed(self) -> bool:
+        """
+        Check whether the stored database changed since it was last read or written by this
+        database, e.g. because another process wrote it. Nothing is read to find out.
+        A database that was never read or written replaces whatever is stored.
+        :return: True if it did, False otherwise
+        """
+        return self.signature is not None and self.engine.signature() != self.signature
+
+    def set_base(self):
+        """
+        Take the contents just read or written as the base of the next merge (see merge()).
+        The hash of every item is kept, so the version of each item changed afterwards is known.
+        Nothing is kept in read-only mode, since the database is never written.
+        """
+        if not self.read_only:
+            self.digest_cache = self.item_digests()
+            self.base_digests = {}
+            self.base_tables = (self.tag_table.export(), self.field_table.export())
+
+    def record(self, op: str, data: dict):
+        """
+        Record a mutation. Pending mutations are appended to the journal by write().
+        :param op: operation (see journal.py)
+        :param data: operation data
+        """
+        self.pending_records.append(make_record(op, data))
+        if op in [OP_ITEM_PUT, OP_ITEM_DELETE]:
+            uid = int(data[ITEM_UID_KEY])
+            self.base_digests.setdefault(uid, self.digest_cache.pop(uid, None))
+
+    @staticmethod
+    def item_from_dict(json_item: dict, uid: int) -> Item:
+        """
+        Build an item from its dictionary representation. The fields are created
+        the first time they are accessed (see LazyFieldCollection).
+        :param json_item: item dictionary, as returned by Item.export()
+        :param uid: item unique identifier
+        :return: item
+        """
+        return Item(json_item[ITEM_NAME_KEY], json_item[ITEM_TAG_LIST_KEY],
+                    json_item[ITEM_NOTE_KEY], LazyFieldCollection(json_item[ITEM_FIELDS_KEY]),
+                    time_stamp=json_item[ITEM_TIMESTAMP_KEY], uid=uid)
+
+    def apply_item_records(self, item_records: dict, count=True):
+        """
+        Apply the item changes returned by split_journal() to the item collection
+        :param item_records: item changes
+        :param count: update the table counters?
+        """
+        for uid, json_item in item_records.items():
+            self.digest_cache.pop(uid, None)
+            if uid in self.item_collection:
+                if count:
+                    self.update_tables(self.item_collection.get(uid), n=-1)
+                self.item_collection.remove(uid)
+            if json_item is not None:
+                item = self.item_from_dict(json_item, uid)
+                if not self.read_only and uid not in ItemUid.uid_list:
+                    ItemUid.add_uid(uid)
+                self.item_collection.add(item)
+                if count:
                     self.update_tables(item)
-            except Exception as e:
-                self.clear()
-                raise ValueError(f'failed to read items: {repr(e)}')
 
-        f_in.close()
+    def read_tables(self, tag_list: list, field_list: list, register=True):
+        """
+        Fill the tag and field tables
+        :param tag_list: tag table, in the same format returned by Table.export()
+        :param field_list: field table, in the same format returned by Table.export()
+        :param register: register the uid? (never in read-only mode)
+        :raise ValueError
+        """
+        register = register and not self.read_only
+        # Read the tag table
+        try:
+            for tag in tag_list:
+                self.tag_table.add(tag[KEY_NAME], tag[KEY_UID], register=register)
+        except Exception as e:
+            self.clear()
+            raise ValueError(f'failed to read tag table: {repr(e)}')
+
+        # Read the field table
+        try:
+            for field in field_list:
+                self.field_table.add(field[FIELD_NAME_KEY], field[FIELD_SENSITIVE_KEY], field[KEY_UID],
+                                     register=register)
+        except Exception as e:
+            self.clear()
+            raise ValueError(f'failed to read field table: {repr(e)}')
+
+    def item_digests(self, json_data: Optional[dict] = None) -> dict[int, bytes]:
+        """
+        Return the hash of each item (see digest.py). For the current contents, the hashes
+        of the items that didn't change since they were read or written are reused.
+        :param json_data: database dictionary (current contents if not specified)
+        :return: hash of each item, by uid
+        """
+        if json_data is not None:
+            return item_digests(json_data[DB_ITEMS_KEY].items())
+        collection = self.item_collection
+        digests = {uid: self.digest_cache[uid] for uid in collection.keys() if uid in self.digest_cache}
+        digests.update(item_digests((uid, collection.get(uid).export()) for uid in collection.keys()
+                                    if uid not in digests))
+        return digests
+
+    def digest(self, json_data: Optional[dict] = None, digests: Optional[dict[int, bytes]] = None) -> str:
+        """
+        Return the hash of the database contents (see digest.py). The file format and the
+        compression settings are included, so changing them makes the file different.
+        :param json_data: database dictionary (current contents if not specified)
+        :param digests: hash of each item, if already known (see item_digests())
+        :return: hash
+        """
+        settings = f'{self.file_format or FORMAT_JSON} {self.codec or CODEC_NONE} {self.level}'
+        digests = self.item_digests(json_data) if digests is None else digests
+        if json_data is None:
+            return content_digest(settings, self.tag_table.export(), self.field_table.export(), digests)
+        return content_digest(settings, json_data[DB_TAGS_KEY], json_data[DB_FIELDS_KEY], digests)
+
+    def read(self, lazy=False, stream=True):
+        """
+        Read the database from storage (see StorageEngine.read())
+        :param lazy: create the items on first access?
+        :param stream: read the contents incrementally?
+        :raise FileNotFoundError, ValueError
+        """
+        self.lazy = lazy
+        with self.file_lock.shared():
+            self.engine.read(lazy=lazy, stream=stream)
+            self.signature = self.engine.signature()
+        self.set_base()
+
+    def refresh(self, lazy: Optional[bool] = None) -> bool:
+        """
+        Read the database again if the stored version changed since it was last read or written.
+        The uid registered by the previous read are released (see uid.clear_all()).
+        If the read fails, the database is left empty.
+        :param lazy: create the items on first access? (as in the last read if not specified)
+        :return: True if the database was read again, False if it didn't change
+        :raise FileNotFoundError, ValueError (also if there are changes that were not written)
+        """
+        with self.lock:
+            if not self.changed():
+                return False
+            if self.pending_records:
+                raise ValueError(f'database {self.file_name} has changes that were not written')
+            if not self.read_only:
+                clear_all()
+            self.clear()
+            self.read(lazy=self.lazy if lazy is None else lazy)
+            return True
+
+    def load(self) -> dict:
+        """
+        Return the dictionary representation of the stored database. The tables and
+        the item collection are not modified.
+        :return: database dictionary
+        :raise FileNotFoundError, ValueError
+        """
+        with self.file_lock.shared():
+            return self.engine.load()
+
+    def verify(self, workers=DEFAULT_WORKERS) -> tuple[Optional[bool], list[int], list[int]]:
+        """
+        Check the stored database against the hashes stored with it. Each item is compared with
+        its own hash (see digest.verify_items()), so the items that don't match can be reported
+        without decoding anything else. The contents as a whole are compared with the content
+        hash, which also covers the tables.
+        :param workers: maximum number of processes used to check the items
+        :return: whether the contents match the content hash (None if it doesn't apply),
+                 uid of the items that don't match their hash and uid of the items without a hash
+        :raise FileNotFoundError, ValueError
+        """
+        json_data = self.load()
+        stored = json_data.get(DB_DIGESTS_KEY) or {}
+        corrupted, missing = verify_items(json_data[DB_ITEMS_KEY], stored, workers)
+        # The content hash doesn't cover the changes in the journal
+        if json_data.get(DB_HASH_KEY) is None or self.journal.is_current():
+            return None, corrupted, missing
+        items = json_data[DB_ITEMS_KEY]
+        digests = {uid: digest for uid, digest in decode_digests(stored).items() if str(uid) in items}
+        digests.update({uid: item_digest(items[str(uid)]) for uid in corrupted + missing})
+        return self.digest(json_data, digests) == json_data[DB_HASH_KEY], corrupted, missing
 
-    def write(self):
+    def merge(self):
         """
-        Write the database file to disk
+        Merge the changes made since the last read or write with the stored version, written by
+        another process in the meantime (see merge.py). The items, tags and fields changed only
+        on the other side are taken from the stored version. Those added on both sides with the
+        same uid are kept, and the ones added on this side get a new uid. Nothing is modified
+        if there are conflicts. The caller must hold the database locks.
+        :raise: ValueError if the same item, tag or field was changed on both sides in different ways,
+                or an item uses a tag or field removed on the other side
         """
-        # Convert the database into json and encrypt if an encryption key is defined
-        json_data = json.dumps(self.export())
-        data = json_data if self.crypt_key is None else self.crypt_key.encrypt_str2byte(json_data)
+        json_data = self.engine.load()
+        their_items = {int(uid): json_item for uid, json_item in json_data[DB_ITEMS_KEY].items()}
+        stored = decode_digests(json_data.get(DB_DIGESTS_KEY))
+        theirs = {uid: stored[uid] if uid in stored else item_digest(json_item)
+                  for uid, json_item in their_items.items()}
+        ours = self.item_digests()
+        base = {uid: digest for uid, digest in {**ours, **self.base_digests}.items() if digest is not None}
+        changes, added, conflicts = merge_entries(base, ours, theirs)
+        changes = {uid: their_items.get(uid) for uid in changes}
+        conflicts = [f'item {uid}' for uid in conflicts]
 
-        # Write the data to a temporary file first
-        with open(TEMP_FILE, self.write_mode()) as f_out:
-            f_out.write(data)
-        f_out.close()
+        # Tables, by uid
+        tables = []
+        for name, table, their_list, base_list in [
+                ('tag', self.tag_table, json_data[DB_TAGS_KEY], self.base_tables[0]),
+                ('field', self.field_table, json_data[DB_FIELDS_KEY], self.base_tables[1])]:
+            our_entries = {x[KEY_UID]: x for x in table.export()}
+            their_entries = {x[KEY_UID]: x for x in their_list}
+            table_changes, table_added, table_conflicts = merge_entries({x[KEY_UID]: x for x in base_list},
+                                                                        our_entries, their_entries)
+            merged = {**our_entries, **{uid: their_entries[uid] for uid in table_added}}
+            for uid, entry in table_changes.items():
+                if entry is None:
+                    merged.pop(uid, None)
+                else:
+                    merged[uid] = entry
+            added_entries = [our_entries[uid] for uid in table_added]
+            table_conflicts += duplicate_names(list(merged.values()) + added_entries, KEY_NAME)
+            conflicts += [f'{name} {x}' for x in table_conflicts]
+            tables.append((merged, added_entries, bool(table_changes or table_added)))
+        (tags, added_tags, tags_changed), (fields, added_fields, fields_changed) = tables
 
-        # Rename files. The old file is renamed using a time stamp.
-        if exists(self.file_name):
-            os.rename(self.file_name, self.file_name + '-' + get_string_timestamp())
-        os.rename(TEMP_FILE, self.file_name)
+        # The items kept from this side and the items taken from the other side
+        # must only use the tags and fields that are left
+        field_names = {x[FIELD_NAME_KEY] for x in list(fields.values()) + added_fields}
+        kept = [self.item_collection.get(uid) for uid in self.base_digests
+                if uid in self.item_collection and uid not in changes]
+        used = [(item.get_id(), item.get_tags(), item.get_field_names()) for item in kept]
+        used += [(uid, their_items[uid][ITEM_TAG_LIST_KEY],
+                  [x[FIELD_NAME_KEY] for x in their_items[uid][ITEM_FIELDS_KEY].values()])
+                 for uid in list(changes) + added if uid in their_items]
+        for uid, tag_list, name_list in used:
+            if any(x not in tags for x in tag_list) or any(x not in field_names for x in name_list):
+                conflicts.append(f'item {uid} (removed tag or field)')
+        if conflicts:
+            raise ValueError(f'failed to merge the changes of another process: {", ".join(conflicts)}')
+
+        # What was added on both sides gets a new uid on this side, past the uid used on the other side.
+        # The items changed on this side use the new tag uid.
+        TagTableUid.reset(max([TagTableUid.uid_next] + [x + 1 for x in tags]))
+        FieldTableUid.reset(max([FieldTableUid.uid_next] + [x + 1 for x in fields]))
+        ItemUid.reset(max([ItemUid.uid_next] + [x + 1 for x in their_items]))
+        tag_map, field_map, item_map = {}, {}, {}
+        for entry in added_tags:
+            tag_map[entry[KEY_UID]] = TagTableUid.get_uid()
+            tags[tag_map[entry[KEY_UID]]] = {**entry, KEY_UID: tag_map[entry[KEY_UID]]}
+        for entry in added_fields:
+            field_map[entry[KEY_UID]] = FieldTableUid.get_uid()
+            fields[field_map[entry[KEY_UID]]] = {**entry, KEY_UID: field_map[entry[KEY_UID]]}
+        for item in kept:
+            item.tags = [tag_map.get(x, x) for x in item.get_tags()]
+        for uid in added:
+            item = self.item_from_dict(self.item_collection.get(uid).export(), ItemUid.get_uid())
+            self.item_collection.remove(uid)
+            self.item_collection.add(item)
+            item_map[uid] = item.get_id()
+            self.base_digests[item.get_id()] = self.base_digests.pop(uid)
+            changes[uid] = their_items[uid]
+        # The changes not written yet must refer to the new uid, in case they are appended to the journal
+        self.pending_records = [renumber_record(x, tag_map, field_map, item_map) for x in self.pending_records]
+
+        # The counters are computed again if the tables changed on the other side
+        if tags_changed or fields_changed:
+            self.tag_table, self.field_table = TagTable(), FieldTable()
+            self.read_tables(list(tags.values()), list(fields.values()), register=False)
+            self.apply_item_records(changes, count=False)
+            counts = self.counts('')
+            for uid, n in counts[COUNTS_TAGS_KEY].items():
+                self.tag_table.increment(uid=int(uid), n=n)
+            for uid, n in counts[COUNTS_FIELDS_KEY].items():
+                self.field_table.increment(uid=int(uid), n=n)
+        else:
+            self.apply_item_records(changes)
+        self.digest_cache.update({uid: theirs[uid] for uid, json_item in changes.items() if json_item is not None})
+        # The merged contents are different from any version stored so far
+        self.content_hash = None
+
+    def save(self, json_data: Optional[dict] = None, force=False) -> bool:
+        """
+        Store the dictionary representation of a database as a new version (see StorageEngine.save()).
+        When no dictionary is supplied, the current database contents are stored.
+        Saves of the current contents requested while another one is running are served
+        by a single save (see durable.GroupCommit), so the lock must not be held by the caller.
+        Nothing is stored if the contents are the same, unless forced.
+        :param json_data: database dictionary (optional)
+        :param force: store the contents even if they didn't change?
+        :return: True if anything was stored, False otherwise
+        :raise: ValueError if the database is read-only, or the current contents are stored
+                and they can't be merged with the changes of another process (see merge())
+        """
+        self.check_writable()
+        if json_data is None and not force:
+            return self.group_commit()
+        return self.commit(json_data, force)
+
+    def commit(self, json_data: Optional[dict] = None, force=False) -> bool:
+        """
+        Store a new version right away (see save()). The current contents are merged first
+        with the stored version if another process wrote it since it was read (see merge()).
+        :param json_data: database dictionary (optional)
+        :param force: store the contents even if they didn't change?
+        :return: True if anything was stored, False otherwise
+        """
+        with self.file_lock.exclusive(), self.lock:
+            current = not self.changed()
+            if json_data is None and not current:
+                self.merge()
+                current = True
+            saved = self.engine.save(json_data, force)
+            # The contents in memory are still those of the stored version if they were before
+            if current:
+                self.signature = self.engine.signature()
+                if json_data is None:
+                    self.set_base()
+            return saved
+
+    def write(self, snapshot=False) -> bool:
+        """
+        Store the changes made since the last read or write (see StorageEngine.write()).
+        A complete new version is stored if another process wrote the database since it was read,
+        with the changes of both processes merged (see merge()).
+        :param snapshot: store a complete new version instead?
+        :return: True if anything was stored, False otherwise
+        :raise: ValueError if the database is read-only, or the changes can't be merged
+        """
+        self.check_writable()
+        with self.file_lock.exclusive():
+            with self.lock:
+                if not self.changed():
+                    written = self.engine.write(snapshot)
+                    if written is not None:
+                        self.signature = self.engine.signature()
+                        self.set_base()
+                        return written
+            # The lock is released first, so full writes from several threads can be coalesced
+            return self.save()
+
+    def list_backups(self) -> list[tuple[str, str]]:
+        """
+        Return the backups of previous versions
+        :return: time stamp and description of each backup, most recent first
+        """
+        return self.engine.list_backups()
+
+    def rebuild(self, time_stamp: str) -> dict:
+        """
+        Rebuild the version of the database in a backup
+        :param time_stamp: backup time stamp
+        :return: database dictionary
+        :raise ValueError
+        """
+        return self.engine.rebuild(time_stamp)
+
+    def restore(self, time_stamp: str):
+        """
+        Store the version of the database in a backup as a new version.
+        The version that is replaced gets its own backup, so the restore can be undone.
+        The database in memory is not modified and should be read again.
+        :param time_stamp: backup time stamp
+        :raise ValueError
+        """
+        with self.file_lock.exclusive(), self.lock:
+            self.save(self.rebuild(time_stamp), force=True)
+
+    def json_chunks(self, generation: Optional[str] = None, content_hash: Optional[str] = None,
+                    crypt: Optional[Crypt] = None, counts: Optional[dict] = None,
+                    digests: Optional[dict] = None) -> Generator[str, None, None]:
+        """
+        Encode the database in json one item at a time. The result is the same
+        as encoding the dictionary returned by export().
+        :param generation: file generation (optional)
+        :param content_hash: hash of the contents (optional)
+        :param crypt: decryption key (see export())
+        :param counts: table counters (optional, see counts())
+        :param digests: stored item hashes (optional, see digest.encode_digests())
+        :return: next chunk of json text
+        """
+        members = [] if generation is None else [(DB_GENERATION_KEY, generation)]
+        members += [] if content_hash is None else [(DB_HASH_KEY, content_hash)]
+        members += [] if counts is None else [(DB_COUNTS_KEY, counts)]
+        members += [] if digests is None else [(DB_DIGESTS_KEY, digests)]
+        members += [(DB_TAGS_KEY, self.tag_table.export()),
+                    (DB_FIELDS_KEY, self.field_table.export()),
+                    (DB_ITEMS_KEY, self.item_collection.next_export(crypt=crypt))]
+        return encode_object(members)
 
     def export_to_json(self, file_name: str):
         """
-        Export the database as json into a file
+        Export the database as json into a file, one item at a time
         """
-        d = self.export(crypt=self.crypt_key)
-        json_data = json.dumps(d)
-        with open(file_name, 'w') as f:
-            f.write(json_data)
+        with open(file_name, 'w', encoding=CHARACTER_ENCODING) as f:
+            f.writelines(self.json_chunks(crypt=self.crypt_key))
             f.close()
 
     def search(self, pattern: str, item_name_flag=True, tag_flag=False,
@@ -161,17 +616,27 @@ class Database:
         :param note_flag: search in note?
         :return: list of items matching the search criteria
         """
+        # The stored contents are only searched by the engine when there are no unsaved changes
+        if not self.pending_records:
+            uid_list = self.engine.search(pattern, item_name_flag, tag_flag, field_name_flag, field_value_flag,
+                                          note_flag)
+            if uid_list is not None:
+                return [self.item_collection.get(uid) for uid in uid_list]
+
         output_list = []
         compiled_pattern = re.compile(pattern, flags=re.IGNORECASE)
         for item in self.item_collection.next():
             assert isinstance(item, Item)
             if item_name_flag and compiled_pattern.search(item.name):
                 output_list.append(item)
-            if field_name_flag or field_value_flag:
-                for field in item.next_field():
-                    if field_name_flag and compiled_pattern.search(field.name):
+            # Field names are available without creating the fields
+            if field_name_flag:
+                for name in item.get_field_names():
+                    if compiled_pattern.search(name):
                         output_list.append(item)
-                    if field_value_flag and compiled_pattern.search(field.value):
+            if field_value_flag:
+                for field in item.next_field():
+                    if compiled_pattern.search(field.value):
                         output_list.append(item)
             if tag_flag:
                 try:
@@ -0,0 +1,117 @@
+"""
+Content hash of a database.
+
+The hash covers the tables and the items, but not the generation or anything else that
+changes every time the file is written. The field uid are not included either, since
+they are assigned again every time a database is read. The items are hashed individually
+and then combined in uid order, so the result doesn't depend on the order of the items.
+
+The item hashes are stored with the database as well, so each item can be checked on its
+own (see verify_items()) and the hashes of the items that didn't change can be reused when
+the database is written again.
+"""
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Optional
+from common import FIELD_UID_KEY, ITEM_FIELDS_KEY
+
+# Number of processes used to check the items
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+# Minimum number of items checked by each process
+MIN_ITEMS_PER_WORKER = 1000
+
+
+def item_digest(json_item: dict) -> bytes:
+    """
+    Return the hash of an item
+    :param json_item: item dictionary, as returned by Item.export()
+    :return: hash
+    """
+    fields = [{k: v for k, v in field.items() if k != FIELD_UID_KEY} for field in json_item[ITEM_FIELDS_KEY].values()]
+    data = {k: v for k, v in json_item.items() if k != ITEM_FIELDS_KEY}
+    return hashlib.sha256(json.dumps([data, fields], sort_keys=True).encode()).digest()
+
+
+def item_digests(items: Iterable[tuple[int, dict]]) -> dict[int, bytes]:
+    """
+    Return the hash of each item
+    :param items: item uid and item dictionary for each item
+    :return: hash of each item, by uid
+    """
+    return {int(uid): item_digest(json_item) for uid, json_item in items}
+
+
+def content_digest(settings: str, tag_list: list, field_list: list, digests: dict[int, bytes]) -> str:
+    """
+    Return the hash of the database contents
+    :param settings: anything else that should change the hash (e.g. the file format)
+    :param tag_list: tag table, in the same format returned by Table.export()
+    :param field_list: field table, in the same format returned by Table.export()
+    :param digests: hash of each item, by uid (see item_digests())
+    :return: hash (hexadecimal string)
+    """
+    h = hashlib.sha256(json.dumps([settings, tag_list, field_list], sort_keys=True).encode())
+    for uid in sorted(digests):
+        h.update(uid.to_bytes(4, 'little') + digests[uid])
+    return h.hexdigest()
+
+
+def encode_digests(digests: dict[int, bytes]) -> dict[str, str]:
+    """
+    Return the item hashes in the format they are stored with the database
+    :param digests: hash of each item, by uid
+    :return: hexadecimal hash of each item, by uid (as a string)
+    """
+    return {str(uid): digest.hex() for uid, digest in digests.items()}
+
+
+def decode_digests(stored: Optional[dict[str, str]]) -> dict[int, bytes]:
+    """
+    Return the item hashes stored with the database (see encode_digests())
+    :param stored: hexadecimal hash of each item, by uid (None if the hashes were not stored)
+    :return: hash of each item, by uid
+    """
+    return {} if stored is None else {int(uid): bytes.fromhex(digest) for uid, digest in stored.items()}
+
+
+def check_items(items: list[tuple[str, dict]], digests: dict[str, str]) -> list[int]:
+    """
+    Compare some items with their stored hashes. Called by the processes checking the items.
+    :param items: item uid and item dictionary for each item
+    :param digests: hexadecimal hash of each item, by uid (see encode_digests())
+    :return: uid of the items that don't match their hash
+    """
+    return [int(uid) for uid, json_item in items if item_digest(json_item).hex() != digests[str(uid)]]
+
+
+def verify_items(items: dict[str, dict], digests: dict[str, str],
+                 workers=DEFAULT_WORKERS) -> tuple[list[int], list[int]]:
+    """
+    Compare the items with their stored hashes. The items are split among a pool of
+    processes if there are enough of them.
+    :param items: item dictionary, by uid (as in the database dictionary)
+    :param digests: hexadecimal hash of each item, by uid (see encode_digests())
+    :param workers: maximum number of processes
+    :return: uid of the items that don't match their hash, and of the items without a hash, in ascending order
+    """
+    checked = [(uid, json_item) for uid, json_item in items.items() if str(uid) in digests]
+    missing = sorted(int(uid) for uid in items if str(uid) not in digests)
+    workers = max(1, min(workers, len(checked) // MIN_ITEMS_PER_WORKER))
+    if workers == 1:
+        return sorted(check_items(checked, digests)), missing
+    size = -(-len(checked) // workers)
+    chunks = [checked[n:n + size] for n in range(0, len(checked), size)]
+    chunk_digests = [{str(uid): digests[str(uid)] for uid, _ in chunk} for chunk in chunks]
+    with ProcessPoolExecutor(workers) as executor:
+        corrupted = [uid for result in executor.map(check_items, chunks, chunk_digests) for uid in result]
+    return sorted(corrupted), missing
+
+
+if __name__ == '__main__':
+    item = {'name': 'one', 'uid': 1000, 'fields': {'5': {'name': 'user', 'value': 'joe', 'uid': '5'}}}
+    print(content_digest('json', [], [], item_digests([(1000, item)])))
+    stored = encode_digests(item_digests([(1000, item)]))
+    print(stored, verify_items({'1000': item}, stored), verify_items({'1000': dict(item, name='two')}, stored))
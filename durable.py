@@ -0,0 +1,176 @@
+"""
+Durable file replacement and group commit.
+
+A file is replaced by writing the new contents to a temporary file in the same directory,
+with a unique name, and renaming it over the old one in a single step. The durability
+level decides what is flushed to disk before the save is considered done:
+
+    - none: nothing (the operating system writes the data whenever it decides)
+    - file: the contents of the new file, before it's renamed
+    - full: the contents of the new file, and the directory after the rename, so the
+            rename itself survives a crash
+
+Group commit coalesces saves requested while another save is running: the requests that
+arrive in the meantime are all served by a single save that starts when the running one
+finishes, since it includes every change made before it started.
+"""
+import os
+import shutil
+import tempfile
+import threading
+from os.path import basename, dirname
+from typing import Any, Callable
+
+# Durability levels
+DURABILITY_NONE = 'none'
+DURABILITY_FILE = 'file'
+DURABILITY_FULL = 'full'
+DURABILITY_LIST = [DURABILITY_NONE, DURABILITY_FILE, DURABILITY_FULL]
+DEFAULT_DURABILITY = DURABILITY_FULL
+
+# Suffix of the temporary files
+TEMP_SUFFIX = '.tmp'
+
+
+def fsync_directory(path: str):
+    """
+    Flush a directory to disk, so the files created, renamed or removed in it are persistent.
+    Does nothing on systems where directories cannot be opened (e.g. Windows).
+    :param path: directory
+    """
+    try:
+        fd = os.open(path or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class AtomicFile:
+    """
+    Temporary file that replaces a target file when committed. The temporary file is
+    removed if the object is used as a context manager and it's not committed, e.g.
+    because an exception was raised while writing.
+
+        with AtomicFile('pw.db') as f:
+            f.write(data)
+            f.commit()
+    """
+
+    def __init__(self, file_name: str, durability=DEFAULT_DURABILITY):
+        """
+        :param file_name: target file name
+        :param durability: durability level
+        :raise: ValueError if the durability level is unknown
+        """
+        if durability not in DURABILITY_LIST:
+            raise ValueError(f'unknown durability level {durability}')
+        self.file_name = file_name
+        self.durability = durability
+        fd, self.temp_name = tempfile.mkstemp(suffix=TEMP_SUFFIX, prefix=basename(file_name) + '.',
+                                              dir=dirname(file_name) or '.')
+        self.f_out = os.fdopen(fd, 'wb')
+        self.committed = False
+        # Temporary files are only readable by the owner. Keep the permissions of the target instead.
+        if os.path.exists(file_name):
+            shutil.copymode(file_name, self.temp_name)
+
+    def write(self, data: bytes) -> int:
+        return self.f_out.write(data)
+
+    def commit(self):
+        """
+        Flush the temporary file as required by the durability level and rename it to the target
+        """
+        self.f_out.flush()
+        if self.durability != DURABILITY_NONE:
+            os.fsync(self.f_out.fileno())
+        self.f_out.close()
+        os.replace(self.temp_name, self.file_name)
+        self.committed = True
+        if self.durability == DURABILITY_FULL:
+            fsync_directory(dirname(self.file_name))
+
+    def discard(self):
+        """
+        Remove the temporary file, if it was not committed
+        """
+        self.f_out.close()
+        if not self.committed and os.path.exists(self.temp_name):
+            os.remove(self.temp_name)
+
+    def __enter__(self) -> 'AtomicFile':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.discard()
+
+
+class GroupCommit:
+    """
+    Run a save function on behalf of several threads. A request made while a save is
+    running waits for it to finish. Then a single save serves all the requests made in
+    the meantime, and all of them get its result.
+    """
+
+    def __init__(self, function: Callable[[], Any], delay=0.0):
+        """
+        :param function: save function
+        :param delay: time the thread running a save waits for more requests before starting it (seconds)
+        """
+        self.function = function
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.running = False
+        # Requests are numbered. A save serves all the requests made before it started.
+        self.requested = 0
+        self.served = 0
+        self.result = None
+        self.error = None
+        # Number of times the save function was run
+        self.count = 0
+
+    def __call__(self) -> Any:
+        """
+        Request a save and wait until a save that started after the request finishes
+        :return: result of the save function
+        :raise: the exception raised by the save function
+        """
+        with self.condition:
+            self.requested += 1
+            ticket = self.requested
+            while self.running:
+                self.condition.wait()
+            if self.served >= ticket:
+                if self.error is not None:
+                    raise self.error
+                return self.result
+            self.running = True
+            if self.delay > 0:
+                self.condition.wait(self.delay)
+            last = self.requested
+        result, error = None, None
+        try:
+            result = self.function()
+        except Exception as e:
+            error = e
+        with self.condition:
+            self.result, self.error = result, error
+            self.served = last
+            self.running = False
+            self.count += 1
+            self.condition.notify_all()
+        if error is not None:
+            raise error
+        return result
+
+
+if __name__ == '__main__':
+    with AtomicFile('durable.txt') as f:
+        f.write(b'some data')
+        f.commit()
+    with open('durable.txt', 'rb') as f_in:
+        print(f_in.read())
+    os.remove('durable.txt')
@@ -0,0 +1,548 @@
+"""
+File storage engine. The database is stored in a single file, in json or binary format
+(see binary_format.py), optionally compressed (see compression.py) and encrypted in chunks
+(see crypt_stream.py). Changes can be appended to a journal (see journal.py) instead of
+rewriting the file. Each new version of the file replaces the old one in a single step
+(see durable.py), and the old version is kept as a backup (see backup.py).
+"""
+import io
+import os
+import json
+import mmap
+import shutil
+from uuid import uuid4
+from typing import Optional, BinaryIO
+from os.path import exists
+from items import LazyItemCollection
+from common import ITEM_UID_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, DB_HASH_KEY, DB_COUNTS_KEY
+from common import DB_DIGESTS_KEY
+from common import FORMAT_JSON, FORMAT_BINARY
+from uid import ItemUid
+from utils import get_string_timestamp
+from crypt import CHARACTER_ENCODING
+from binary_format import BINARY_MAGIC, is_binary, encode_database, decode_database, read_index
+from journal import fold_record
+from journal import RECORD_OP_KEY, RECORD_DATA_KEY, OP_ITEM_PUT, OP_ITEM_DELETE
+from json_stream import JsonStreamReader
+from digest import item_digest, encode_digests, decode_digests
+from backup import backup_file_name, list_backups, is_delta
+from backup import make_delta, apply_delta, merge_deltas, read_delta, write_delta
+from compression import CODEC_NONE, HEADER_SIZE, CompressWriter, DecompressReader
+from compression import compress, decompress, get_codec
+from crypt_stream import CHUNK_MAGIC, EncryptWriter, DecryptReader, encrypt_chunks, decrypt_chunks, is_chunked
+from durable import AtomicFile
+from storage import StorageEngine, ENGINE_FILE, file_signature
+
+
+class FileEngine(StorageEngine):
+
+    name = ENGINE_FILE
+
+    def exists(self) -> bool:
+        """
+        Check whether the database file exists
+        :return: True if it does, False otherwise
+        """
+        return exists(self.db.file_name)
+
+    def signature(self) -> Optional[tuple]:
+        """
+        Return what identifies the version of the database file and its journal
+        :return: signature (None if the file does not exist)
+        """
+        signature = file_signature(self.db.file_name)
+        return None if signature is None else (signature, file_signature(self.db.journal.file_name))
+
+    def list_backups(self) -> list[tuple[str, str]]:
+        """
+        Return the backups of the database file (see backup.py)
+        :return: time stamp and kind of each backup (delta or full), most recent first
+        """
+        return [(x, 'delta' if is_delta(self.db.file_name, x) else 'full') for x in list_backups(self.db.file_name)]
+
+    def decrypt(self, data: bytes) -> bytes:
+        """
+        Decrypt the contents of a database file if an encryption key is defined
+        :param data: file contents
+        :return: decrypted data
+        :raise: ValueError
+        """
+        if self.db.crypt_key is None:
+            return data
+        try:
+            if is_chunked(data):
+                return decrypt_chunks(self.db.crypt_key, data)
+            return self.db.crypt_key.decrypt_byte2byte(data)
+        except Exception as e:
+            raise ValueError(f'failed to decrypt data: {repr(e)}')
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        Decompress the decrypted contents of a database file. The codec is detected
+        from the data and kept for writing, unless a codec was specified.
+        :param data: decrypted file contents
+        :return: decompressed data
+        :raise: ValueError
+        """
+        codec = get_codec(data)
+        if self.db.codec is None:
+            self.db.codec = codec
+        return decompress(data)
+
+    def decode(self, data: bytes) -> dict:
+        """
+        Decrypt, decompress and decode the contents of a database file
+        :param data: file contents
+        :return: database dictionary
+        :raise: ValueError
+        """
+        return self.parse(self.decompress(self.decrypt(data)))
+
+    def parse(self, data: bytes) -> dict:
+        """
+        Decode the decrypted contents of a database file. The file format is detected
+        from the data and kept for writing, unless a format was specified.
+        :param data: decrypted file contents
+        :return: database dictionary
+        :raise: ValueError
+        """
+        try:
+            if is_binary(data):
+                file_format = FORMAT_BINARY
+                json_data = decode_database(data)
+            else:
+                file_format = FORMAT_JSON
+                json_data = json.loads(data)
+        except Exception as e:
+            raise ValueError(f'failed to read the data: {repr(e)}')
+        if self.db.file_format is None:
+            self.db.file_format = file_format
+        return json_data
+
+    def encode(self, json_data: dict) -> bytes:
+        """
+        Encode the database dictionary in the database file format, compress it and
+        encrypt it if an encryption key is defined
+        :param json_data: database dictionary
+        :return: file contents
+        """
+        if self.db.file_format == FORMAT_BINARY:
+            data = encode_database(json_data)
+        else:
+            data = json.dumps(json_data).encode(CHARACTER_ENCODING)
+        data = compress(data, self.db.codec or CODEC_NONE, self.db.level)
+        return data if self.db.crypt_key is None else encrypt_chunks(self.db.crypt_key, data)
+
+    def open_data(self, file_name: Optional[str] = None) -> io.BufferedReader:
+        """
+        Open the database file for reading. Files encrypted in chunks and compressed data
+        are decrypted and decompressed as they are read. Files encrypted as a single token
+        are decrypted into memory, since the whole file is needed to authenticate the data.
+        :param file_name: file to open (the database file if not specified, or a full backup copy)
+        :return: binary stream with the decrypted and decompressed file contents
+        :raise FileNotFoundError, ValueError
+        """
+        f_in = open(self.db.file_name if file_name is None else file_name, 'rb')
+        if self.db.crypt_key is not None:
+            if is_chunked(f_in.peek(len(CHUNK_MAGIC))):
+                f_in = io.BufferedReader(DecryptReader(f_in, self.db.crypt_key))
+            else:
+                with f_in:
+                    data = self.decrypt(f_in.read())
+                f_in.close()
+                f_in = io.BufferedReader(io.BytesIO(data))
+        try:
+            codec = get_codec(f_in.peek(HEADER_SIZE))
+        except ValueError:
+            f_in.close()
+            raise
+        if self.db.codec is None:
+            self.db.codec = codec
+        return f_in if codec == CODEC_NONE else io.BufferedReader(DecompressReader(f_in))
+
+    def load(self) -> dict:
+        """
+        Read the database file from disk and fold the journal into it, if there is one.
+        Only the dictionary representation of the database is returned. The tables and
+        the item collection are not modified.
+        :return: database dictionary
+        :raise FileNotFoundError, ValueError
+        """
+        with self.open_data() as f_in:
+            json_data = self.parse(f_in.read())
+        f_in.close()
+        return self.fold_journal(json_data)
+
+    def fold_journal(self, json_data: dict) -> dict:
+        """
+        Apply the changes saved in the journal since the file was written.
+        A journal from a different generation was already folded into the file.
+        The counters stored in the file are removed if any change is applied.
+        :param json_data: database dictionary, as read from the file
+        :return: database dictionary with the changes applied
+        :raise ValueError
+        """
+        self.db.journal.generation = json_data.get(DB_GENERATION_KEY)
+        if self.db.journal.is_current():
+            try:
+                for record in self.db.journal.next():
+                    fold_record(json_data, record)
+                    json_data.pop(DB_COUNTS_KEY, None)
+            except Exception as e:
+                raise ValueError(f'failed to replay journal: {repr(e)}')
+        return json_data
+
+    def split_journal(self, json_data: dict) -> dict:
+        """
+        Apply the changes saved in the journal to the tag and field tables only.
+        The item changes are returned instead, so they can be applied to the item collection.
+        The journal generation must be set before calling this function.
+        :param json_data: dictionary with the tag and field tables
+        :return: last version of each item changed in the journal, by uid (None for deleted items)
+        :raise ValueError
+        """
+        item_records = {}
+        if self.db.journal.is_current():
+            try:
+                for record in self.db.journal.next():
+                    op, record_data = record[RECORD_OP_KEY], record[RECORD_DATA_KEY]
+                    if op in [OP_ITEM_PUT, OP_ITEM_DELETE]:
+                        item_records[int(record_data[ITEM_UID_KEY])] = record_data if op == OP_ITEM_PUT else None
+                    else:
+                        fold_record(json_data, record)
+            except Exception as e:
+                raise ValueError(f'failed to replay journal: {repr(e)}')
+        return item_records
+
+    def read(self, lazy=False, stream=True):
+        """
+        Read the database from disk.
+        In lazy mode only the tables and the item index are read, and each item is created
+        the first time it's accessed. Lazy reads need a file in binary format. Other files
+        are read normally.
+        Files in json format are parsed incrementally unless streaming is disabled.
+        :param lazy: lazy read?
+        :param stream: parse json files incrementally?
+        :raise FileNotFoundError, ValueError
+        """
+        if lazy and self.read_lazy():
+            return
+
+        with self.db.lock:
+            with self.open_data() as f_in:
+                binary = is_binary(f_in.peek(len(BINARY_MAGIC)))
+                if stream and not binary:
+                    self.read_stream(f_in)
+                    return
+                json_data = self.fold_journal(self.parse(f_in.read()))
+            f_in.close()
+            self.db.content_hash = json_data.get(DB_HASH_KEY)
+
+        self.db.read_tables(json_data[DB_TAGS_KEY], json_data[DB_FIELDS_KEY])
+
+        # Read the items. The item uid are preserved so journal records can refer to them.
+        # The counters and the item hashes are taken from the file if they are still valid.
+        try:
+            for item_uid in json_data[DB_ITEMS_KEY]:
+                uid = int(item_uid)
+                self.db.add_item_uid(uid)
+                self.db.item_collection.add(self.db.item_from_dict(json_data[DB_ITEMS_KEY][item_uid], uid))
+            self.db.digest_cache = decode_digests(json_data.get(DB_DIGESTS_KEY))
+            if not self.db.apply_counts(json_data.get(DB_COUNTS_KEY), json_data.get(DB_GENERATION_KEY)):
+                self.db.count_items()
+        except Exception as e:
+            self.db.clear()
+            raise ValueError(f'failed to read items: {repr(e)}')
+
+        self.db.pending_records = []
+
+    def read_stream(self, f_in: BinaryIO):
+        """
+        Read a database file in json format incrementally. Each item is created as soon as it's
+        parsed, so neither the whole file nor the whole database dictionary are kept in memory.
+        The generation can be anywhere in the file, so the journal is replayed on the item
+        collection after all the items are read, and the counters are set at the end, from
+        the file if no item changed in the journal.
+        :param f_in: binary stream with the decrypted file contents
+        :raise ValueError
+        """
+        json_data = {DB_TAGS_KEY: [], DB_FIELDS_KEY: []}
+        try:
+            reader = JsonStreamReader(io.TextIOWrapper(f_in, encoding=CHARACTER_ENCODING))
+            for key in reader.members():
+                if key == DB_ITEMS_KEY:
+                    for item_uid in reader.members():
+                        uid = int(item_uid)
+                        self.db.add_item_uid(uid)
+                        self.db.item_collection.add(self.db.item_from_dict(reader.value(), uid))
+                else:
+                    json_data[key] = reader.value()
+        except Exception as e:
+            self.db.clear()
+            raise ValueError(f'failed to read the data: {repr(e)}')
+        if self.db.file_format is None:
+            self.db.file_format = FORMAT_JSON
+
+        self.db.journal.generation = json_data.get(DB_GENERATION_KEY)
+        self.db.content_hash = json_data.get(DB_HASH_KEY)
+        item_records = self.split_journal(json_data)
+        self.db.read_tables(json_data[DB_TAGS_KEY], json_data[DB_FIELDS_KEY])
+
+        try:
+            self.db.digest_cache = decode_digests(json_data.get(DB_DIGESTS_KEY))
+            self.db.apply_item_records(item_records, count=False)
+            counts = None if item_records else json_data.get(DB_COUNTS_KEY)
+            if not self.db.apply_counts(counts, json_data.get(DB_GENERATION_KEY)):
+                self.db.count_items()
+        except Exception as e:
+            self.db.clear()
+            raise ValueError(f'failed to read items: {repr(e)}')
+
+        self.db.pending_records = []
+
+    def read_lazy(self) -> bool:
+        """
+        Read the tables and the item index of a file in binary format. Unencrypted files are
+        memory mapped, so the items that are never accessed are not even read from disk.
+        Compressed files are decompressed into memory first.
+        The table counters are taken from the file, so the items don't need to be created.
+        :return: True if the database was read, False if the file has no index
+        :raise FileNotFoundError, ValueError
+        """
+        with self.db.lock:
+            with open(self.db.file_name, 'rb') as f_in:
+                if self.db.crypt_key is None:
+                    data = mmap.mmap(f_in.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    data = self.decrypt(f_in.read())
+            f_in.close()
+            try:
+                data = self.decompress(data)
+                index = read_index(data) if is_binary(data) else None
+            except Exception as e:
+                raise ValueError(f'failed to read the data: {repr(e)}')
+            if index is None:
+                return False
+
+            # Journal records for items are kept aside, the rest are folded into the tables
+            self.db.journal.generation = index.generation
+            self.db.content_hash = index.content_hash
+            json_data = {DB_TAGS_KEY: index.tag_list, DB_FIELDS_KEY: index.field_list}
+            item_records = self.split_journal(json_data)
+
+        if self.db.file_format is None:
+            self.db.file_format = FORMAT_BINARY
+        self.db.read_tables(json_data[DB_TAGS_KEY], json_data[DB_FIELDS_KEY])
+
+        try:
+            # Counters
+            for uid, count in index.tag_count.items():
+                if count and self.db.tag_table.has_uid(uid):
+                    self.db.tag_table.increment(uid=uid, n=count)
+            for uid, count in index.field_count.items():
+                if count and self.db.field_table.has_uid(uid):
+                    self.db.field_table.increment(uid=uid, n=count)
+
+            # Items. The item uid counter is moved past the last stored item.
+            self.db.item_collection = LazyItemCollection(
+                index.uid_list, lambda x: self.db.item_from_dict(index.decode_item(data, x), x),
+                lambda: index.item_names(data))
+            if len(index) > 0:
+                ItemUid.reset(max(ItemUid.uid_next, index.uid_list[-1] + 1))
+
+            # Items changed in the journal
+            self.db.digest_cache = index.digests
+            self.db.apply_item_records(item_records)
+        except Exception as e:
+            self.db.clear()
+            raise ValueError(f'failed to read items: {repr(e)}')
+
+        self.db.pending_records = []
+        return True
+
+    def save(self, json_data: Optional[dict] = None, force=False) -> bool:
+        """
+        Write the dictionary representation of a database to disk as a new generation
+        of the database file. The journal is removed since its contents are already
+        in the dictionary. When no dictionary is supplied, files in json format are written
+        incrementally, without building the dictionary.
+        The data is written to a temporary file in the same directory, which replaces the
+        database file when complete.
+        :param json_data: database dictionary (optional)
+        :param force: write the file even if the contents didn't change?
+        :return: True if the file was written, False otherwise
+        """
+        with self.db.lock:
+            # The changes not written yet are included when saving the current contents,
+            # so they are dropped once the new version is in place (or if nothing changed)
+            current = json_data is None
+            digests = self.db.item_digests(json_data)
+            content_hash = self.db.digest(json_data, digests)
+            if not force and content_hash == self.db.content_hash and exists(self.db.file_name) \
+                    and not self.db.journal.is_current():
+                if current:
+                    self.db.pending_records = []
+                return False
+            generation = uuid4().hex
+
+            # Write the data to a temporary file first
+            with AtomicFile(self.db.file_name, self.db.durability) as f_out:
+                if current and self.db.file_format != FORMAT_BINARY:
+                    self.write_stream(f_out, generation, content_hash, digests)
+                else:
+                    json_data = self.db.export() if current else json_data
+                    json_data[DB_GENERATION_KEY] = generation
+                    json_data[DB_HASH_KEY] = content_hash
+                    json_data[DB_DIGESTS_KEY] = encode_digests(digests)
+                    f_out.write(self.encode(json_data))
+
+                # Keep a backup of the old file using a time stamp, then replace it in a single step,
+                # so there is always a complete database file on disk.
+                if exists(self.db.file_name):
+                    self.backup(get_string_timestamp(), digests, generation)
+                f_out.commit()
+            if current:
+                self.db.pending_records = []
+
+            # The journal is folded into the file that was just written
+            self.db.journal.remove()
+            self.db.journal.generation = generation
+            self.db.content_hash = content_hash
+            if current:
+                self.db.digest_cache = digests
+
+            # Remove the backups that are no longer needed
+            if self.db.retention is not None:
+                self.db.retention.prune(self.db.file_name, self.db.crypt_key, self.db.codec, self.db.durability)
+            return True
+
+    def file_delta(self, digests: dict[int, bytes], generation: str) -> dict:
+        """
+        Compare the database file with a new version of its contents and return the reverse
+        delta that rebuilds the file from the new version (see backup.py). Files in json format
+        are read incrementally, and only the items that changed are kept in memory. The item hashes
+        stored in the file are used when they come before the items.
+        :param digests: hash of each item in the new version, by uid (see item_digests())
+        :param generation: generation of the new version
+        :return: delta
+        :raise FileNotFoundError, ValueError
+        """
+        old_data = {DB_TAGS_KEY: [], DB_FIELDS_KEY: []}
+        old_items = {}
+        old_uids = set()
+
+        def compare(item_uid: str, json_item: dict):
+            uid = int(item_uid)
+            old_uids.add(uid)
+            old_digest = old_data.get(DB_DIGESTS_KEY, {}).get(item_uid)
+            if digests.get(uid) != (bytes.fromhex(old_digest) if old_digest else item_digest(json_item)):
+                old_items[uid] = json_item
+
+        try:
+            with self.open_data() as f_in:
+                if is_binary(f_in.peek(len(BINARY_MAGIC))):
+                    old_data = decode_database(f_in.read())
+                    for item_uid, old_item in old_data[DB_ITEMS_KEY].items():
+                        compare(item_uid, old_item)
+                else:
+                    reader = JsonStreamReader(io.TextIOWrapper(f_in, encoding=CHARACTER_ENCODING))
+                    for key in reader.members():
+                        if key == DB_ITEMS_KEY:
+                            for item_uid in reader.members():
+                                compare(item_uid, reader.value())
+                        else:
+                            old_data[key] = reader.value()
+            f_in.close()
+        except Exception as e:
+            raise ValueError(f'failed to read the data: {repr(e)}')
+        return make_delta(old_data, old_items, [x for x in digests if x not in old_uids], generation)
+
+    def backup(self, time_stamp: str, digests: dict[int, bytes], generation: str):
+        """
+        Keep a backup of the database file before it's replaced by a new version.
+        The backup is stored as a reverse delta. A delta with the same time stamp is merged
+        into the new one. If the file cannot be compared, a full copy is kept instead.
+        :param time_stamp: backup time stamp
+        :param digests: hash of each item in the new version, by uid (see item_digests())
+        :param generation: generation of the new version
+        """
+        try:
+            delta = self.file_delta(digests, generation)
+            if is_delta(self.db.file_name, time_stamp):
+                delta = merge_deltas(delta, read_delta(self.db.file_name, time_stamp, self.db.crypt_key))
+            write_delta(self.db.file_name, time_stamp, delta, self.db.crypt_key, self.db.codec, self.db.durability)
+        except ValueError:
+            backup_name = backup_file_name(self.db.file_name, time_stamp)
+            try:
+                os.link(self.db.file_name, backup_name)
+            except OSError:
+                shutil.copy2(self.db.file_name, backup_name)
+
+    def rebuild(self, time_stamp: str) -> dict:
+        """
+        Rebuild the version of the database in a backup. The deltas are applied one after the
+        other, starting from the database file or from the closest full copy, if there is one.
+        :param time_stamp: backup time stamp
+        :return: database dictionary
+        :raise ValueError
+        """
+        time_stamp_list = [x for x in list_backups(self.db.file_name) if x >= time_stamp]
+        if time_stamp not in time_stamp_list:
+            raise ValueError(f'backup {time_stamp} not found')
+        full_list = [x for x in time_stamp_list if not is_delta(self.db.file_name, x)]
+        start_name = self.db.file_name if not full_list else backup_file_name(self.db.file_name, full_list[-1])
+        if full_list:
+            time_stamp_list = time_stamp_list[time_stamp_list.index(full_list[-1]) + 1:]
+        with self.open_data(start_name) as f_in:
+            json_data = self.parse(f_in.read())
+        f_in.close()
+        for delta_time_stamp in time_stamp_list:
+            try:
+                apply_delta(json_data, read_delta(self.db.file_name, delta_time_stamp, self.db.crypt_key))
+            except Exception as e:
+                raise ValueError(f'failed to rebuild backup {time_stamp}: {repr(e)}')
+        return json_data
+
+    def write_stream(self, f_out: BinaryIO, generation: str, content_hash: str, digests: dict[int, bytes]):
+        """
+        Write the database in json format one item at a time, compressing it if a codec is defined
+        and encrypting it in chunks if an encryption key is defined.
+        :param f_out: output file
+        :param generation: file generation
+        :param content_hash: hash of the contents
+        :param digests: hash of each item, by uid (see item_digests())
+        """
+        sink = f_out if self.db.crypt_key is None else EncryptWriter(f_out, self.db.crypt_key)
+        codec = self.db.codec or CODEC_NONE
+        writer = sink if codec == CODEC_NONE else CompressWriter(sink, codec, self.db.level)
+        for chunk in self.db.json_chunks(generation, content_hash, counts=self.db.counts(generation),
+                                         digests=encode_digests(digests)):
+            writer.write(chunk.encode(CHARACTER_ENCODING))
+        if codec != CODEC_NONE:
+            writer.close()
+        if self.db.crypt_key is not None:
+            sink.close()
+
+    def write(self, snapshot=False) -> Optional[bool]:
+        """
+        Append the changes since the last read/write to the journal when journaling is enabled.
+        The whole file is written instead if a full snapshot is requested or the file does not
+        exist yet (see StorageEngine.write()).
+        :param snapshot: force a full write?
+        :return: True if anything was written, False otherwise, None if the file must be written
+        """
+        with self.db.lock:
+            if self.db.journal_enabled and not snapshot and exists(self.db.file_name):
+                written = len(self.db.pending_records) > 0
+                self.db.journal.append(self.db.pending_records)
+                self.db.pending_records = []
+                return written
+        return None
+
+
+if __name__ == '__main__':
+    from db import Database
+    from common import DEFAULT_DATABASE_NAME
+    engine = FileEngine(Database(DEFAULT_DATABASE_NAME))
+    print(engine.name, engine.exists(), engine.list_backups())
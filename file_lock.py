@@ -0,0 +1,161 @@
+"""
+Advisory locking of a database shared by several processes.
+
+Readers take a shared lock and writers an exclusive one, so a process never reads a
+database while another one is replacing it, and only one process writes at a time.
+The lock is taken on a separate lock file next to the database, since the database file
+itself is replaced by a new one every time it's written (see durable.py).
+
+The lock belongs to the process: the threads of a process are serialized by the
+database itself, so the lock can be taken again while it's held (e.g. a save run by
+another thread on behalf of a write, see durable.GroupCommit). The operating system
+lock is only taken by the first request and released by the last one.
+
+Locking is not available on systems without fcntl (e.g. Windows), where it does nothing.
+"""
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Generator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Suffix of the lock file
+LOCK_SUFFIX = '.lock'
+
+# Time to wait for a lock held by another process before giving up (seconds)
+DEFAULT_LOCK_TIMEOUT = 10.0
+
+# Time between attempts to take a lock held by another process (seconds)
+LOCK_POLL_INTERVAL = 0.01
+
+
+def lock_file_name(file_name: str) -> str:
+    """
+    Return the name of the lock file of a database
+    :param file_name: database file name
+    :return: lock file name
+    """
+    return file_name + LOCK_SUFFIX
+
+
+class FileLock:
+    """
+    Shared/exclusive lock of a database, held by the whole process
+
+        lock = FileLock('pw.db')
+        with lock.exclusive():
+            ...
+    """
+
+    def __init__(self, file_name: str, timeout: Optional[float] = DEFAULT_LOCK_TIMEOUT):
+        """
+        :param file_name: database file name
+        :param timeout: time to wait for the lock (forever if None)
+        """
+        self.file_name = lock_file_name(file_name)
+        self.timeout = timeout
+        self.fd: Optional[int] = None
+        # Number of shared and exclusive requests holding the lock
+        self.shared_count = 0
+        self.exclusive_count = 0
+        self.mutex = threading.Lock()
+
+    def lock(self, operation: int):
+        """
+        Take or change the operating system lock, waiting while another process holds it
+        :param operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+        :raise: ValueError if the lock was not available in time
+        """
+        if self.fd is None:
+            self.fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, operation | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise ValueError(f'timed out waiting for the lock on {self.file_name}')
+                time.sleep(LOCK_POLL_INTERVAL)
+
+    def unlock(self):
+        """
+        Release the operating system lock
+        """
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def acquire(self, exclusive=False):
+        """
+        Take the lock. A shared request is satisfied by an exclusive lock already held,
+        and an exclusive request converts a shared lock already held (not atomically, so
+        another process may write in between).
+        :param exclusive: exclusive lock?
+        :raise: ValueError if the lock was not available in time
+        """
+        if fcntl is None:
+            return
+        with self.mutex:
+            if exclusive and self.exclusive_count == 0:
+                self.lock(fcntl.LOCK_EX)
+            elif not exclusive and self.shared_count == 0 and self.exclusive_count == 0:
+                self.lock(fcntl.LOCK_SH)
+            if exclusive:
+                self.exclusive_count += 1
+            else:
+                self.shared_count += 1
+
+    def release(self, exclusive=False):
+        """
+        Release a request. The lock goes back to shared if shared requests are still holding it.
+        :param exclusive: exclusive lock?
+        """
+        if fcntl is None:
+            return
+        with self.mutex:
+            if exclusive:
+                self.exclusive_count -= 1
+            else:
+                self.shared_count -= 1
+            if self.exclusive_count == 0:
+                if self.shared_count == 0:
+                    self.unlock()
+                elif exclusive:
+                    fcntl.flock(self.fd, fcntl.LOCK_SH)
+
+    @contextmanager
+    def shared(self) -> Generator[None, None, None]:
+        """
+        Hold a shared lock while reading
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextmanager
+    def exclusive(self) -> Generator[None, None, None]:
+        """
+        Hold an exclusive lock while writing
+        """
+        self.acquire(exclusive=True)
+        try:
+            yield
+        finally:
+            self.release(exclusive=True)
+
+
+if __name__ == '__main__':
+    file_lock = FileLock('pw.db', timeout=1.0)
+    with file_lock.shared():
+        with file_lock.exclusive():
+            print(file_lock.shared_count, file_lock.exclusive_count)
+    print(file_lock.fd)
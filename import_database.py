@@ -217,6 +217,9 @@ def import_items(db: Database, item_list: list, encrypt_key: Crypt | None):
     :param item_list: list of items
     :param encrypt_key: key used to encrypt sensitive values (optional)
     """
+    # Sensitive fields, encrypted all at once when all the items are imported
+    sensitive_fields = []
+
     # found = False
     for item in item_list:
 
@@ -250,9 +253,10 @@ def import_items(db: Database, item_list: list, encrypt_key: Crypt | None):
                 for field in value:
                     try:
                         f_name, f_value, f_sensitive = process_field(field)
+                        new_field = Field(f_name, f_value, f_sensitive)
+                        field_collection.add(new_field)
                         if f_sensitive and encrypt_key is not None:
-                            f_value = encrypt_key.encrypt_str2str(str(f_value))
-                        field_collection.add(Field(f_name, f_value, f_sensitive))
+                            sensitive_fields.append(new_field)
                         # if 'Network_password' in f_name:
                         #     found = True
                         db.field_table.increment(name=f_name)
@@ -276,6 +280,12 @@ def import_items(db: Database, item_list: list, encrypt_key: Crypt | None):
         else:
             raise ValueError('incomplete item')
 
+    # Encrypt the sensitive values
+    if encrypt_key is not None:
+        values = encrypt_key.encrypt_many([str(field.get_value()) for field in sensitive_fields])
+        for field, value in zip(sensitive_fields, values):
+            field.value = value
+
 
 def save_tables(db: Database):
     """
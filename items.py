@@ -1,11 +1,16 @@
 from abc import ABC, abstractmethod
-from typing import Generator, Optional, Union
+from bisect import bisect_left
+from itertools import islice
+from typing import Callable, Generator, Iterable, Optional, Sequence, Union
 from crypt import Crypt
 from uid import ItemUid, FieldUid
 from utils import filter_control_characters, get_timestamp, trace
 from common import FIELD_NAME_KEY, FIELD_VALUE_KEY, FIELD_UID_KEY, FIELD_SENSITIVE_KEY
 from common import ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_UID_KEY, ITEM_FIELDS_KEY
 
+# Number of items exported together, so their sensitive values are decrypted at once (see export_items())
+EXPORT_BATCH_SIZE = 1000
+
 
 class Element(ABC):
     """
@@ -184,12 +189,13 @@ class Field(Element):
     def get_decrypted_value(self, crypt_key: Crypt) -> Union[str, int, float]:
         """
         Return unencrypted field value. Decryption will only be done if the crypt
-        key is defined and the field is sensitive.
+        key is defined and the field is sensitive. Values decrypted recently are
+        taken from the cache of the key (see Crypt.decrypt_value()).
         :param crypt_key: encryption key
         :return: decrypted value
         """
         if crypt_key and self.sensitive:
-            return crypt_key.decrypt_str2str(self.get_value())
+            return crypt_key.decrypt_value(self.uid, self.get_value())
         else:
             return self.value
 
@@ -253,9 +259,18 @@ class FieldCollection(Collection):
         for key in self.data:
             field = self.data[key]
             assert isinstance(field, Field)
-            d[key] = field.export(crypt)
+            d[key] = field.export()
+        if crypt is not None:
+            decrypt_fields(d.values(), crypt)
         return d
 
+    def get_names(self) -> list[str]:
+        """
+        Return the field names, sorted as in next()
+        :return: list of field names
+        """
+        return [x.get_name() for x in self.next()]
+
     def dump(self, indent=0):
         """
         Dump collection contents in a human readable form
@@ -266,6 +281,69 @@ class FieldCollection(Collection):
             self.data[key].dump(indent=indent + 1)
 
 
+class LazyFieldCollection(FieldCollection):
+    """
+    Field collection built from the stored field dictionaries of an item. The fields are created,
+    with new uid, the first time the collection data is accessed. Until then only the name, value
+    and sensitive flag of each field are kept, in a tuple, and the names, the length and the export
+    are taken from them, so items that are only listed or written back never create their fields.
+    """
+
+    def __init__(self, records: dict):
+        """
+        :param records: field dictionaries, as returned by FieldCollection.export()
+        """
+        self.records = tuple((x[FIELD_NAME_KEY], x[FIELD_VALUE_KEY], x[FIELD_SENSITIVE_KEY])
+                             for x in records.values())
+        self.fields: Optional[dict] = None
+
+    @property
+    def data(self) -> dict:
+        """
+        Return the fields by uid, creating them the first time
+        :return: field dictionary
+        """
+        if self.fields is None:
+            self.fields = {}
+            for name, value, sensitive in self.records:
+                field = Field(name, value, sensitive)
+                self.fields[field.get_id()] = field
+            self.records = None
+        return self.fields
+
+    def loaded(self) -> bool:
+        """
+        Check whether the fields were created
+        :return: True if that's the case, False otherwise
+        """
+        return self.fields is not None
+
+    def __len__(self) -> int:
+        return len(self.records) if self.fields is None else len(self.fields)
+
+    def get_names(self) -> list[str]:
+        if self.fields is None:
+            return sorted(x[0] for x in self.records)
+        return super().get_names()
+
+    def export(self, crypt: Optional[Crypt] = None) -> dict:
+        """
+        Export the collection as a dictionary (see FieldCollection.export()).
+        Fields that were not created yet are identified by their position.
+        :param crypt: decryption key (optional)
+        :return: dictionary representation
+        """
+        if self.fields is not None:
+            return super().export(crypt)
+        d = {}
+        for n, (name, value, sensitive) in enumerate(self.records):
+            d[str(n)] = {FIELD_NAME_KEY: name, FIELD_VALUE_KEY: value, FIELD_SENSITIVE_KEY: sensitive,
+                         FIELD_UID_KEY: str(n)}
+        if crypt is not None:
+            decrypt_fields(d.values(), crypt)
+        return d
+
+
 class Item(Element):
     def __init__(self, name: str, tag_list: list, note: str, field_collection: FieldCollection,
                  time_stamp: Optional[int] = None, uid: Optional[int] = None):
@@ -303,8 +381,12 @@ class Item(Element):
         """
         return self.uid
 
-    def get_field_names(self):
-        return [x.get_name() for x in self.field_collection.next()]
+    def get_field_names(self) -> list[str]:
+        """
+        Return the names of the fields in the item, sorted by name
+        :return: list of field names
+        """
+        return self.field_collection.get_names()
 
     def next_field(self) -> Generator[Field, None, None]:
         """
@@ -345,6 +427,33 @@ class Item(Element):
             field.dump(indent=indent + 1)
 
 
+def decrypt_fields(field_list: Iterable[dict], crypt: Crypt):
+    """
+    Decrypt the sensitive values of exported fields in place, all at once (see Crypt.decrypt_many())
+    :param field_list: field dictionaries, exported without a decryption key
+    :param crypt: decryption key
+    """
+    sensitive = [x for x in field_list if x[FIELD_SENSITIVE_KEY]]
+    for field, value in zip(sensitive, crypt.decrypt_many([x[FIELD_VALUE_KEY] for x in sensitive])):
+        field[FIELD_VALUE_KEY] = value
+
+
+def export_items(items: Iterable[tuple[int, Item]],
+                 crypt: Optional[Crypt] = None) -> Generator[tuple[int, dict], None, None]:
+    """
+    Export items as dictionaries. When a decryption key is provided, the items are exported
+    in batches and the sensitive values of each batch are decrypted together.
+    :param items: item uid and item
+    :param crypt: decryption key (optional)
+    :return: next item uid and item dictionary
+    """
+    items = iter(items)
+    while batch := [(uid, item.export()) for uid, item in islice(items, EXPORT_BATCH_SIZE)]:
+        if crypt is not None:
+            decrypt_fields([x for _, d in batch for x in d[ITEM_FIELDS_KEY].values()], crypt)
+        yield from batch
+
+
 class ItemCollection(Collection):
 
     def sort_key(self, key: str):
@@ -364,12 +473,24 @@ class ItemCollection(Collection):
         :param crypt: decryption key (optional)
         :return:
         """
-        d = {}
-        for item_uid in self.data:
-            item = self.data[item_uid]
-            assert isinstance(item, Item)
-            d[item_uid] = item.export(crypt=crypt)
-        return d
+        return dict(self.next_export(crypt=crypt))
+
+    def next_name(self) -> Generator[tuple[int, str], None, None]:
+        """
+        Iterate over the item uid and names, sorted by name as in next()
+        :return: next item uid and name
+        """
+        for item in self.next():
+            yield item.get_id(), item.get_name()
+
+    def next_export(self, crypt: Optional[Crypt] = None) -> Generator[tuple[int, dict], None, None]:
+        """
+        Iterate over the items in the collection, exported as dictionaries, in no particular order.
+        Used to write the collection one item at a time.
+        :param crypt: decryption key (optional)
+        :return: next item uid and item dictionary
+        """
+        yield from export_items(self.data.items(), crypt=crypt)
 
     def dump(self, indent=0):
         """
@@ -381,6 +502,179 @@ class ItemCollection(Collection):
             self.data[uid].dump(indent=indent + 1)
 
 
+class LazyItemCollection(ItemCollection):
+    """
+    Item collection where the stored items are created the first time they are accessed.
+    The stored items are identified by a sorted sequence of uid. Items that are loaded,
+    added or updated are kept in the data dictionary, as in any other collection.
+    """
+
+    def __init__(self, uid_list: Sequence[int], loader: Callable[[int], Item],
+                 name_loader: Optional[Callable[[], Optional[Sequence[str]]]] = None):
+        """
+        :param uid_list: uid of the stored items, in ascending order
+        :param loader: function used to create a stored item from its uid
+        :param name_loader: function returning the names of the stored items, in the same order as
+                            the uid (optional). Used to sort the items by name without creating them.
+        """
+        super().__init__()
+        self.uid_list = uid_list
+        self.loader = loader
+        self.name_loader = name_loader
+        self.names: Optional[Sequence[str]] = None
+        self.removed = set()
+
+    def indexed(self, key: int) -> bool:
+        """
+        Check whether an item is in the stored items, even if it was removed
+        :param key: item uid
+        :return: True if that's the case, False otherwise
+        """
+        n = bisect_left(self.uid_list, key)
+        return n < len(self.uid_list) and self.uid_list[n] == key
+
+    def stored(self, key: int) -> bool:
+        """
+        Check whether an item is in the stored items and was not removed
+        :param key: item uid
+        :return: True if that's the case, False otherwise
+        """
+        return key not in self.removed and self.indexed(key)
+
+    def __contains__(self, key: int):
+        return key in self.data or self.stored(key)
+
+    def __len__(self) -> int:
+        """
+        Return the number of items in the collection, without creating them
+        :return: number of items
+        """
+        return len(self.uid_list) - len(self.removed) + len([x for x in self.data if not self.indexed(x)])
+
+    def __str__(self) -> str:
+        return ', '.join([str(self.get(x)) for x in self.keys()])
+
+    def keys(self) -> list:
+        return [x for x in self.uid_list if x not in self.removed and x not in self.data] + list(self.data.keys())
+
+    def get(self, key) -> Element:
+        """
+        Get element corresponding to a given key, creating it if was not accessed before
+        :param key: element key
+        :return:
+        """
+        if key not in self.data:
+            if self.stored(key):
+                self.data[key] = self.loader(key)
+            else:
+                raise KeyError(f'{key} does not exist')
+        return self.data[key]
+
+    def stored_name(self, key: int) -> Optional[str]:
+        """
+        Return the name of a stored item without creating it
+        :param key: item uid
+        :return: item name (None if the names of the stored items are not known)
+        """
+        if self.names is None and self.name_loader is not None:
+            self.names = self.name_loader()
+            self.name_loader = None
+        if self.names is None:
+            return None
+        return self.names[bisect_left(self.uid_list, key)]
+
+    def sort_key(self, key: int):
+        """
+        Auxiliary routine called by next() to sort the item keys by item name.
+        The names of the stored items that were not created are taken from the index.
+        :param key: key
+        :return: item name for that key
+        """
+        if key not in self.data:
+            name = self.stored_name(key)
+            if name is not None:
+                return name
+        return super().sort_key(key)
+
+    def next(self) -> Generator[Element, None, None]:
+        """
+        Iterate over all elements in the collection, sorted by name.
+        All the stored items are created the first time this is called.
+        :return: next element
+        """
+        for key in sorted(self.keys(), key=self.sort_key):
+            yield self.get(key)
+
+    def next_name(self) -> Generator[tuple[int, str], None, None]:
+        """
+        Iterate over the item uid and names, sorted by name as in next(). The stored items are
+        not created if their names are known (see stored_name()).
+        :return: next item uid and name
+        """
+        for key in sorted(self.keys(), key=self.sort_key):
+            name = self.stored_name(key) if key not in self.data else None
+            yield key, self.get(key).get_name() if name is None else name
+
+    def add(self, element: Element):
+        """
+        Add element to the collection
+        :param element: Item to add
+        :raise: KeyError if the item already exists
+        """
+        key = element.get_id()
+        if key not in self:
+            self.data[key] = element
+            self.removed.discard(key)
+        else:
+            raise KeyError(f'{key} already exists')
+
+    def remove(self, key: int):
+        """
+        Remove element identified by a unique identifier
+        :param key:
+        :raise: KeyError if the item does not exist
+        """
+        if key in self:
+            if key in self.data:
+                del self.data[key]
+            if self.indexed(key):
+                self.removed.add(key)
+        else:
+            raise KeyError(f'{key} does not exist')
+
+    def update(self, element: Element):
+        """
+        Update the collection with a new instance of an item
+        :param element: element to update
+        :raise: KeyError if the element is not in the collection already
+        """
+        key = element.get_id()
+        if key in self:
+            self.data[key] = element
+        else:
+            raise KeyError(f'{key} does not exist')
+
+    def next_export(self, crypt: Optional[Crypt] = None) -> Generator[tuple[int, dict], None, None]:
+        """
+        Iterate over the items in the collection, exported as dictionaries, in no particular order.
+        Stored items that were not accessed yet are created and discarded, without keeping them
+        in the collection.
+        :param crypt: decryption key (optional)
+        :return: next item uid and item dictionary
+        """
+        items = ((key, self.data[key] if key in self.data else self.loader(key)) for key in self.keys())
+        yield from export_items(items, crypt=crypt)
+
+    def dump(self, indent=0):
+        """
+        Dump collection contents in a human readable form
+        :param indent: indentation level
+        """
+        print('Items:')
+        for key in self.keys():
+            self.get(key).dump(indent=indent + 1)
+
+
 if __name__ == '__main__':
     fc1 = FieldCollection()
     fc1.add(Field('f_one', 1, True))
@@ -0,0 +1,287 @@
+"""
+Append-only journal of database mutations.
+
+Each mutation is stored as one json record per line. Records are encrypted
+individually when an encryption key is supplied, so appending a record never
+requires rewriting the records that are already on disk.
+
+The first record is a header with the generation of the database file the
+journal applies to. A journal left behind after its records were already
+folded into a newer database file has a different generation and is ignored.
+"""
+import os
+import json
+from os.path import exists, dirname
+from typing import Generator, Optional
+from crypt import Crypt
+from durable import DEFAULT_DURABILITY, DURABILITY_NONE, DURABILITY_FULL, fsync_directory
+from common import KEY_NAME, KEY_UID, ITEM_UID_KEY, ITEM_TAG_LIST_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, DB_DIGESTS_KEY
+
+# Suffix appended to the database file name to get the journal file name
+JOURNAL_SUFFIX = '.journal'
+
+# Record keys
+RECORD_OP_KEY = 'op'
+RECORD_DATA_KEY = 'data'
+
+# Previous name in rename records
+RENAME_OLD_KEY = 'old_name'
+
+# Record operations
+OP_HEADER = 'header'
+OP_TAG_ADD = 'tag_add'
+OP_TAG_RENAME = 'tag_rename'
+OP_TAG_DELETE = 'tag_delete'
+OP_FIELD_ADD = 'field_add'
+OP_FIELD_DELETE = 'field_delete'
+OP_ITEM_PUT = 'item_put'
+OP_ITEM_DELETE = 'item_delete'
+
+# Record separator
+RECORD_SEPARATOR = b'\n'
+
+
+def journal_file_name(file_name: str) -> str:
+    """
+    Return the journal file name for a given database file
+    :param file_name: database file name
+    :return: journal file name
+    """
+    return file_name + JOURNAL_SUFFIX
+
+
+def make_record(op: str, data: dict) -> dict:
+    """
+    Build a journal record
+    :param op: record operation
+    :param data: operation data
+    :return: record
+    """
+    return {RECORD_OP_KEY: op, RECORD_DATA_KEY: data}
+
+
+def renumber_record(record: dict, tag_map: dict[int, int], field_map: dict[int, int],
+                    item_map: dict[int, int]) -> dict:
+    """
+    Build a journal record referring to the new uid of the tags, fields and items renumbered
+    (see Database.merge())
+    :param record: record
+    :param tag_map: new tag uid, by old uid
+    :param field_map: new field uid, by old uid
+    :param item_map: new item uid, by old uid
+    :return: record (the same one if nothing changed)
+    """
+    op, data = record[RECORD_OP_KEY], dict(record[RECORD_DATA_KEY])
+    if op == OP_TAG_ADD:
+        data[KEY_UID] = tag_map.get(data[KEY_UID], data[KEY_UID])
+    elif op == OP_FIELD_ADD and KEY_UID in data:
+        data[KEY_UID] = field_map.get(data[KEY_UID], data[KEY_UID])
+    elif op in [OP_ITEM_PUT, OP_ITEM_DELETE]:
+        data[ITEM_UID_KEY] = item_map.get(int(data[ITEM_UID_KEY]), data[ITEM_UID_KEY])
+        if op == OP_ITEM_PUT:
+            data[ITEM_TAG_LIST_KEY] = [tag_map.get(x, x) for x in data[ITEM_TAG_LIST_KEY]]
+    return record if data == record[RECORD_DATA_KEY] else make_record(op, data)
+
+
+def _table_entry(table: list, name: str) -> dict:
+    """
+    Find an entry by name in the list representation of a table
+    :param table: table, as returned by Table.export()
+    :param name: entry name
+    :return: table entry
+    :raise: KeyError if the entry is not in the table
+    """
+    for entry in table:
+        if entry[KEY_NAME] == name:
+            return entry
+    raise KeyError(f'{name} not in the table')
+
+
+def fold_record(json_data: dict, record: dict):
+    """
+    Apply a record to the dictionary representation of a database (see Database.export()).
+    Working on the dictionary allows folding the journal without creating any uid.
+    :param json_data: database dictionary
+    :param record: record
+    :raise: KeyError, ValueError
+    """
+    op, data = record[RECORD_OP_KEY], record[RECORD_DATA_KEY]
+    if op in [OP_TAG_ADD, OP_FIELD_ADD]:
+        table = json_data[DB_TAGS_KEY if op == OP_TAG_ADD else DB_FIELDS_KEY]
+        if any(x[KEY_NAME] == data[KEY_NAME] for x in table):
+            raise KeyError(f'{data[KEY_NAME]} already exists')
+        table.append(dict(data))
+    elif op == OP_TAG_RENAME:
+        _table_entry(json_data[DB_TAGS_KEY], data[RENAME_OLD_KEY])[KEY_NAME] = data[KEY_NAME]
+    elif op in [OP_TAG_DELETE, OP_FIELD_DELETE]:
+        table = json_data[DB_TAGS_KEY if op == OP_TAG_DELETE else DB_FIELDS_KEY]
+        table.remove(_table_entry(table, data[KEY_NAME]))
+    elif op == OP_ITEM_PUT:
+        json_data[DB_ITEMS_KEY][str(data[ITEM_UID_KEY])] = data
+    elif op == OP_ITEM_DELETE:
+        del json_data[DB_ITEMS_KEY][str(data[ITEM_UID_KEY])]
+    else:
+        raise ValueError(f'unknown journal operation {op}')
+    # The stored hash of a changed item no longer applies
+    if op in [OP_ITEM_PUT, OP_ITEM_DELETE] and DB_DIGESTS_KEY in json_data:
+        json_data[DB_DIGESTS_KEY].pop(str(data[ITEM_UID_KEY]), None)
+
+
+class Journal:
+
+    def __init__(self, file_name: str, crypt_key: Optional[Crypt] = None, generation: Optional[str] = None,
+                 durability=DEFAULT_DURABILITY):
+        """
+        :param file_name: journal file name
+        :param crypt_key: key used to encrypt the records (optional)
+        :param generation: generation of the database file the records apply to
+        :param durability: what is flushed to disk when appending (see durable.py)
+        """
+        self.file_name = file_name
+        self.crypt_key = crypt_key
+        self.generation = generation
+        self.durability = durability
+
+    def __len__(self) -> int:
+        """
+        Return the number of records in the journal, not counting the header.
+        The records are counted without decoding them.
+        :return: number of records
+        """
+        if not self.exists():
+            return 0
+        with open(self.file_name, 'rb') as f_in:
+            n = f_in.read().count(RECORD_SEPARATOR)
+        f_in.close()
+        return max(n - 1, 0)
+
+    def exists(self) -> bool:
+        """
+        Check whether the journal file exists
+        :return: True if it does, False otherwise
+        """
+        return exists(self.file_name)
+
+    def size(self) -> int:
+        """
+        Return the journal file size in bytes
+        :return: size (zero if the journal does not exist)
+        """
+        return os.path.getsize(self.file_name) if self.exists() else 0
+
+    def encode(self, record: dict) -> bytes:
+        """
+        Convert a record into the bytes stored in the file
+        :param record: record
+        :return: encoded record
+        """
+        data = json.dumps(record)
+        return data.encode() if self.crypt_key is None else self.crypt_key.encrypt_str2byte(data)
+
+    def decode(self, data: bytes) -> dict:
+        """
+        Convert the bytes stored in the file back into a record
+        :param data: encoded record
+        :return: record
+        """
+        return json.loads(data.decode() if self.crypt_key is None else self.crypt_key.decrypt_byte2str(data))
+
+    def get_generation(self) -> Optional[str]:
+        """
+        Return the generation stored in the journal header
+        :return: generation (None if the journal does not exist)
+        :raise: ValueError if the header cannot be decoded
+        """
+        if not self.exists():
+            return None
+        with open(self.file_name, 'rb') as f_in:
+            line = f_in.readline()
+        f_in.close()
+        try:
+            record = self.decode(line.rstrip(RECORD_SEPARATOR))
+            assert record[RECORD_OP_KEY] == OP_HEADER
+            return record[RECORD_DATA_KEY][DB_GENERATION_KEY]
+        except Exception as e:
+            raise ValueError(f'failed to read journal header: {repr(e)}')
+
+    def is_current(self) -> bool:
+        """
+        Check whether the journal applies to the current generation of the database file
+        :return: True if it does, False otherwise
+        """
+        return self.exists() and self.get_generation() == self.generation
+
+    def append(self, record_list: list[dict]):
+        """
+        Append records at the end of the journal.
+        A journal from a different generation is discarded first.
+        :param record_list: list of records
+        """
+        if not record_list:
+            return
+        self.repair()
+        if self.exists() and not self.is_current():
+            self.remove()
+        created = not self.exists()
+        if created:
+            record_list = [make_record(OP_HEADER, {DB_GENERATION_KEY: self.generation})] + record_list
+        data = b''.join([self.encode(x) + RECORD_SEPARATOR for x in record_list])
+        with open(self.file_name, 'ab') as f_out:
+            f_out.write(data)
+            f_out.flush()
+            if self.durability != DURABILITY_NONE:
+                os.fsync(f_out.fileno())
+        f_out.close()
+        if created and self.durability == DURABILITY_FULL:
+            fsync_directory(dirname(self.file_name))
+
+    def repair(self):
+        """
+        Remove a partial record left at the end of the journal by an interrupted append.
+        Otherwise, the next record would be appended to it.
+        """
+        if not self.exists():
+            return
+        with open(self.file_name, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(RECORD_SEPARATOR):
+                f.truncate(data.rfind(RECORD_SEPARATOR) + 1)
+        f.close()
+
+    def next(self) -> Generator[dict, None, None]:
+        """
+        Iterate over all the records in the journal, oldest first. The header is skipped.
+        A partial record at the end of the file (interrupted append) is ignored.
+        :return: next record
+        :raise: ValueError if a record cannot be decoded
+        """
+        if not self.exists():
+            return
+        with open(self.file_name, 'rb') as f_in:
+            data = f_in.read()
+        f_in.close()
+        line_list = data.split(RECORD_SEPARATOR)
+        # The last element is empty unless the last append was interrupted
+        for n, line in enumerate(line_list[1:-1]):
+            try:
+                yield self.decode(line)
+            except Exception as e:
+                raise ValueError(f'failed to read journal record {n}: {repr(e)}')
+
+    def remove(self):
+        """
+        Remove the journal file
+        """
+        if self.exists():
+            os.remove(self.file_name)
+
+
+if __name__ == '__main__':
+    j = Journal('test' + JOURNAL_SUFFIX, Crypt('test'), generation='1')
+    j.append([make_record(OP_TAG_ADD, {'name': 'one', 'uid': 10}),
+              make_record(OP_TAG_DELETE, {'name': 'one'})])
+    for r in j.next():
+        print(r)
+    print(len(j), j.size(), j.get_generation())
+    j.remove()
@@ -0,0 +1,151 @@
+"""
+Incremental json reader and writer.
+
+The reader walks through a json document in chunks, so the members of a large object
+can be decoded one at a time, without holding the whole document or the whole decoded
+dictionary in memory. Consumed characters are dropped every time a new chunk is read.
+
+Example (iterate over the members of the top level object):
+
+    reader = JsonStreamReader(f_in)
+    for key in reader.members():
+        value = reader.value()
+
+The writer does the opposite. The members of an object are supplied by an iterator and
+the document is returned in chunks, one member at a time (see encode_object()).
+"""
+import io
+import json
+from typing import Any, TextIO, Generator, Iterable, Iterator
+
+# Characters skipped between json tokens
+WHITESPACE = ' \t\n\r'
+
+# Number of characters read from the input at a time
+DEFAULT_CHUNK_SIZE = 1 << 16
+
+
+class JsonStreamReader:
+
+    def __init__(self, f_in: TextIO, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param f_in: input stream
+        :param chunk_size: number of characters read at a time
+        """
+        self.f_in = f_in
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """
+        Read the next chunk into the buffer, dropping the characters that were already consumed
+        :return: True if there was more input, False at the end of the input
+        """
+        if self.eof:
+            return False
+        chunk = self.f_in.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.offset += self.pos
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """
+        Skip whitespace and return the next character without consuming it
+        :return: next character (empty string at the end of the input)
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char: str):
+        """
+        Consume the next character, which must be a given one
+        :param char: expected character
+        :raise: ValueError if the next character is a different one
+        """
+        if self.peek() != char:
+            raise ValueError(f'expected {repr(char)} at position {self.offset + self.pos}')
+        self.pos += 1
+
+    def value(self) -> Any:
+        """
+        Decode the next json value
+        :return: value
+        :raise: ValueError if the value cannot be decoded
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value that ends with the buffer might continue in the next chunk (e.g. a number)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    raise ValueError(f'failed to decode value at position {self.offset + e.pos}: {e.msg}')
+            self.fill()
+
+    def members(self) -> Generator[str, None, None]:
+        """
+        Iterate over the members of the next json object. Only the keys are returned.
+        The value of each member must be consumed, with value() or members(), before
+        asking for the next key.
+        :return: next key
+        :raise: ValueError if the input is not a json object
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f'invalid key {repr(key)} at position {self.offset + self.pos}')
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f'expected \',\' or \'}}\' at position {self.offset + self.pos - 1}')
+
+
+def encode_object(members: Iterable[tuple[str, Any]]) -> Generator[str, None, None]:
+    """
+    Encode a json object one member at a time. Values that are iterators over (key, value)
+    pairs are encoded as nested objects, also one member at a time. Any other value is
+    encoded in a single chunk.
+    :param members: object members, as (key, value) pairs
+    :return: next chunk of json text
+    """
+    yield '{'
+    for n, (key, value) in enumerate(members):
+        yield (', ' if n > 0 else '') + json.dumps(str(key)) + ': '
+        if isinstance(value, Iterator):
+            yield from encode_object(value)
+        else:
+            yield json.dumps(value)
+    yield '}'
+
+
+if __name__ == '__main__':
+    r = JsonStreamReader(io.StringIO('{"one": 1, "many": {"a": [1, 2], "b": {"c": 3.5}}, "last": "x"}'), chunk_size=4)
+    for k in r.members():
+        if k == 'many':
+            for m in r.members():
+                print(k, m, r.value())
+        else:
+            print(k, r.value())
+    print(''.join(encode_object([('one', 1), ('many', iter([('a', [1, 2]), ('b', {'c': 3.5})]))])))
@@ -0,0 +1,184 @@
+"""
+Derivation of the encryption key from a password.
+
+The key derivation function and its parameters are chosen when a database is created
+and stored with it (see crypt_stream.py and StorageEngine.kdf_parameters()), so the cost
+can be tuned on each machine without making the existing databases unreadable:
+
+    pbkdf2      {"algorithm": "pbkdf2", "salt": "<hex>", "iterations": <n>}  (SHA-512)
+    scrypt      {"algorithm": "scrypt", "salt": "<hex>", "n": <n>, "r": <r>, "p": <p>}
+
+Each database gets a random salt. Databases stored before the parameters were stored
+used a fixed salt and PBKDF2 (see LEGACY_PARAMETERS).
+
+The cost that makes the derivation take a given time on this machine is found with calibrate().
+"""
+import os
+import json
+import time
+import base64
+from typing import Optional
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# Key derivation functions
+KDF_PBKDF2 = 'pbkdf2'
+KDF_SCRYPT = 'scrypt'
+KDF_LIST = [KDF_PBKDF2, KDF_SCRYPT]
+DEFAULT_KDF = KDF_PBKDF2
+
+# Parameter keys
+KDF_ALGORITHM_KEY = 'algorithm'
+KDF_SALT_KEY = 'salt'
+KDF_ITERATIONS_KEY = 'iterations'
+KDF_N_KEY = 'n'
+KDF_R_KEY = 'r'
+KDF_P_KEY = 'p'
+
+# Key and salt sizes (bytes)
+KEY_SIZE = 32
+SALT_SIZE = 16
+
+# Default cost: PBKDF2 iterations, scrypt CPU/memory cost (n) with its block size (r) and parallelism (p)
+DEFAULT_ITERATIONS = 480000
+DEFAULT_SCRYPT_N = 1 << 15
+DEFAULT_SCRYPT_R = 8
+DEFAULT_SCRYPT_P = 1
+
+# Largest cost accepted, so a file cannot make opening it take forever or exhaust the memory.
+# Scrypt uses 128·n·r bytes (1 GB for n=2^20 and r=8), and runs that p times one after the other.
+MAX_ITERATIONS = 100000000
+MAX_SCRYPT_N = 1 << 20
+MAX_SCRYPT_MEMORY = 128 * MAX_SCRYPT_N * DEFAULT_SCRYPT_R
+
+# Parameters of the databases stored without them
+LEGACY_PARAMETERS = {KDF_ALGORITHM_KEY: KDF_PBKDF2, KDF_SALT_KEY: b'TDkmQ2TyV6HRw7pW'.hex(),
+                     KDF_ITERATIONS_KEY: 480000}
+
+# Default time the key derivation should take when calibrating (seconds)
+DEFAULT_TARGET_TIME = 0.5
+
+
+def new_parameters(algorithm=DEFAULT_KDF, cost: Optional[int] = None) -> dict:
+    """
+    Return the parameters for a new database, with a random salt
+    :param algorithm: key derivation function (see KDF_LIST)
+    :param cost: PBKDF2 iterations or scrypt n (default cost if not specified)
+    :return: parameters
+    :raise: ValueError if the algorithm is unknown
+    """
+    salt = os.urandom(SALT_SIZE).hex()
+    if algorithm == KDF_PBKDF2:
+        return {KDF_ALGORITHM_KEY: KDF_PBKDF2, KDF_SALT_KEY: salt, KDF_ITERATIONS_KEY: cost or DEFAULT_ITERATIONS}
+    elif algorithm == KDF_SCRYPT:
+        return {KDF_ALGORITHM_KEY: KDF_SCRYPT, KDF_SALT_KEY: salt, KDF_N_KEY: cost or DEFAULT_SCRYPT_N,
+                KDF_R_KEY: DEFAULT_SCRYPT_R, KDF_P_KEY: DEFAULT_SCRYPT_P}
+    raise ValueError(f'unknown key derivation function {algorithm}')
+
+
+def is_count(value) -> bool:
+    """
+    Check that a cost parameter is an integer (bool is a subclass of int, but not a count)
+    :param value: value read from storage
+    :return: True if it's an integer
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def check_parameters(parameters: dict) -> dict:
+    """
+    Check parameters read from storage
+    :param parameters: parameters
+    :return: same parameters
+    :raise: ValueError if they are not valid or the cost is too high
+    """
+    try:
+        algorithm = parameters[KDF_ALGORITHM_KEY]
+        bytes.fromhex(parameters[KDF_SALT_KEY])
+        if algorithm == KDF_PBKDF2:
+            iterations = parameters[KDF_ITERATIONS_KEY]
+            valid = is_count(iterations) and 0 < iterations <= MAX_ITERATIONS
+        elif algorithm == KDF_SCRYPT:
+            n, r, p = parameters[KDF_N_KEY], parameters[KDF_R_KEY], parameters[KDF_P_KEY]
+            valid = all(is_count(x) for x in [n, r, p]) and 1 < n <= MAX_SCRYPT_N and n & (n - 1) == 0 \
+                and 0 < r and 0 < p and 128 * n * r <= MAX_SCRYPT_MEMORY and 128 * n * r * p <= MAX_SCRYPT_MEMORY
+        else:
+            valid = False
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'bad key derivation parameters: {repr(e)}')
+    if not valid:
+        raise ValueError(f'bad key derivation parameters {parameters}')
+    return parameters
+
+
+def describe(parameters: dict) -> str:
+    """
+    Return the parameters as a string, the same for the same parameters
+    :param parameters: parameters
+    :return: string
+    """
+    return json.dumps(parameters, sort_keys=True)
+
+
+def derive_key(password: str, parameters: dict) -> bytes:
+    """
+    Derive a Fernet key from a password
+    :param password: password
+    :param parameters: parameters
+    :return: key (base64 encoded)
+    :raise: ValueError if the parameters are not valid
+    """
+    check_parameters(parameters)
+    salt = bytes.fromhex(parameters[KDF_SALT_KEY])
+    if parameters[KDF_ALGORITHM_KEY] == KDF_PBKDF2:
+        kdf = PBKDF2HMAC(algorithm=hashes.SHA512(), length=KEY_SIZE, salt=salt,
+                         iterations=parameters[KDF_ITERATIONS_KEY])
+    else:
+        kdf = Scrypt(salt=salt, length=KEY_SIZE, n=parameters[KDF_N_KEY], r=parameters[KDF_R_KEY],
+                     p=parameters[KDF_P_KEY])
+    return base64.urlsafe_b64encode(kdf.derive(password.encode()))
+
+
+def derive_time(parameters: dict) -> float:
+    """
+    Measure the time needed to derive a key
+    :param parameters: parameters
+    :return: time in seconds
+    """
+    start = time.perf_counter()
+    derive_key('calibration', parameters)
+    return time.perf_counter() - start
+
+
+def calibrate(algorithm=DEFAULT_KDF, target_time=DEFAULT_TARGET_TIME) -> tuple[int, float]:
+    """
+    Find the cost that makes the key derivation take a given time on this machine.
+    The time grows linearly with the PBKDF2 iterations, so they are scaled from a short run.
+    The scrypt n must be a power of two, so it's doubled while the time stays below the target.
+    :param algorithm: key derivation function (see KDF_LIST)
+    :param target_time: time the derivation should take (seconds)
+    :return: cost (PBKDF2 iterations or scrypt n) and the time it takes
+    :raise: ValueError if the algorithm is unknown
+    """
+    if algorithm == KDF_PBKDF2:
+        sample = 10000
+        t = derive_time(new_parameters(KDF_PBKDF2, sample))
+        cost = min(max(sample, int(sample * target_time / t) // 1000 * 1000), MAX_ITERATIONS)
+    elif algorithm == KDF_SCRYPT:
+        cost = 1 << 10
+        t = derive_time(new_parameters(KDF_SCRYPT, cost))
+        while cost < MAX_SCRYPT_N and t * 2 <= target_time:
+            cost *= 2
+            t = derive_time(new_parameters(KDF_SCRYPT, cost))
+        return cost, t
+    else:
+        raise ValueError(f'unknown key derivation function {algorithm}')
+    return cost, derive_time(new_parameters(algorithm, cost))
+
+
+if __name__ == '__main__':
+    for kdf_algorithm in KDF_LIST:
+        kdf_cost, kdf_time = calibrate(kdf_algorithm, 0.2)
+        print(kdf_algorithm, kdf_cost, f'{kdf_time:.3f}s', new_parameters(kdf_algorithm, kdf_cost))
+    print(derive_key('test', LEGACY_PARAMETERS))
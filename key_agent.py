@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+Key agent holding the encryption keys derived from passwords during a session.
+
+Deriving a key from a password is deliberately slow (see Crypt.generate_crypt_key()), and it's
+done every time a database is opened. The agent is a separate process that keeps the keys already
+derived in memory, so the following opens get them right away instead. It's reached through a
+Unix socket named in the PW_KEY_AGENT environment variable, and it's not used if the variable
+is not set or the agent is not running. The agent stops, forgetting the keys, when it's not used
+for a while.
+
+Each key is looked up by a hash of the password and the key derivation parameters (salt included),
+so only the key derived from the same password with the same parameters is returned. The socket
+can only be used by the user that started the agent.
+
+Start the agent in the background and set the variable for the session:
+
+    python key_agent.py -s /tmp/pw_agent.sock &
+    export PW_KEY_AGENT=/tmp/pw_agent.sock
+
+Each request and response is a json object in a single line (see request()).
+"""
+import os
+import hmac
+import json
+import socket
+import hashlib
+import argparse
+import socketserver
+from typing import Optional
+
+# Environment variable with the agent socket
+KEY_AGENT_ENV = 'PW_KEY_AGENT'
+
+# Time the agent waits for a request before stopping (seconds)
+DEFAULT_IDLE_TIMEOUT = 900.0
+
+# Time a client waits for the agent (seconds)
+CLIENT_TIMEOUT = 1.0
+
+# Maximum size of a request or response
+MAX_MESSAGE_SIZE = 4096
+
+# Request operations and keys
+AGENT_OP_KEY = 'op'
+AGENT_ID_KEY = 'id'
+AGENT_KEY_KEY = 'key'
+AGENT_OK_KEY = 'ok'
+OP_GET = 'get'
+OP_PUT = 'put'
+OP_CLEAR = 'clear'
+OP_STOP = 'stop'
+
+
+def key_id(password: str, parameters: str) -> str:
+    """
+    Return the id used to look up a key in the agent
+    :param password: password the key is derived from
+    :param parameters: key derivation parameters, salt included
+    :return: key id
+    """
+    return hmac.new(parameters.encode(), password.encode(), hashlib.sha256).hexdigest()
+
+
+def agent_socket() -> Optional[str]:
+    """
+    Return the socket of the agent used in this session
+    :return: socket file name (None if no agent is used)
+    """
+    return os.environ.get(KEY_AGENT_ENV) or None
+
+
+def request(message: dict, socket_name: Optional[str] = None) -> Optional[dict]:
+    """
+    Send a request to the agent and return the response
+    :param message: request
+    :param socket_name: agent socket (the one in the environment if not specified)
+    :return: response (None if there is no agent or it didn't respond)
+    """
+    socket_name = socket_name or agent_socket()
+    if socket_name is None or not hasattr(socket, 'AF_UNIX'):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(CLIENT_TIMEOUT)
+            s.connect(socket_name)
+            s.sendall(json.dumps(message).encode() + b'\n')
+            with s.makefile('rb') as f:
+                return json.loads(f.readline(MAX_MESSAGE_SIZE))
+    except (OSError, ValueError):
+        return None
+
+
+def get_key(password: str, parameters: str) -> Optional[bytes]:
+    """
+    Return a key held by the agent
+    :param password: password the key is derived from
+    :param parameters: key derivation parameters, salt included
+    :return: key (None if the agent doesn't have it)
+    """
+    response = request({AGENT_OP_KEY: OP_GET, AGENT_ID_KEY: key_id(password, parameters)})
+    key = None if response is None else response.get(AGENT_KEY_KEY)
+    return None if key is None else key.encode()
+
+
+def put_key(password: str, parameters: str, key: bytes):
+    """
+    Give a key to the agent, if there is one
+    :param password: password the key is derived from
+    :param parameters: key derivation parameters, salt included
+    :param key: key
+    """
+    request({AGENT_OP_KEY: OP_PUT, AGENT_ID_KEY: key_id(password, parameters), AGENT_KEY_KEY: key.decode()})
+
+
+class KeyAgentHandler(socketserver.StreamRequestHandler):
+    """
+    Serve a single request
+    """
+
+    def handle(self):
+        server = self.server
+        assert isinstance(server, KeyAgent)
+        try:
+            message = json.loads(self.rfile.readline(MAX_MESSAGE_SIZE))
+            op = message[AGENT_OP_KEY]
+            if op == OP_GET:
+                response = {AGENT_KEY_KEY: server.keys.get(message[AGENT_ID_KEY])}
+            elif op == OP_PUT:
+                server.keys[message[AGENT_ID_KEY]] = message[AGENT_KEY_KEY]
+                response = {AGENT_OK_KEY: True}
+            elif op == OP_CLEAR:
+                server.keys.clear()
+                response = {AGENT_OK_KEY: True}
+            elif op == OP_STOP:
+                server.running = False
+                response = {AGENT_OK_KEY: True}
+            else:
+                response = {AGENT_OK_KEY: False}
+        except (KeyError, TypeError, ValueError):
+            response = {AGENT_OK_KEY: False}
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class KeyAgent(socketserver.UnixStreamServer):
+    """
+    Agent process. Requests are served one at a time until the agent is idle for too long.
+
+        agent = KeyAgent('/tmp/pw_agent.sock')
+        agent.serve()
+    """
+
+    def __init__(self, socket_name: str, idle_timeout: Optional[float] = DEFAULT_IDLE_TIMEOUT):
+        """
+        :param socket_name: socket file name
+        :param idle_timeout: time to wait for a request before stopping (forever if None)
+        :raise: OSError if the socket cannot be created
+        """
+        # Keys, by id (see key_id())
+        self.keys: dict[str, str] = {}
+        self.running = True
+        # Only the owner can use the socket
+        mask = os.umask(0o177)
+        try:
+            super().__init__(socket_name, KeyAgentHandler)
+        finally:
+            os.umask(mask)
+        self.timeout = idle_timeout
+
+    def handle_timeout(self):
+        """
+        Stop when no request arrived in time
+        """
+        self.running = False
+
+    def serve(self):
+        """
+        Serve requests until the agent is stopped or idle for too long.
+        The keys are forgotten and the socket is removed when it stops.
+        """
+        try:
+            while self.running:
+                self.handle_request()
+        finally:
+            self.keys.clear()
+            self.server_close()
+            os.remove(self.server_address)
+
+
+if __name__ == '__main__':
+
+    # Process command line arguments
+    parser = argparse.ArgumentParser(description='Key agent')
+    parser.add_argument('-s', dest='socket_name', default=agent_socket(),
+                        help=f'Socket file name (default: ${KEY_AGENT_ENV})')
+    parser.add_argument('-t', dest='timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Idle time before stopping (seconds)')
+    parser.add_argument('-c', dest='command', choices=[OP_CLEAR, OP_STOP],
+                        help='Tell a running agent to forget the keys or to stop')
+    args = parser.parse_args()
+
+    if args.socket_name is None:
+        parser.error(f'no socket specified, and ${KEY_AGENT_ENV} is not set')
+    if args.command:
+        if request({AGENT_OP_KEY: args.command}, args.socket_name) is None:
+            print(f'no agent running on {args.socket_name}')
+    else:
+        KeyAgent(args.socket_name, args.timeout).serve()
@@ -13,6 +13,10 @@ class Tid(Enum):
     WRITE = auto()
     EXPORT = auto()
     DUMP = auto()
+    COMPACT = auto()
+    VERIFY = auto()
+    CALIBRATE = auto()
+    RESTORE = auto()
     # subcommands
     LIST = auto()
     SEARCH = auto()
@@ -43,6 +47,14 @@ class Tid(Enum):
     SW_TAG = auto()
     SW_NOTE = auto()
     SW_MULTILINE_NOTE = auto()  # multiline note
+    SW_JOURNAL = auto()
+    SW_BINARY = auto()
+    SW_LAZY = auto()
+    SW_COMPRESS = auto()
+    SW_DURABILITY = auto()
+    SW_ENGINE = auto()
+    SW_READ_ONLY = auto()
+    SW_CIPHER = auto()
     # error
     INVALID = auto()
 
@@ -56,7 +68,8 @@ class LexState(Enum):
 
 # Token classes
 LEX_ACTIONS = [Tid.ITEM, Tid.FIELD, Tid.TAG]
-LEX_DATABASE = [Tid.NEW, Tid.READ, Tid.WRITE, Tid.EXPORT, Tid.DUMP]
+LEX_DATABASE = [Tid.NEW, Tid.READ, Tid.WRITE, Tid.EXPORT, Tid.DUMP, Tid.COMPACT, Tid.VERIFY, Tid.RESTORE,
+                Tid.CALIBRATE]
 LEX_SUBCOMMANDS = [Tid.LIST, Tid.PRINT, Tid.DUMP, Tid.COUNT, Tid.SEARCH,
                    Tid.RENAME, Tid.DELETE,
                    Tid.CREATE, Tid.COPY, Tid.ADD, Tid.EDIT]
@@ -117,7 +130,8 @@ class Lexer:
         self.keywords = {
             'item': Tid.ITEM, 'field': Tid.FIELD, 'tag': Tid.TAG,
             'new': Tid.NEW, 'read': Tid.READ, 'write': Tid.WRITE,
-            'export': Tid.EXPORT, 'print': Tid.PRINT, 'dump': Tid.DUMP,
+            'export': Tid.EXPORT, 'print': Tid.PRINT, 'dump': Tid.DUMP, 'compact': Tid.COMPACT,
+            'verify': Tid.VERIFY, 'restore': Tid.RESTORE, 'calibrate': Tid.CALIBRATE,
             'list': Tid.LIST, 'count': Tid.COUNT, 'search': Tid.SEARCH,
             'create': Tid.CREATE, 'copy': Tid.COPY, 'add': Tid.ADD, 'edit': Tid.EDIT,
             'ren': Tid.RENAME, 'del': Tid.DELETE,
@@ -132,7 +146,15 @@ class Lexer:
             '-fd': Tid.SW_FIELD_DELETE,
             '-fv': Tid.SW_FIELD_VALUE,
             '-note': Tid.SW_NOTE,
-            '-ml': Tid.SW_MULTILINE_NOTE
+            '-ml': Tid.SW_MULTILINE_NOTE,
+            '-j': Tid.SW_JOURNAL,
+            '-b': Tid.SW_BINARY,
+            '-l': Tid.SW_LAZY,
+            '-z': Tid.SW_COMPRESS,
+            '-d': Tid.SW_DURABILITY,
+            '-e': Tid.SW_ENGINE,
+            '-ro': Tid.SW_READ_ONLY,
+            '-c': Tid.SW_CIPHER
         }
 
     def input(self, command: str):
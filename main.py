@@ -9,6 +9,8 @@ class CommandInterpreter(Cmd):
     def __init__(self, p: Parser):
         super().__init__()
         self.parser = p
+        # Keep the journal compacted while the session is open
+        self.parser.cp.background_compaction = True
 
     # ignore eof (ctrl-d)
     def do_EOF(self, _) -> bool:
@@ -0,0 +1,56 @@
+"""
+Three-way merge of the changes made to a database by two processes.
+
+Each process starts from the version it read (the base). When the stored version was
+written by another process in the meantime (theirs), the changes made in memory (ours)
+are merged with it instead of overwriting it. The items are compared by uid using their
+hashes (see digest.py), and the tag and field tables entry by entry, so the changes made to
+different items never conflict. Only the entries changed on both sides in different ways
+are reported as conflicts.
+"""
+from collections import Counter
+from typing import Iterable
+
+
+def merge_entries(base: dict, ours: dict, theirs: dict) -> tuple[dict, list, list]:
+    """
+    Merge two versions of a set of entries derived from the same base version.
+    An entry is missing from a version if it doesn't exist there (it was removed or never added).
+    Entries with the same key added on both sides with different values are not conflicts,
+    since each side can be given its own key.
+    :param base: value of each entry in the base version, by key
+    :param ours: value of each entry in our version, by key
+    :param theirs: value of each entry in their version, by key
+    :return: their changes to apply to our version, by key (None for removed entries),
+             keys of the entries added on both sides, and keys of the conflicting entries
+    """
+    changes: dict = {}
+    added = []
+    conflicts = []
+    for key in ours.keys() | theirs.keys() | base.keys():
+        b, o, t = base.get(key), ours.get(key), theirs.get(key)
+        if o == t or t == b:
+            continue
+        if o == b:
+            changes[key] = t
+        elif b is None and o is not None and t is not None:
+            added.append(key)
+        else:
+            conflicts.append(key)
+    return changes, sorted(added), sorted(conflicts)
+
+
+def duplicate_names(entries: Iterable[dict], name_key: str) -> list[str]:
+    """
+    Return the names used by more than one entry of a table
+    :param entries: table entries
+    :param name_key: key of the name in each entry
+    :return: names used more than once, sorted
+    """
+    names = Counter(entry[name_key] for entry in entries)
+    return sorted(name for name, n in names.items() if n > 1)
+
+
+if __name__ == '__main__':
+    print(merge_entries({1: 'a', 2: 'b', 3: 'c'}, {1: 'x', 2: 'b', 3: 'y', 4: 'o'}, {1: 'a', 2: 'z', 3: 'w', 4: 't'}))
+    print(duplicate_names([{'name': 'web'}, {'name': 'web'}, {'name': 'mail'}], 'name'))
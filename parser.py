@@ -1,4 +1,10 @@
-from db import DEFAULT_DATABASE_NAME
+from db import DEFAULT_DATABASE_NAME, ENGINES
+from common import FORMAT_BINARY
+from compression import CODEC_LIST
+from durable import DURABILITY_LIST, DEFAULT_DURABILITY
+from storage import ENGINE_FILE
+from kdf import KDF_LIST, DEFAULT_KDF, DEFAULT_TARGET_TIME
+from crypt import CIPHER_LIST
 from command import CommandProcessor
 from lexer import Lexer, Token, Tid, LEX_ACTIONS, LEX_SUBCOMMANDS, LEX_DATABASE, LEX_MISC, LEX_VALUES, LEX_STRINGS
 from utils import trace, trace_toggle
@@ -7,6 +13,13 @@ from utils import trace, trace_toggle
 ERROR_UNKNOWN_COMMAND = 'unknown command'
 ERROR_UNKNOWN_SUBCOMMAND = 'unknown subcommand'
 ERROR_BAD_FILENAME = 'bad file name'
+ERROR_BAD_CODEC = 'bad compression codec'
+ERROR_BAD_DURABILITY = 'bad durability level'
+ERROR_BAD_ENGINE = 'bad storage engine'
+ERROR_BAD_TIMESTAMP = 'bad backup time stamp'
+ERROR_BAD_KDF = 'bad key derivation function'
+ERROR_BAD_TIME = 'bad time'
+ERROR_BAD_CIPHER = 'bad cipher'
 
 
 class Parser:
@@ -325,11 +338,17 @@ class Parser:
 
     def database_commands(self, token: Token):
         """
-        database_commands: NEW [file_name] |
-                           READ [file_name] |
+        database_commands: NEW [file_name] [SW_JOURNAL] [SW_BINARY] [SW_COMPRESS codec [level]]
+                               [SW_DURABILITY level] [SW_ENGINE engine] [SW_CIPHER cipher] |
+                           READ [file_name] [SW_JOURNAL] [SW_BINARY] [SW_LAZY] [SW_COMPRESS codec [level]]
+                                [SW_DURABILITY level] [SW_ENGINE engine] [SW_READ_ONLY] |
                            WRITE |
                            EXPORT file_name |
-                           DUMP
+                           DUMP |
+                           COMPACT |
+                           VERIFY |
+                           RESTORE [time_stamp] |
+                           CALIBRATE [algorithm] [time]
         :param token: next token
         """
         trace('database_command', token)
@@ -337,22 +356,78 @@ class Parser:
 
             # Get file name
             tok = self.get_token()
-            if tok.tid == Tid.EOS:
-                file_name = DEFAULT_DATABASE_NAME
-                trace('no file name', file_name)
-            elif tok.tid == Tid.FILE:
+            if tok.tid == Tid.FILE:
                 file_name = tok.value
                 trace('file name', file_name)
+                tok = self.get_token()
             else:
-                self.error(ERROR_BAD_FILENAME, token)
-                return
+                file_name = DEFAULT_DATABASE_NAME
+                trace('no file name', file_name)
+
+            # Get options
+            journal_flag = False
+            file_format = None
+            lazy_flag = False
+            read_only_flag = False
+            codec = None
+            level = None
+            durability = DEFAULT_DURABILITY
+            engine = ENGINE_FILE
+            cipher = None
+            while tok.tid != Tid.EOS:
+                if tok.tid == Tid.SW_JOURNAL:
+                    journal_flag = True
+                elif tok.tid == Tid.SW_BINARY:
+                    file_format = FORMAT_BINARY
+                elif tok.tid == Tid.SW_LAZY and token.tid == Tid.READ:
+                    lazy_flag = True
+                elif tok.tid == Tid.SW_READ_ONLY and token.tid == Tid.READ:
+                    read_only_flag = True
+                elif tok.tid == Tid.SW_COMPRESS:
+                    tok = self.get_token()
+                    if tok.tid != Tid.NAME or tok.value not in CODEC_LIST:
+                        self.error(ERROR_BAD_CODEC, tok)
+                        return
+                    codec = tok.value
+                    # The level is optional
+                    tok = self.get_token()
+                    if tok.tid == Tid.VALUE and isinstance(tok.value, int):
+                        level = tok.value
+                    else:
+                        continue
+                elif tok.tid == Tid.SW_DURABILITY:
+                    tok = self.get_token()
+                    if tok.tid != Tid.NAME or tok.value not in DURABILITY_LIST:
+                        self.error(ERROR_BAD_DURABILITY, tok)
+                        return
+                    durability = tok.value
+                elif tok.tid == Tid.SW_ENGINE:
+                    tok = self.get_token()
+                    if tok.tid != Tid.NAME or tok.value not in ENGINES:
+                        self.error(ERROR_BAD_ENGINE, tok)
+                        return
+                    engine = tok.value
+                elif tok.tid == Tid.SW_CIPHER and token.tid == Tid.NEW:
+                    tok = self.get_token()
+                    if tok.tid != Tid.NAME or tok.value not in CIPHER_LIST:
+                        self.error(ERROR_BAD_CIPHER, tok)
+                        return
+                    cipher = tok.value
+                else:
+                    self.error(ERROR_BAD_FILENAME, tok)
+                    return
+                tok = self.get_token()
 
             # Run command
             if token.tid == Tid.READ:
-                trace('read', file_name)
-                self.cp.database_read(file_name)
+                trace('read', file_name, journal_flag)
+                self.cp.database_read(file_name, journal=journal_flag, file_format=file_format, lazy=lazy_flag,
+                                      codec=codec, level=level, durability=durability, engine=engine,
+                                      read_only=read_only_flag)
             elif token.tid == Tid.NEW:
-                self.cp.database_create(file_name)
+                self.cp.database_create(file_name, journal=journal_flag, file_format=file_format,
+                                        codec=codec, level=level, durability=durability, engine=engine,
+                                        cipher=cipher)
             else:
                 self.error(ERROR_UNKNOWN_COMMAND, token)  # should never get here
 
@@ -370,6 +445,38 @@ class Parser:
 
         elif token.tid == Tid.DUMP:
             self.cp.database_dump()
+        elif token.tid == Tid.COMPACT:
+            self.cp.database_compact()
+        elif token.tid == Tid.VERIFY:
+            self.cp.database_verify()
+        elif token.tid == Tid.RESTORE:
+            tok = self.get_token()
+            trace('restore', tok)
+            if tok.tid == Tid.EOS:
+                self.cp.database_restore()
+            elif tok.tid == Tid.VALUE and isinstance(tok.value, int):
+                self.cp.database_restore(str(tok.value))
+            else:
+                self.error(ERROR_BAD_TIMESTAMP, tok)
+        elif token.tid == Tid.CALIBRATE:
+            # Key derivation function and target time in milliseconds, both optional
+            algorithm = DEFAULT_KDF
+            target_time = DEFAULT_TARGET_TIME
+            tok = self.get_token()
+            trace('calibrate', tok)
+            if tok.tid == Tid.NAME:
+                if tok.value not in KDF_LIST:
+                    self.error(ERROR_BAD_KDF, tok)
+                    return
+                algorithm = tok.value
+                tok = self.get_token()
+            if tok.tid == Tid.VALUE and isinstance(tok.value, int) and tok.value > 0:
+                target_time = tok.value / 1000
+                tok = self.get_token()
+            if tok.tid != Tid.EOS:
+                self.error(ERROR_BAD_TIME, tok)
+                return
+            self.cp.database_calibrate(algorithm, target_time)
         else:
             self.error(ERROR_UNKNOWN_COMMAND, token)  # should never get here
 
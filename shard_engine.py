@@ -0,0 +1,292 @@
+"""
+Sharded storage engine. The items are partitioned by uid into a fixed number of shard files,
+and a manifest file (the database file) holds the tag and field tables and the list of shards:
+
+    {"tags": [...], "fields": [...], "generation": "...", "hash": "...", "counts": {...},
+     "shards": [{"file": "pw.db.shard-000.<generation>", "count": 12}, ...]}
+
+Each shard holds the items whose uid modulo the number of shards is its position in the list,
+and their hashes (see digest.py), in json format, compressed and encrypted in chunks in the
+same way as the database file.
+
+Shard files are never modified: a shard is written to a new file named after the generation
+that wrote it, and the manifest that refers to it replaces the old one in a single step, so
+a crash leaves either the old or the new version. Files no longer referenced are then removed.
+write() only writes the shards holding the items changed since the last read or write
+(see Database.record()), and the shards are decrypted and parsed by a pool of processes
+when reading.
+"""
+import os
+import json
+from glob import glob, escape
+from uuid import uuid4
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from os.path import exists, basename, dirname, join
+from typing import Iterable, Optional
+from common import ITEM_UID_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, DB_HASH_KEY, DB_COUNTS_KEY
+from common import DB_DIGESTS_KEY
+from crypt import Crypt
+from digest import item_digest, decode_digests
+from journal import RECORD_OP_KEY, RECORD_DATA_KEY, OP_ITEM_PUT, OP_ITEM_DELETE
+from compression import CODEC_NONE, compress, decompress
+from crypt_stream import encrypt_chunks, decrypt_chunks, is_chunked
+from durable import AtomicFile
+from storage import StorageEngine, ENGINE_SHARD
+
+# Manifest keys
+MANIFEST_SHARDS_KEY = 'shards'
+SHARD_FILE_KEY = 'file'
+SHARD_COUNT_KEY = 'count'
+
+# Shard file names are the database file name followed by the shard number and the generation
+SHARD_INFIX = '.shard-'
+
+# Number of shards of a new database
+DEFAULT_SHARDS = 16
+
+# Number of processes used to read the shards
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def shard_file_name(file_name: str, n: int, generation: str) -> str:
+    """
+    Return the name of a shard file
+    :param file_name: database file name
+    :param n: shard number
+    :param generation: generation that wrote the shard
+    :return: shard file name
+    """
+    return f'{file_name}{SHARD_INFIX}{n:03d}.{generation}'
+
+
+def encode_data(json_data: dict, crypt: Optional[Crypt] = None, codec: Optional[str] = None,
+                level: Optional[int] = None) -> bytes:
+    """
+    Encode a dictionary in json, compress it and encrypt it in chunks
+    :param json_data: dictionary
+    :param crypt: encryption key (optional)
+    :param codec: compression codec (optional)
+    :param level: compression level (optional)
+    :return: file contents
+    """
+    data = compress(json.dumps(json_data).encode(), codec or CODEC_NONE, level)
+    return data if crypt is None else encrypt_chunks(crypt, data)
+
+
+def read_data(file_name: str, crypt: Optional[Crypt] = None) -> dict:
+    """
+    Read a file written with encode_data(). Called by the processes reading the shards.
+    :param file_name: file name
+    :param crypt: decryption key (optional)
+    :return: dictionary
+    :raise FileNotFoundError, ValueError
+    """
+    with open(file_name, 'rb') as f_in:
+        data = f_in.read()
+    f_in.close()
+    try:
+        if crypt is not None:
+            data = decrypt_chunks(crypt, data) if is_chunked(data) else crypt.decrypt_byte2byte(data)
+        return json.loads(decompress(data))
+    except Exception as e:
+        raise ValueError(f'failed to read {basename(file_name)}: {repr(e)}')
+
+
+class ShardEngine(StorageEngine):
+
+    name = ENGINE_SHARD
+
+    def __init__(self, db):
+        """
+        :param db: database using the engine
+        """
+        super().__init__(db)
+        # Number of shards (taken from the manifest when reading)
+        self.shard_count = DEFAULT_SHARDS
+        # Number of processes used to read the shards
+        self.workers = DEFAULT_WORKERS
+        # Shard list of the manifest last read or written
+        self.shard_list: Optional[list[dict]] = None
+
+    def exists(self) -> bool:
+        """
+        Check whether the manifest file exists
+        :return: True if it does, False otherwise
+        """
+        return exists(self.db.file_name)
+
+    def shard_path(self, shard: dict) -> str:
+        """
+        Return the path of a shard file, which is in the same directory as the manifest
+        :param shard: shard entry of the manifest
+        :return: path
+        """
+        return join(dirname(self.db.file_name), shard[SHARD_FILE_KEY])
+
+    def read_shards(self) -> tuple[dict, list[dict]]:
+        """
+        Read the manifest and all the shards. Several shards are read in parallel by a pool of processes.
+        :return: manifest and contents of each shard (items and item hashes)
+        :raise FileNotFoundError, ValueError
+        """
+        manifest = read_data(self.db.file_name, self.db.crypt_key)
+        file_list = [self.shard_path(x) for x in manifest[MANIFEST_SHARDS_KEY]]
+        if self.workers > 1 and len(file_list) > 1:
+            with ProcessPoolExecutor(min(self.workers, len(file_list))) as executor:
+                shard_list = list(executor.map(read_data, file_list, repeat(self.db.crypt_key)))
+        else:
+            shard_list = [read_data(x, self.db.crypt_key) for x in file_list]
+        return manifest, shard_list
+
+    def read(self, lazy=False, stream=True):
+        """
+        Read the database from the manifest and the shard files
+        :param lazy: ignored (all the items are read)
+        :param stream: ignored (each shard is read at once)
+        :raise FileNotFoundError, ValueError
+        """
+        with self.db.lock:
+            manifest, shard_list = self.read_shards()
+            self.db.content_hash = manifest.get(DB_HASH_KEY)
+            self.db.read_tables(manifest[DB_TAGS_KEY], manifest[DB_FIELDS_KEY])
+            try:
+                self.db.digest_cache = {}
+                for shard in shard_list:
+                    for item_uid, json_item in shard[DB_ITEMS_KEY].items():
+                        uid = int(item_uid)
+                        self.db.add_item_uid(uid)
+                        self.db.item_collection.add(self.db.item_from_dict(json_item, uid))
+                    self.db.digest_cache.update(decode_digests(shard.get(DB_DIGESTS_KEY)))
+                if not self.db.apply_counts(manifest.get(DB_COUNTS_KEY), manifest.get(DB_GENERATION_KEY)):
+                    self.db.count_items()
+            except Exception as e:
+                self.db.clear()
+                raise ValueError(f'failed to read items: {repr(e)}')
+            self.shard_list = manifest[MANIFEST_SHARDS_KEY]
+            self.shard_count = len(self.shard_list)
+            self.db.pending_records = []
+
+    def load(self) -> dict:
+        """
+        Return the dictionary representation of the stored database
+        :return: database dictionary
+        :raise FileNotFoundError, ValueError
+        """
+        manifest, shard_list = self.read_shards()
+        json_data = {key: manifest[key] for key in [DB_TAGS_KEY, DB_FIELDS_KEY, DB_GENERATION_KEY, DB_HASH_KEY]}
+        json_data[DB_ITEMS_KEY], json_data[DB_DIGESTS_KEY] = {}, {}
+        for shard in shard_list:
+            json_data[DB_ITEMS_KEY].update(shard[DB_ITEMS_KEY])
+            json_data[DB_DIGESTS_KEY].update(shard.get(DB_DIGESTS_KEY, {}))
+        return json_data
+
+    def store(self, tag_list: list, field_list: list, items: Iterable[tuple[int, dict]], shard_set: set[int],
+              content_hash: Optional[str], digests: dict[int, bytes], counts=False):
+        """
+        Write some shards and a new manifest that refers to them and to the rest of the current shards.
+        The shard files that are no longer referenced are removed afterwards.
+        :param tag_list: tag table
+        :param field_list: field table
+        :param items: uid and dictionary of every item in the shards to write
+        :param shard_set: shards to write
+        :param content_hash: hash of the contents (None if unknown)
+        :param digests: known item hashes, by uid (the rest are computed)
+        :param counts: store the table counters? (only when writing the current contents)
+        """
+        generation = uuid4().hex
+        shard_items = {n: {} for n in shard_set}
+        shard_digests = {n: {} for n in shard_set}
+        for uid, json_item in items:
+            n = int(uid) % self.shard_count
+            shard_items[n][str(uid)] = json_item
+            shard_digests[n][str(uid)] = (digests.get(int(uid)) or item_digest(json_item)).hex()
+
+        shard_list = list(self.shard_list or [{} for _ in range(self.shard_count)])
+        for n in sorted(shard_set):
+            file_name = shard_file_name(self.db.file_name, n, generation)
+            with AtomicFile(file_name, self.db.durability) as f_out:
+                f_out.write(encode_data({DB_ITEMS_KEY: shard_items[n], DB_DIGESTS_KEY: shard_digests[n]},
+                                        self.db.crypt_key, self.db.codec, self.db.level))
+                f_out.commit()
+            shard_list[n] = {SHARD_FILE_KEY: basename(file_name), SHARD_COUNT_KEY: len(shard_items[n])}
+
+        manifest = {DB_TAGS_KEY: tag_list, DB_FIELDS_KEY: field_list, DB_GENERATION_KEY: generation,
+                    DB_HASH_KEY: content_hash, MANIFEST_SHARDS_KEY: shard_list}
+        if counts:
+            manifest[DB_COUNTS_KEY] = self.db.counts(generation)
+        with AtomicFile(self.db.file_name, self.db.durability) as f_out:
+            f_out.write(encode_data(manifest, self.db.crypt_key, self.db.codec, self.db.level))
+            f_out.commit()
+        self.shard_list = shard_list
+
+        # Remove the shards replaced, and any left behind by an interrupted write
+        referenced = {x[SHARD_FILE_KEY] for x in shard_list}
+        for file_name in glob(f'{escape(self.db.file_name)}{SHARD_INFIX}*'):
+            if basename(file_name) not in referenced:
+                os.remove(file_name)
+
+    def save(self, json_data: Optional[dict] = None, force=False) -> bool:
+        """
+        Write all the shards and the manifest. When no dictionary is supplied, the current
+        database contents are written.
+        :param json_data: database dictionary (optional)
+        :param force: write the files even if the contents didn't change?
+        :return: True if the files were written, False otherwise
+        """
+        with self.db.lock:
+            digests = self.db.item_digests(json_data)
+            content_hash = self.db.digest(json_data, digests)
+            if not force and content_hash == self.db.content_hash and self.exists():
+                if json_data is None:
+                    self.db.pending_records = []
+                return False
+            if json_data is None:
+                tag_list, field_list = self.db.tag_table.export(), self.db.field_table.export()
+                items = self.db.item_collection.next_export()
+            else:
+                tag_list, field_list = json_data[DB_TAGS_KEY], json_data[DB_FIELDS_KEY]
+                items = json_data[DB_ITEMS_KEY].items()
+            self.shard_list = None
+            self.store(tag_list, field_list, items, set(range(self.shard_count)), content_hash, digests,
+                       json_data is None)
+            self.db.content_hash = content_hash
+            if json_data is None:
+                self.db.digest_cache = digests
+                # The changes not written yet are included, now they are stored
+                self.db.pending_records = []
+            return True
+
+    def write(self, snapshot=False) -> Optional[bool]:
+        """
+        Write the shards holding the items changed since the last read or write, and the manifest.
+        All the shards must be written if a snapshot is requested or nothing was written yet.
+        The content hash is not computed for the changes, so it's removed.
+        :param snapshot: write all the shards?
+        :return: True if anything was written, False otherwise, None if all the shards must be written
+        """
+        with self.db.lock:
+            if not snapshot and self.shard_list is not None and self.exists():
+                if not self.db.pending_records:
+                    return False
+                shard_set = {int(x[RECORD_DATA_KEY][ITEM_UID_KEY]) % self.shard_count for x in self.db.pending_records
+                             if x[RECORD_OP_KEY] in [OP_ITEM_PUT, OP_ITEM_DELETE]}
+                collection = self.db.item_collection
+                items = ((uid, collection.get(uid).export()) for uid in collection.keys()
+                         if uid % self.shard_count in shard_set)
+                self.store(self.db.tag_table.export(), self.db.field_table.export(), items, shard_set, None,
+                           self.db.digest_cache, True)
+                self.db.pending_records = []
+                self.db.content_hash = None
+                return True
+        return None
+
+
+if __name__ == '__main__':
+    from db import Database
+    from testing import random_database
+    database = Database('shard.db', engine=ENGINE_SHARD)
+    random_database(database, 100)
+    database.write()
+    print(database.engine.shard_list)
@@ -0,0 +1,510 @@
+"""
+SQLite storage engine. Tags, fields, items and item fields are kept in tables of a
+local SQLite database, so a change to an item is stored by updating the rows of that
+item in a single transaction instead of rewriting the whole database.
+
+    meta            key, value (password check, key derivation parameters, content hash)
+    tags            uid, name
+    fields          uid, name, sensitive
+    items           uid, name, note, timestamp, digest
+    item_tags       item uid, position, tag uid
+    item_fields     item uid, position, name, value, sensitive
+
+Field values are stored in json, so their type is preserved. Sensitive values are stored
+encrypted, as they are kept in memory, but the rest of the database is not encrypted.
+AES-GCM tokens (see crypt.py) are stored as raw bytes instead, in a BLOB (schema version 3).
+When a password is supplied, a value encrypted with it is stored to check it when reading.
+The hash of each item (see digest.py) is stored in its row when the item is stored.
+
+The changes recorded since the last read or write (see Database.record()) are applied
+to the tables by write(). Item searches on the name, note, tags and field names are run
+in SQL (see search()), so lazily read items don't need to be created to be searched.
+"""
+import re
+import json
+import sqlite3
+from collections import defaultdict
+from os.path import exists
+from typing import Generator, Optional
+from common import KEY_NAME, KEY_UID
+from common import FIELD_NAME_KEY, FIELD_VALUE_KEY, FIELD_SENSITIVE_KEY, FIELD_UID_KEY
+from common import ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_UID_KEY, ITEM_FIELDS_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_HASH_KEY, DB_DIGESTS_KEY
+from items import LazyItemCollection
+from uid import ItemUid
+from digest import item_digest, encode_digests
+from kdf import LEGACY_PARAMETERS, check_parameters
+from crypt import is_aead_token, aead_token_to_bytes, aead_token_from_bytes
+from journal import RENAME_OLD_KEY, RECORD_OP_KEY, RECORD_DATA_KEY
+from journal import OP_TAG_ADD, OP_TAG_RENAME, OP_TAG_DELETE, OP_FIELD_ADD, OP_FIELD_DELETE, OP_ITEM_PUT, OP_ITEM_DELETE
+from durable import DURABILITY_NONE, DURABILITY_FILE, DURABILITY_FULL
+from storage import StorageEngine, ENGINE_SQLITE
+
+# Schema version stored in the meta table (version 1 has no item hashes, version 2 has no AES-GCM tokens)
+SCHEMA_VERSION = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tags (uid INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS fields (uid INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, sensitive INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS items (uid INTEGER PRIMARY KEY, name TEXT NOT NULL, note TEXT NOT NULL,
+                                  timestamp INTEGER NOT NULL, digest TEXT);
+CREATE TABLE IF NOT EXISTS item_tags (item_uid INTEGER NOT NULL, position INTEGER NOT NULL, tag_uid INTEGER NOT NULL,
+                                      PRIMARY KEY (item_uid, position));
+CREATE TABLE IF NOT EXISTS item_fields (item_uid INTEGER NOT NULL, position INTEGER NOT NULL, name TEXT NOT NULL,
+                                        value TEXT NOT NULL, sensitive INTEGER NOT NULL,
+                                        PRIMARY KEY (item_uid, position));
+CREATE INDEX IF NOT EXISTS item_tags_tag ON item_tags (tag_uid);
+CREATE INDEX IF NOT EXISTS item_fields_name ON item_fields (name);
+'''
+
+# Maximum number of values in a single IN (...) clause
+MAX_PARAMETERS = 500
+
+# Meta table keys
+META_VERSION = 'version'
+META_CHECK = 'check'
+META_KDF = 'kdf'
+META_HASH = DB_HASH_KEY
+
+# Value encrypted with the password to check it when reading
+CHECK_TEXT = 'password check'
+
+# SQLite synchronous setting for each durability level
+SYNCHRONOUS = {DURABILITY_NONE: 'OFF', DURABILITY_FILE: 'NORMAL', DURABILITY_FULL: 'FULL'}
+
+
+def regexp(pattern: str, value) -> bool:
+    """
+    Implementation of the SQL REGEXP operator (value REGEXP pattern). Matches are case-insensitive,
+    as in Database.search().
+    :param pattern: regular expression
+    :param value: column value
+    :return: True if the value matches, False otherwise
+    """
+    return value is not None and re.search(pattern, str(value), flags=re.IGNORECASE) is not None
+
+
+def encode_value(value: str | int | float) -> str | bytes:
+    """
+    Convert a field value to the form stored in the item_fields table
+    :param value: field value
+    :return: value in json, or raw bytes for an AES-GCM token
+    """
+    return aead_token_to_bytes(value) if is_aead_token(value) else json.dumps(value)
+
+
+def decode_value(value: str | bytes) -> str | int | float:
+    """
+    Convert a value stored in the item_fields table back to a field value (see encode_value())
+    :param value: stored value
+    :return: field value
+    """
+    return aead_token_from_bytes(value) if isinstance(value, bytes) else json.loads(value)
+
+
+class SqliteEngine(StorageEngine):
+
+    name = ENGINE_SQLITE
+
+    def __init__(self, db):
+        """
+        :param db: database using the engine
+        """
+        super().__init__(db)
+        self.connection: Optional[sqlite3.Connection] = None
+
+    def exists(self) -> bool:
+        """
+        Check whether the SQLite file exists
+        :return: True if it does, False otherwise
+        """
+        return exists(self.db.file_name)
+
+    def connect(self, create=False) -> sqlite3.Connection:
+        """
+        Return the connection to the SQLite file, opening it the first time
+        :param create: create the file and the tables if the file does not exist?
+        :return: connection
+        :raise FileNotFoundError, ValueError
+        """
+        if self.connection is None:
+            if not create and not self.exists():
+                raise FileNotFoundError(f'{self.db.file_name} does not exist')
+            try:
+                connection = sqlite3.connect(self.db.file_name, check_same_thread=False)
+                connection.create_function('REGEXP', 2, regexp, deterministic=True)
+                connection.execute('PRAGMA journal_mode = WAL')
+                connection.execute(f'PRAGMA synchronous = {SYNCHRONOUS[self.db.durability]}')
+                # Any write changes the data version seen by the other connections (see signature()),
+                # so the version is only stored when the file is created or its schema upgraded
+                with connection:
+                    if not self.db.read_only:
+                        connection.executescript(SCHEMA)
+                    row = connection.execute('SELECT value FROM meta WHERE key = ?', (META_VERSION,)).fetchone()
+                    version = SCHEMA_VERSION if row is None else int(row[0])
+                    if version > SCHEMA_VERSION:
+                        raise ValueError(f'unsupported schema version {version}')
+                    if version < 2 and self.db.read_only:
+                        raise ValueError(f'schema version {version} must be upgraded, open the database for writing')
+                    if version < 2:
+                        connection.execute('ALTER TABLE items ADD COLUMN digest TEXT')
+                    if not self.db.read_only and (row is None or version != SCHEMA_VERSION):
+                        connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (META_VERSION, SCHEMA_VERSION))
+            except sqlite3.Error as e:
+                raise ValueError(f'failed to open the database: {repr(e)}')
+            self.connection = connection
+        return self.connection
+
+    def signature(self) -> Optional[tuple]:
+        """
+        Return what identifies the stored version. SQLite changes the data version of a connection
+        when another connection commits, so the rows don't need to be compared, and the changes
+        stored through this engine don't count.
+        :return: signature (None if the file does not exist)
+        """
+        if not self.exists():
+            return None
+        return self.connect().execute('PRAGMA data_version').fetchone()[0],
+
+    def get_meta(self, key: str) -> Optional[str]:
+        """
+        Return a value from the meta table
+        :param key: key
+        :return: value (None if not found)
+        """
+        row = self.connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key: str, value: Optional[str]):
+        """
+        Set a value in the meta table. Must be called inside a transaction.
+        :param key: key
+        :param value: value (the key is removed if None)
+        """
+        if value is None:
+            self.connect().execute('DELETE FROM meta WHERE key = ?', (key,))
+        else:
+            self.connect().execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def kdf_parameters(self) -> Optional[dict]:
+        """
+        Return the parameters used to derive the encryption key, from the meta table
+        :return: parameters (the legacy ones if stored without them, None if the file does not exist)
+        :raise: ValueError if the stored parameters are not valid
+        """
+        if not self.exists():
+            return None
+        parameters = self.get_meta(META_KDF)
+        return LEGACY_PARAMETERS if parameters is None else check_parameters(json.loads(parameters))
+
+    def check_password(self):
+        """
+        Check that the password used to encrypt the sensitive values is the one supplied
+        :raise: ValueError if it's not
+        """
+        check = self.get_meta(META_CHECK)
+        if (check is None) != (self.db.crypt_key is None):
+            raise ValueError('failed to decrypt data: the password does not match')
+        if check is not None:
+            try:
+                self.db.crypt_key.decrypt_str2str(check)
+            except Exception as e:
+                raise ValueError(f'failed to decrypt data: {repr(e)}')
+
+    def next_item(self, uid: Optional[int] = None) -> Generator[tuple[int, dict], None, None]:
+        """
+        Iterate over the stored items, as dictionaries (see Item.export()), in uid order
+        :param uid: uid of the only item to return (optional)
+        :return: next item uid and item dictionary
+        """
+        connection = self.connect()
+        where, args = ('WHERE item_uid = ?', (uid,)) if uid is not None else ('', ())
+        tag_lists = defaultdict(list)
+        for item_uid, tag_uid in connection.execute(
+                f'SELECT item_uid, tag_uid FROM item_tags {where} ORDER BY item_uid, position', args):
+            tag_lists[item_uid].append(tag_uid)
+        field_dicts = defaultdict(dict)
+        for item_uid, position, name, value, sensitive in connection.execute(
+                f'SELECT item_uid, position, name, value, sensitive FROM item_fields {where} '
+                f'ORDER BY item_uid, position', args):
+            field_dicts[item_uid][str(position)] = {FIELD_NAME_KEY: name, FIELD_VALUE_KEY: decode_value(value),
+                                                    FIELD_SENSITIVE_KEY: bool(sensitive),
+                                                    FIELD_UID_KEY: str(position)}
+        where = where.replace('item_uid', 'uid')
+        for item_uid, name, note, time_stamp in connection.execute(
+                f'SELECT uid, name, note, timestamp FROM items {where} ORDER BY uid', args):
+            yield item_uid, {ITEM_NAME_KEY: name, ITEM_TAG_LIST_KEY: tag_lists[item_uid], ITEM_NOTE_KEY: note,
+                             ITEM_TIMESTAMP_KEY: time_stamp, ITEM_UID_KEY: item_uid,
+                             ITEM_FIELDS_KEY: field_dicts[item_uid]}
+
+    def read_digests(self) -> dict[int, bytes]:
+        """
+        Return the stored item hashes
+        :return: hash of each item, by uid (items stored without a hash are left out)
+        """
+        return {uid: bytes.fromhex(digest) for uid, digest in
+                self.connect().execute('SELECT uid, digest FROM items WHERE digest IS NOT NULL')}
+
+    def load_item(self, uid: int) -> dict:
+        """
+        Return a stored item
+        :param uid: item uid
+        :return: item dictionary
+        :raise: KeyError if the item is not stored
+        """
+        for _, json_item in self.next_item(uid):
+            return json_item
+        raise KeyError(f'{uid} does not exist')
+
+    def read_tables(self) -> tuple[list, list]:
+        """
+        Return the stored tag and field tables
+        :return: tag table and field table, in the same format returned by Table.export()
+        """
+        connection = self.connect()
+        tag_list = [{KEY_NAME: name, KEY_UID: uid} for uid, name in
+                    connection.execute('SELECT uid, name FROM tags ORDER BY uid')]
+        field_list = [{KEY_NAME: name, FIELD_SENSITIVE_KEY: bool(sensitive), KEY_UID: uid} for uid, name, sensitive in
+                      connection.execute('SELECT uid, name, sensitive FROM fields ORDER BY uid')]
+        return tag_list, field_list
+
+    def read(self, lazy=False, stream=True):
+        """
+        Read the database from the SQLite file.
+        In lazy mode only the tables and the item uid and names are read, and each item is created
+        the first time it's accessed. The table counters are computed in SQL from the indexes,
+        unless the items must be counted (see Database.recount).
+        :param lazy: lazy read?
+        :param stream: ignored (the rows are always read incrementally)
+        :raise FileNotFoundError, ValueError
+        """
+        with self.db.lock:
+            try:
+                self.check_password()
+                tag_list, field_list = self.read_tables()
+            except sqlite3.Error as e:
+                raise ValueError(f'failed to read the data: {repr(e)}')
+            self.db.content_hash = self.get_meta(META_HASH)
+            self.db.read_tables(tag_list, field_list)
+
+            try:
+                connection = self.connect()
+                if lazy or not self.db.recount:
+                    for uid, count in connection.execute('SELECT tag_uid, COUNT(*) FROM item_tags GROUP BY tag_uid'):
+                        if self.db.tag_table.has_uid(uid):
+                            self.db.tag_table.increment(uid=uid, n=count)
+                    for name, count in connection.execute('SELECT name, COUNT(*) FROM item_fields GROUP BY name'):
+                        if self.db.field_table.has_name(name):
+                            self.db.field_table.increment(name=name, n=count)
+                if lazy:
+                    rows = connection.execute('SELECT uid, name FROM items ORDER BY uid').fetchall()
+                    uid_list = [x for x, _ in rows]
+                    self.db.item_collection = LazyItemCollection(
+                        uid_list, lambda x: self.db.item_from_dict(self.load_item(x), x), lambda: [x for _, x in rows])
+                    if uid_list:
+                        ItemUid.reset(max(ItemUid.uid_next, uid_list[-1] + 1))
+                else:
+                    for uid, json_item in self.next_item():
+                        self.db.add_item_uid(uid)
+                        self.db.item_collection.add(self.db.item_from_dict(json_item, uid))
+                    if self.db.recount:
+                        self.db.count_items()
+                self.db.digest_cache = self.read_digests()
+            except Exception as e:
+                self.db.clear()
+                raise ValueError(f'failed to read items: {repr(e)}')
+
+            self.db.pending_records = []
+
+    def load(self) -> dict:
+        """
+        Return the dictionary representation of the stored database
+        :return: database dictionary
+        :raise FileNotFoundError, ValueError
+        """
+        with self.db.lock:
+            try:
+                self.check_password()
+                tag_list, field_list = self.read_tables()
+                items = {str(uid): json_item for uid, json_item in self.next_item()}
+                digests = encode_digests(self.read_digests())
+            except sqlite3.Error as e:
+                raise ValueError(f'failed to read the data: {repr(e)}')
+            return {DB_TAGS_KEY: tag_list, DB_FIELDS_KEY: field_list, DB_ITEMS_KEY: items,
+                    DB_HASH_KEY: self.get_meta(META_HASH), DB_DIGESTS_KEY: digests}
+
+    def put_item(self, uid: int, json_item: dict, digest: Optional[bytes] = None):
+        """
+        Store an item, replacing the stored version if there is one. Must be called inside a transaction.
+        :param uid: item uid
+        :param json_item: item dictionary
+        :param digest: item hash (computed if not supplied)
+        """
+        connection = self.connect()
+        self.delete_item(uid)
+        digest = item_digest(json_item) if digest is None else digest
+        connection.execute('INSERT INTO items VALUES (?, ?, ?, ?, ?)',
+                           (uid, json_item[ITEM_NAME_KEY], json_item[ITEM_NOTE_KEY], json_item[ITEM_TIMESTAMP_KEY],
+                            digest.hex()))
+        connection.executemany('INSERT INTO item_tags VALUES (?, ?, ?)',
+                               [(uid, n, tag_uid) for n, tag_uid in enumerate(json_item[ITEM_TAG_LIST_KEY])])
+        connection.executemany('INSERT INTO item_fields VALUES (?, ?, ?, ?, ?)',
+                               [(uid, n, field[FIELD_NAME_KEY], encode_value(field[FIELD_VALUE_KEY]),
+                                 field[FIELD_SENSITIVE_KEY])
+                                for n, field in enumerate(json_item[ITEM_FIELDS_KEY].values())])
+
+    def delete_item(self, uid: int):
+        """
+        Remove a stored item. Must be called inside a transaction.
+        :param uid: item uid
+        """
+        for table, key in [('items', 'uid'), ('item_tags', 'item_uid'), ('item_fields', 'item_uid')]:
+            self.connect().execute(f'DELETE FROM {table} WHERE {key} = ?', (uid,))
+
+    def apply_record(self, record: dict):
+        """
+        Apply a recorded change to the tables (see journal.fold_record()). Must be called inside a transaction.
+        :param record: record
+        :raise: ValueError if the operation is unknown
+        """
+        connection = self.connect()
+        op, data = record[RECORD_OP_KEY], record[RECORD_DATA_KEY]
+        if op == OP_TAG_ADD:
+            connection.execute('INSERT INTO tags VALUES (?, ?)', (data[KEY_UID], data[KEY_NAME]))
+        elif op == OP_FIELD_ADD:
+            connection.execute('INSERT INTO fields VALUES (?, ?, ?)',
+                               (data[KEY_UID], data[KEY_NAME], data[FIELD_SENSITIVE_KEY]))
+        elif op == OP_TAG_RENAME:
+            connection.execute('UPDATE tags SET name = ? WHERE name = ?', (data[KEY_NAME], data[RENAME_OLD_KEY]))
+        elif op in [OP_TAG_DELETE, OP_FIELD_DELETE]:
+            table = 'tags' if op == OP_TAG_DELETE else 'fields'
+            connection.execute(f'DELETE FROM {table} WHERE name = ?', (data[KEY_NAME],))
+        elif op == OP_ITEM_PUT:
+            self.put_item(int(data[ITEM_UID_KEY]), data)
+        elif op == OP_ITEM_DELETE:
+            self.delete_item(int(data[ITEM_UID_KEY]))
+        else:
+            raise ValueError(f'unknown journal operation {op}')
+
+    def save(self, json_data: Optional[dict] = None, force=False) -> bool:
+        """
+        Replace all the rows with the dictionary representation of a database, in a single transaction.
+        When no dictionary is supplied, the current database contents are stored.
+        :param json_data: database dictionary (optional)
+        :param force: store the contents even if they didn't change?
+        :return: True if the rows were replaced, False otherwise
+        """
+        with self.db.lock:
+            digests = self.db.item_digests(json_data)
+            content_hash = self.db.digest(json_data, digests)
+            if not force and content_hash == self.db.content_hash and self.exists():
+                if json_data is None:
+                    self.db.pending_records = []
+                return False
+            if json_data is None:
+                tag_list, field_list = self.db.tag_table.export(), self.db.field_table.export()
+                items = self.db.item_collection.next_export()
+            else:
+                tag_list, field_list = json_data[DB_TAGS_KEY], json_data[DB_FIELDS_KEY]
+                items = json_data[DB_ITEMS_KEY].items()
+
+            connection = self.connect(create=True)
+            with connection:
+                for table in ['tags', 'fields', 'items', 'item_tags', 'item_fields']:
+                    connection.execute(f'DELETE FROM {table}')
+                connection.executemany('INSERT INTO tags VALUES (?, ?)', [(x[KEY_UID], x[KEY_NAME]) for x in tag_list])
+                connection.executemany('INSERT INTO fields VALUES (?, ?, ?)',
+                                       [(x[KEY_UID], x[KEY_NAME], x[FIELD_SENSITIVE_KEY]) for x in field_list])
+                for uid, json_item in items:
+                    self.put_item(int(uid), json_item, digests[int(uid)])
+                check = None if self.db.crypt_key is None else self.db.crypt_key.encrypt_str2str(CHECK_TEXT)
+                self.set_meta(META_CHECK, check)
+                self.set_meta(META_KDF, None if self.db.crypt_key is None else json.dumps(self.db.crypt_key.parameters))
+                self.set_meta(META_HASH, content_hash)
+            self.db.content_hash = content_hash
+            if json_data is None:
+                self.db.digest_cache = digests
+                # The changes not written yet are included, now they are stored
+                self.db.pending_records = []
+            return True
+
+    def write(self, snapshot=False) -> Optional[bool]:
+        """
+        Apply the changes recorded since the last read or write to the rows, in a single transaction.
+        All the rows must be replaced if a snapshot is requested or the file does not exist yet.
+        The content hash is not computed for the changes, so it's removed.
+        :param snapshot: replace all the rows?
+        :return: True if anything was written, False otherwise, None if all the rows must be replaced
+        """
+        with self.db.lock:
+            if not snapshot and self.exists():
+                if not self.db.pending_records:
+                    return False
+                connection = self.connect()
+                try:
+                    with connection:
+                        for record in self.db.pending_records:
+                            self.apply_record(record)
+                        self.set_meta(META_HASH, None)
+                except sqlite3.Error as e:
+                    raise ValueError(f'failed to write the changes: {repr(e)}')
+                self.db.pending_records = []
+                self.db.content_hash = None
+                return True
+        return None
+
+    def search(self, pattern: str, item_name_flag=True, tag_flag=False,
+               field_name_flag=False, field_value_flag=False, note_flag=False) -> Optional[list[int]]:
+        """
+        Search the stored items in SQL (see Database.search()). The tags and the field names are
+        matched against the tag table and the distinct field names first, and the items are then
+        found through the indexes on the tag uid and the field name.
+        Field values are not searched in SQL since they are stored in json, and nothing is
+        searched before the database is read or saved.
+        :return: uid of the matching items, once for each match as in Database.search(),
+                 or None if the search cannot be done in SQL
+        """
+        if field_value_flag or self.connection is None:
+            return None
+        connection = self.connect()
+        compiled_pattern = re.compile(pattern, flags=re.IGNORECASE)
+        matches = defaultdict(int)
+        names = {}
+        for flag, column in [(item_name_flag, 'name'), (note_flag, 'note')]:
+            if flag:
+                for uid, name in connection.execute(f'SELECT uid, name FROM items WHERE {column} REGEXP ?', (pattern,)):
+                    matches[uid] += 1
+                    names[uid] = name
+        for flag, query, table, column in [
+                (tag_flag, 'SELECT uid, name FROM tags', 'item_tags', 'tag_uid'),
+                (field_name_flag, 'SELECT DISTINCT name, name FROM item_fields', 'item_fields', 'name')]:
+            if flag:
+                key_list = [key for key, name in connection.execute(query) if compiled_pattern.search(name)]
+                for n in range(0, len(key_list), MAX_PARAMETERS):
+                    chunk = key_list[n:n + MAX_PARAMETERS]
+                    for uid, name, count in connection.execute(
+                            f'SELECT t.item_uid, i.name, COUNT(*) FROM {table} t JOIN items i ON i.uid = t.item_uid '
+                            f'WHERE t.{column} IN ({", ".join("?" * len(chunk))}) GROUP BY t.item_uid', chunk):
+                        matches[uid] += count
+                        names[uid] = name
+        # Same order as ItemCollection.next()
+        return [uid for uid in sorted(matches, key=lambda x: (names[x], x)) for _ in range(matches[uid])]
+
+    def close(self):
+        """
+        Close the connection to the SQLite file
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+if __name__ == '__main__':
+    from db import Database
+    from testing import random_database
+    database = Database('sqlite.db', engine=ENGINE_SQLITE)
+    random_database(database, 10)
+    database.write()
+    print(len(database.engine.load()[DB_ITEMS_KEY]), database.engine.search('name'))
+    database.engine.close()
@@ -0,0 +1,147 @@
+"""
+Storage engines.
+
+A storage engine keeps the contents of a database somewhere (e.g. a file) and moves them
+between that place and the tables and item collection held in memory by the Database.
+The Database keeps everything that doesn't depend on the storage (the in-memory contents,
+the settings, the content hash, group commit), and calls the engine to read and write.
+"""
+import os
+from abc import ABC, abstractmethod
+from typing import Optional, TYPE_CHECKING
+from kdf import LEGACY_PARAMETERS
+from crypt_stream import read_parameters
+
+if TYPE_CHECKING:
+    from db import Database
+
+# Engine names
+ENGINE_FILE = 'file'
+ENGINE_SQLITE = 'sqlite'
+ENGINE_SHARD = 'shard'
+
+
+def file_signature(file_name: str) -> Optional[tuple[int, int, int]]:
+    """
+    Return what identifies the version of a file, which changes whenever it's written or replaced
+    :param file_name: file name
+    :return: inode, size and modification time (None if the file does not exist)
+    """
+    try:
+        st = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class StorageEngine(ABC):
+    """
+    Generic storage engine used to define the engines
+    """
+
+    # Engine name
+    name = ''
+
+    def __init__(self, db: 'Database'):
+        """
+        :param db: database using the engine
+        """
+        self.db = db
+
+    @abstractmethod
+    def exists(self) -> bool:
+        """
+        Check whether the database was stored already
+        :return: True if it was, False otherwise
+        """
+        pass
+
+    @abstractmethod
+    def read(self, lazy=False, stream=True):
+        """
+        Fill the tables and the item collection of the database with the stored contents.
+        Engines that don't support a read mode ignore the flag.
+        :param lazy: create the items on first access?
+        :param stream: read the contents incrementally?
+        :raise FileNotFoundError, ValueError
+        """
+        pass
+
+    @abstractmethod
+    def load(self) -> dict:
+        """
+        Return the dictionary representation of the stored contents, without modifying
+        the tables or the item collection
+        :return: database dictionary
+        :raise FileNotFoundError, ValueError
+        """
+        pass
+
+    @abstractmethod
+    def save(self, json_data: Optional[dict] = None, force=False) -> bool:
+        """
+        Store a complete new version of the database
+        :param json_data: database dictionary (current contents if not specified)
+        :param force: store it even if the contents didn't change?
+        :return: True if anything was stored, False otherwise
+        """
+        pass
+
+    @abstractmethod
+    def write(self, snapshot=False) -> Optional[bool]:
+        """
+        Store the changes made since the last read or write (see Database.record()).
+        Called holding the database lock, so a complete new version is not stored here
+        but by Database.write(), which lets several threads share the same save.
+        :param snapshot: store a complete new version instead?
+        :return: True if anything was stored, False otherwise, or None if a complete new version
+                 must be stored (always the case for a snapshot)
+        """
+        pass
+
+    def signature(self) -> Optional[tuple]:
+        """
+        Return what identifies the stored version, so a change made by another process can be
+        detected without reading it (see Database.changed()). Engines that store the contents
+        in several files override it.
+        :return: signature (None if nothing is stored)
+        """
+        return file_signature(self.db.file_name)
+
+    def kdf_parameters(self) -> Optional[dict]:
+        """
+        Return the parameters used to derive the encryption key of the stored database (see kdf.py),
+        which are in the header of the file when it's encrypted (see crypt_stream.py).
+        Engines that store the contents in other ways override it.
+        :return: parameters (the legacy ones if stored without them, None if nothing is stored)
+        :raise: ValueError if the stored parameters are not valid
+        """
+        if not self.exists():
+            return None
+        parameters = read_parameters(self.db.file_name)
+        return LEGACY_PARAMETERS if parameters is None else parameters
+
+    def list_backups(self) -> list[tuple[str, str]]:
+        """
+        Return the backups of previous versions
+        :return: time stamp and description of each backup, most recent first
+        """
+        return []
+
+    def rebuild(self, time_stamp: str) -> dict:
+        """
+        Rebuild the version of the database in a backup
+        :param time_stamp: backup time stamp
+        :return: database dictionary
+        :raise ValueError
+        """
+        raise ValueError(f'backup {time_stamp} not found')
+
+    def search(self, pattern: str, item_name_flag=True, tag_flag=False,
+               field_name_flag=False, field_value_flag=False, note_flag=False) -> Optional[list[int]]:
+        """
+        Search the stored items (see Database.search()). Engines that can search without
+        creating the items override it.
+        :return: uid of the matching items, once for each match, or None if the engine can't search
+        """
+        return None
@@ -169,6 +169,13 @@ class Table:
         else:
             raise KeyError(f'uid {uid} not in the table')
 
+    def total(self) -> int:
+        """
+        Return the sum of all the counters
+        :return: total count
+        """
+        return sum(self.count_dict.values())
+
     def get_attributes(self, uid: int) -> dict:
         """
         Get the additional attributes for a table entry either by name or uid
@@ -217,17 +224,18 @@ class TagTable(Table):
     def __init__(self):
         super().__init__('Tags')
 
-    def add(self, tag_name: str, uid=None):
+    def add(self, tag_name: str, uid=None, register=True):
         """
         Add tag to table
         :param tag_name: tag name
         :param uid: unique identifier (optional)
+        :param register: register the uid so it's not used again? (only when specified)
         """
         if self.has_name(tag_name):
             raise KeyError(f'{tag_name} already exists')
         if uid is None:
             uid = TagTableUid.get_uid()
-        else:
+        elif register:
             TagTableUid.add_uid(uid)
         super().add(name=tag_name, uid=uid)
 
@@ -262,18 +270,19 @@ class FieldTable(Table):
     def __init__(self):
         super().__init__('Fields')
 
-    def add(self, name: str, sensitive=False, uid=None):
+    def add(self, name: str, sensitive=False, uid=None, register=True):
         """
         Add field to the table
         :param name: field name
         :param sensitive: sensitive?
         :param uid: unique identifier
+        :param register: register the uid so it's not used again? (only when specified)
         """
         if self.has_name(name):
             raise KeyError(f'{name} already exists')
         if uid is None:
             uid = FieldTableUid.get_uid()
-        else:
+        elif register:
             FieldTableUid.add_uid(uid)
         if uid == 658:
             pass
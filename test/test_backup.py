@@ -0,0 +1,172 @@
+import os
+import pytest
+from db import Database
+from backup import RetentionPolicy, list_backups, backup_file_name, delta_file_name, is_delta
+from common import FORMAT_JSON, FORMAT_BINARY
+from compression import CODEC_ZLIB
+from items import Item, FieldCollection
+from testing import random_database
+from uid import clear_all
+
+TIME_STAMP_LIST = ['20240101100000', '20240101100500', '20240101110000', '20240101113000',
+                   '20240102090000', '20240102090100', '20240102090200']
+
+
+def test_select():
+    assert RetentionPolicy(2, 0, 0).select(TIME_STAMP_LIST) == {'20240102090200', '20240102090100'}
+    assert RetentionPolicy(0, 3, 0).select(TIME_STAMP_LIST) == {'20240102090200', '20240101113000', '20240101100500'}
+    assert RetentionPolicy(0, 0, 1).select(TIME_STAMP_LIST) == {'20240102090200'}
+    assert RetentionPolicy(1, 1, 2).select(TIME_STAMP_LIST) == {'20240102090200', '20240101113000'}
+    assert RetentionPolicy(0, 0, 0).select(TIME_STAMP_LIST) == set()
+    assert RetentionPolicy(100, 100, 100).select(TIME_STAMP_LIST) == set(TIME_STAMP_LIST)
+
+
+def test_prune(tmp_path):
+    file_name = str(tmp_path / 'test.db')
+    for time_stamp in TIME_STAMP_LIST:
+        open(backup_file_name(file_name, time_stamp), 'w').close()
+    open(file_name + '-other', 'w').close()
+    open(str(tmp_path / 'other.db-20240101100000'), 'w').close()
+    assert list_backups(file_name) == sorted(TIME_STAMP_LIST, reverse=True)
+
+    removed = RetentionPolicy(1, 1, 2).prune(file_name)
+    assert sorted(removed) == sorted(set(TIME_STAMP_LIST) - {'20240102090200', '20240101113000'})
+    assert list_backups(file_name) == ['20240102090200', '20240101113000']
+    assert os.path.exists(file_name + '-other')
+
+
+def test_unchanged_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+            file_name = f'{file_format}{password}.db'
+            clear_all()
+            db = Database(file_name, password, file_format=file_format)
+            db.retention = None
+            random_database(db, 10)
+            assert db.write()
+            assert not db.write()
+            assert db.write(snapshot=True) is False
+
+            # Same contents after reading the file again
+            for lazy in [False, True]:
+                clear_all()
+                db = Database(file_name, password)
+                db.retention = None
+                db.read(lazy=lazy)
+                assert not db.write()
+            assert list_backups(file_name) == []
+
+            # Changes
+            db.item_collection.add(Item('new', [], '', FieldCollection()))
+            assert db.write()
+            assert not db.write()
+            db.codec = CODEC_ZLIB
+            assert db.write()
+            assert db.save(force=True)
+            assert len(list_backups(file_name)) > 0
+
+
+def test_retention(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db')
+    random_database(db, 5)
+    db.write()
+    for time_stamp in TIME_STAMP_LIST:
+        open(backup_file_name('test.db', time_stamp), 'w').close()
+    db.retention = RetentionPolicy(2, 0, 0)
+    db.item_collection.add(Item('new', [], '', FieldCollection()))
+    db.write()
+    assert len(list_backups('test.db')) == 2
+
+
+DELTA_TIME_STAMP_LIST = ['20240101100000', '20240102100000', '20240102110000', '20240102120000', '20240103100000']
+
+
+def write_versions(file_name: str, password: str, file_format: str, monkeypatch) -> list[str]:
+    """
+    Write a new version of a database for each time stamp in DELTA_TIME_STAMP_LIST.
+    Items are added, removed and the tag table changes between versions.
+    :return: content hash of each version replaced, in the same order as the time stamps
+    """
+    time_stamps = iter(DELTA_TIME_STAMP_LIST)
+    monkeypatch.setattr('file_engine.get_string_timestamp', lambda: next(time_stamps))
+    clear_all()
+    db = Database(file_name, password, file_format=file_format)
+    db.retention = None
+    random_database(db, 20)
+    db.write()
+    hash_list = []
+    for n in range(len(DELTA_TIME_STAMP_LIST)):
+        hash_list.append(db.content_hash)
+        db.item_collection.remove(db.item_collection.keys()[n])
+        db.item_collection.add(Item(f'new-{n}', [], '', FieldCollection()))
+        db.tag_table.add(f'new-tag-{n}')
+        assert db.write()
+    return hash_list
+
+
+def read_hash(file_name: str, password: str) -> str:
+    clear_all()
+    db = Database(file_name, password)
+    db.read()
+    return db.digest()
+
+
+def test_restore(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+            file_name = f'{file_format}{password}.db'
+            hash_list = write_versions(file_name, password, file_format, monkeypatch)
+            assert list_backups(file_name) == sorted(DELTA_TIME_STAMP_LIST, reverse=True)
+            assert all(is_delta(file_name, x) for x in DELTA_TIME_STAMP_LIST)
+
+            db = Database(file_name, password)
+            for time_stamp, content_hash in zip(DELTA_TIME_STAMP_LIST, hash_list):
+                assert db.digest(db.rebuild(time_stamp)) == content_hash
+
+            # The restored version is written as a new version, with its own backup
+            current_hash = read_hash(file_name, password)
+            monkeypatch.setattr('file_engine.get_string_timestamp', lambda: '20240104100000')
+            db.restore(DELTA_TIME_STAMP_LIST[1])
+            assert read_hash(file_name, password) == hash_list[1]
+            assert db.digest(db.rebuild('20240104100000')) == current_hash
+            with pytest.raises(ValueError):
+                db.rebuild('20230101100000')
+
+
+def test_delta_merge(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        file_name = f'test{password}.db'
+        hash_list = write_versions(file_name, password, FORMAT_JSON, monkeypatch)
+        db = Database(file_name, password)
+
+        # The deltas removed are merged into the next older one
+        removed = RetentionPolicy(1, 0, 3).prune(file_name, db.crypt_key)
+        assert sorted(removed) == ['20240102100000', '20240102110000']
+        for time_stamp, content_hash in zip(DELTA_TIME_STAMP_LIST, hash_list):
+            if time_stamp not in removed:
+                assert db.digest(db.rebuild(time_stamp)) == content_hash
+
+        # Missing delta
+        os.remove(delta_file_name(file_name, '20240102120000'))
+        with pytest.raises(ValueError, match='broken backup chain'):
+            db.rebuild('20240101100000')
+
+
+def test_same_time_stamp(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('file_engine.get_string_timestamp', lambda: '20240101100000')
+    clear_all()
+    db = Database('test.db')
+    random_database(db, 5)
+    db.write()
+    content_hash = db.content_hash
+    for n in range(3):
+        db.item_collection.add(Item(f'new-{n}', [], '', FieldCollection()))
+        db.write()
+    assert list_backups('test.db') == ['20240101100000']
+    assert db.digest(db.rebuild('20240101100000')) == content_hash
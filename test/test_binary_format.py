@@ -0,0 +1,183 @@
+import pytest
+from db import Database
+from items import Item, FieldCollection, LazyItemCollection
+from journal import OP_ITEM_PUT, OP_ITEM_DELETE
+from uid import clear_all
+from testing import random_database
+from binary_format import encode_database, decode_database, is_binary, read_index, BINARY_VERSION, BASE_VERSION
+from binary_format import NAMES_MAGIC
+from crypt import Crypt, CIPHER_AES_GCM
+from kdf import LEGACY_PARAMETERS
+from common import KEY_NAME, KEY_UID, FIELD_NAME_KEY, FIELD_VALUE_KEY, FIELD_SENSITIVE_KEY
+from common import ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_UID_KEY, ITEM_FIELDS_KEY
+from common import DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY, DB_GENERATION_KEY, FORMAT_JSON, FORMAT_BINARY
+
+
+def field_values(json_data: dict) -> dict:
+    """
+    Return the item fields as a dictionary of sets, ignoring the field uid
+    """
+    return {uid: {(f[FIELD_NAME_KEY], f[FIELD_VALUE_KEY], f[FIELD_SENSITIVE_KEY])
+                  for f in json_data[DB_ITEMS_KEY][uid][ITEM_FIELDS_KEY].values()}
+            for uid in json_data[DB_ITEMS_KEY]}
+
+
+def test_encode_decode():
+    fields = {'1': {FIELD_NAME_KEY: 'user', FIELD_VALUE_KEY: 'joe', FIELD_SENSITIVE_KEY: False},
+              '2': {FIELD_NAME_KEY: 'not in table', FIELD_VALUE_KEY: 'ñandú', FIELD_SENSITIVE_KEY: True},
+              '3': {FIELD_NAME_KEY: 'int', FIELD_VALUE_KEY: -12, FIELD_SENSITIVE_KEY: False},
+              '4': {FIELD_NAME_KEY: 'big', FIELD_VALUE_KEY: 2 ** 70, FIELD_SENSITIVE_KEY: False},
+              '5': {FIELD_NAME_KEY: 'float', FIELD_VALUE_KEY: 3.5, FIELD_SENSITIVE_KEY: False}}
+    json_data = {DB_TAGS_KEY: [{KEY_NAME: 'web', KEY_UID: 10}],
+                 DB_FIELDS_KEY: [{KEY_NAME: 'user', KEY_UID: 100, FIELD_SENSITIVE_KEY: False}],
+                 DB_ITEMS_KEY: {'1000': {ITEM_NAME_KEY: 'item', ITEM_TAG_LIST_KEY: [10], ITEM_NOTE_KEY: 'a\nnote',
+                                         ITEM_TIMESTAMP_KEY: 12345, ITEM_UID_KEY: 1000, ITEM_FIELDS_KEY: fields}},
+                 DB_GENERATION_KEY: 'abc'}
+    data = encode_database(json_data)
+    assert is_binary(data)
+    decoded = decode_database(data)
+    assert decoded[DB_TAGS_KEY] == json_data[DB_TAGS_KEY]
+    assert decoded[DB_FIELDS_KEY] == json_data[DB_FIELDS_KEY]
+    assert decoded[DB_GENERATION_KEY] == 'abc'
+    item = decoded[DB_ITEMS_KEY]['1000']
+    for key in [ITEM_NAME_KEY, ITEM_TAG_LIST_KEY, ITEM_NOTE_KEY, ITEM_TIMESTAMP_KEY, ITEM_UID_KEY]:
+        assert item[key] == json_data[DB_ITEMS_KEY]['1000'][key]
+    assert field_values(decoded) == field_values(json_data)
+
+
+def test_aead_values():
+    crypt = Crypt('test', dict(LEGACY_PARAMETERS, cipher=CIPHER_AES_GCM))
+    fields = {'1': {FIELD_NAME_KEY: 'user', FIELD_VALUE_KEY: 'joe', FIELD_SENSITIVE_KEY: False},
+              '2': {FIELD_NAME_KEY: 'password', FIELD_VALUE_KEY: Crypt('test').encrypt_str2str('x'),
+                    FIELD_SENSITIVE_KEY: True}}
+    json_data = {DB_TAGS_KEY: [], DB_FIELDS_KEY: [],
+                 DB_ITEMS_KEY: {'1': {ITEM_NAME_KEY: 'item', ITEM_TAG_LIST_KEY: [], ITEM_NOTE_KEY: '',
+                                      ITEM_TIMESTAMP_KEY: 1, ITEM_UID_KEY: 1, ITEM_FIELDS_KEY: fields}}}
+
+    # Files without AES-GCM tokens keep the previous version
+    data = encode_database(json_data)
+    assert data[4] == BASE_VERSION
+    assert field_values(decode_database(data)) == field_values(json_data)
+
+    # AES-GCM tokens are stored as raw bytes
+    token = crypt.encrypt_str2str('secret')
+    fields['2'][FIELD_VALUE_KEY] = token
+    aead_data = encode_database(json_data)
+    assert aead_data[4] == BINARY_VERSION
+    assert token.encode() not in aead_data
+    assert len(aead_data) < len(data)
+    assert field_values(decode_database(aead_data)) == field_values(json_data)
+
+
+def test_index_names():
+    json_data = {DB_TAGS_KEY: [], DB_FIELDS_KEY: [],
+                 DB_ITEMS_KEY: {str(uid): {ITEM_NAME_KEY: name, ITEM_TAG_LIST_KEY: [], ITEM_NOTE_KEY: '',
+                                           ITEM_TIMESTAMP_KEY: 1, ITEM_UID_KEY: uid, ITEM_FIELDS_KEY: {}}
+                                for uid, name in [(3, 'ñandú'), (1, 'web'), (2, '')]}}
+    data = encode_database(json_data)
+    index = read_index(data)
+    assert index.item_names(data) == ['web', '', 'ñandú']
+    assert decode_database(data)[DB_ITEMS_KEY]['3'][ITEM_NAME_KEY] == 'ñandú'
+
+    # Indexes written without the names
+    names_offset = index.names_offset - len(NAMES_MAGIC)
+    old_data = data[:names_offset] + data[-16:]  # footer
+    assert read_index(old_data).item_names(old_data) is None
+    assert field_values(decode_database(old_data)) == field_values(json_data)
+
+    empty = encode_database({DB_TAGS_KEY: [], DB_FIELDS_KEY: [], DB_ITEMS_KEY: {}})
+    assert read_index(empty).item_names(empty) == []
+
+
+def test_bad_data():
+    assert is_binary(b'{"tags": []}') is False
+    with pytest.raises(ValueError):
+        decode_database(b'JDBX\x01')
+
+
+def test_database_format(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        clear_all()
+        db = Database('test.db', password, file_format=FORMAT_BINARY)
+        random_database(db, 50)
+        db.write()
+        expected = db.export()
+
+        # The format is detected when reading and kept for writing
+        clear_all()
+        db = Database('test.db', password)
+        db.read()
+        assert db.file_format == FORMAT_BINARY
+        assert field_values(db.export()) == field_values(expected)
+        assert db.tag_table.export() == expected[DB_TAGS_KEY]
+        assert db.field_table.export() == expected[DB_FIELDS_KEY]
+
+        # Convert to json
+        db.file_format = FORMAT_JSON
+        db.write()
+        clear_all()
+        db = Database('test.db', password)
+        db.read()
+        assert db.file_format == FORMAT_JSON
+        assert field_values(db.export()) == field_values(expected)
+
+
+def test_lazy_read(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for file_name, password in [('plain.db', ''), ('encrypted.db', 'test')]:
+        clear_all()
+        db = Database(file_name, password, journal=True, file_format=FORMAT_BINARY)
+        random_database(db, 20)
+        db.write()
+        uid_list = sorted(db.item_collection.keys())
+
+        # Change some items and save the changes in the journal
+        db.item_collection.remove(uid_list[0])
+        db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid_list[0]})
+        item = Item('new', db.item_collection.get(uid_list[1]).get_tags(), '', FieldCollection())
+        db.item_collection.add(item)
+        db.record(OP_ITEM_PUT, item.export())
+        db.write()
+
+        # The counters are compared against a full read
+        clear_all()
+        db = Database(file_name, password, journal=True)
+        db.read()
+        expected = db.export()
+        names = sorted(db.item_collection.next_name())
+        tag_counts = [str(x) for x in db.tag_table.next()]
+        field_counts = [str(x) for x in db.field_table.next()]
+
+        clear_all()
+        db = Database(file_name, password, journal=True)
+        db.read(lazy=True)
+        assert isinstance(db.item_collection, LazyItemCollection)
+        assert len(db.item_collection.data) == 1
+        assert len(db.item_collection) == 20
+        assert uid_list[0] not in db.item_collection
+        assert [str(x) for x in db.tag_table.next()] == tag_counts
+        assert [str(x) for x in db.field_table.next()] == field_counts
+
+        # The items are listed by name without creating them
+        listing = list(db.item_collection.next_name())
+        assert [x for _, x in listing] == sorted(x for _, x in listing)
+        assert sorted(listing) == names
+        assert len(db.item_collection.data) == 1
+        assert field_values(db.export()) == field_values(expected)
+
+        # New items get a new uid
+        assert Item('other', [], '', FieldCollection()).get_id() > max(uid_list + [item.get_id()])
+
+
+def test_lazy_read_json(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db')
+    random_database(db, 5)
+    db.write()
+    clear_all()
+    db = Database('test.db')
+    db.read(lazy=True)
+    assert not isinstance(db.item_collection, LazyItemCollection)
+    assert len(db.item_collection) == 5
@@ -0,0 +1,28 @@
+import command
+from command import CommandProcessor
+from db import Database
+from testing import random_database
+from uid import clear_all
+from common import FORMAT_BINARY
+
+
+def test_refresh_failed(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(command, 'get_password', lambda: '')
+    clear_all()
+    db = Database('test.db', file_format=FORMAT_BINARY)
+    random_database(db, 5)
+    db.write()
+
+    cp = CommandProcessor()
+    cp.database_read('test.db', lazy=True, read_only=True)
+    assert cp.db_loaded()
+    assert cp.db.lazy
+
+    # Another process leaves the file unreadable, so the database is dropped instead of left empty
+    with open('test.db', 'wb') as f:
+        f.write(b'not a database')
+    assert not cp.db_loaded()
+    assert cp.db is None
+    assert 'cannot read database test.db again' in capsys.readouterr().out
+    assert not cp.db_loaded()
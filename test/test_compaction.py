@@ -0,0 +1,80 @@
+import os
+from db import Database
+from items import Item, FieldCollection
+from journal import OP_ITEM_PUT
+from compaction import Compactor
+from test_journal import create_database, clear_uid
+
+
+def add_item(db: Database, name: str):
+    item = Item(name, [], '', FieldCollection())
+    db.item_collection.add(item)
+    db.record(OP_ITEM_PUT, item.export())
+
+
+def test_compaction_trigger(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = create_database('test.db', 'test', True)
+    c = Compactor(db, max_size=0, max_records=3)
+    assert c.needed() is False
+    assert c.compact() is False
+    for n in range(3):
+        add_item(db, f'new{n}')
+        db.write()
+    assert c.needed() is True
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = create_database('test.db', 'test', True)
+    add_item(db, 'saved')
+    db.write()
+    add_item(db, 'not saved')
+    assert Compactor(db).compact() is True
+    assert db.journal.exists() is False
+
+    # Changes that were not written are appended to the new journal
+    db.write()
+    assert len(db.journal) == 1
+
+    clear_uid()
+    db = Database('test.db', 'test', journal=True)
+    db.read()
+    assert sorted([x.get_name() for x in db.item_collection.next()]) == \
+           ['item0', 'item1', 'item2', 'not saved', 'saved']
+
+
+def test_stale_journal(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = create_database('test.db', '', True)
+    add_item(db, 'saved')
+    db.write()
+
+    # Simulate a crash after the new file is in place but before the journal is removed
+    with open(db.journal.file_name, 'rb') as f:
+        journal_data = f.read()
+    Compactor(db).compact()
+    with open(db.journal.file_name, 'wb') as f:
+        f.write(journal_data)
+
+    clear_uid()
+    db = Database('test.db', '', journal=True)
+    db.read()
+    assert len(db.item_collection) == 4
+    assert os.path.exists(db.journal.file_name)
+
+
+def test_background_compaction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = create_database('test.db', '', True)
+    add_item(db, 'saved')
+    db.write()
+    c = Compactor(db, max_records=1, interval=0.01)
+    c.start()
+    for _ in range(500):
+        if not db.journal.exists():
+            break
+        c.stop_event.wait(0.01)
+    c.stop()
+    assert db.journal.exists() is False
+    assert c.error is None
@@ -0,0 +1,76 @@
+import io
+import pytest
+from db import Database
+from compression import CODEC_LIST, CODEC_NONE, CODEC_ZLIB, CODEC_BZ2, CODEC_LZMA, COMPRESSION_MAGIC
+from compression import compress, decompress, get_codec, is_compressed, CompressWriter, DecompressReader
+from common import FORMAT_JSON, FORMAT_BINARY
+from testing import random_database
+from uid import clear_all
+from test_binary_format import field_values
+
+DATA = b''.join([f'line {n} with some text\n'.encode() for n in range(10000)])
+
+
+def test_compress():
+    for codec in CODEC_LIST:
+        data = compress(DATA, codec)
+        assert get_codec(data) == codec
+        assert decompress(data) == DATA
+        if codec != CODEC_NONE:
+            assert is_compressed(data)
+            assert len(data) < len(DATA)
+    assert len(compress(DATA, CODEC_ZLIB, 1)) > len(compress(DATA, CODEC_ZLIB, 9))
+
+
+def test_bad_data():
+    with pytest.raises(ValueError):
+        get_codec(COMPRESSION_MAGIC + b'\xff')
+    for codec in [CODEC_ZLIB, CODEC_LZMA, CODEC_BZ2]:
+        data = compress(DATA, codec)
+        with pytest.raises(ValueError):
+            decompress(data[:len(data) // 2])
+        with pytest.raises(ValueError):
+            decompress(data[:10] + b'garbage' + data[10:])
+
+
+def test_stream():
+    for codec in [CODEC_ZLIB, CODEC_LZMA, CODEC_BZ2]:
+        f = io.BytesIO()
+        writer = CompressWriter(f, codec)
+        for n in range(0, len(DATA), 1000):
+            writer.write(DATA[n:n + 1000])
+        writer.close()
+        assert f.getvalue() == compress(DATA, codec)
+
+        f.seek(0)
+        reader = io.BufferedReader(DecompressReader(f))
+        assert reader.read() == DATA
+
+        reader = io.BufferedReader(DecompressReader(io.BytesIO(f.getvalue()[:-10])))
+        with pytest.raises(ValueError):
+            reader.read()
+
+
+def test_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+            for codec in CODEC_LIST:
+                file_name = f'{file_format}-{codec}-{"encrypted" if password else "plain"}.db'
+                clear_all()
+                db = Database(file_name, password, file_format=file_format, codec=codec)
+                random_database(db, 20)
+                db.write()
+                expected = field_values(db.export())
+                if not password:
+                    with open(file_name, 'rb') as f:
+                        assert get_codec(f.read()) == codec
+
+                # The codec and the file format are taken from the file
+                for lazy in [False, True]:
+                    clear_all()
+                    db = Database(file_name, password)
+                    db.read(lazy=lazy)
+                    assert db.codec == codec
+                    assert db.file_format == file_format
+                    assert field_values(db.export()) == expected
@@ -1,5 +1,8 @@
 import os
-from crypt import Crypt
+import pytest
+from cryptography.fernet import InvalidToken
+from crypt import Crypt, CIPHER_AES_GCM, CIPHER_KEY, is_aead_token, aead_token_to_bytes, aead_token_from_bytes
+from kdf import LEGACY_PARAMETERS
 
 
 def test_string_encryption():
@@ -46,3 +49,47 @@ def test_file_encryption():
     assert m_in == m_out
 
     os.remove(file_name)
+
+
+def test_many():
+    c = Crypt('password')
+    m_list = [f'message {n}' for n in range(1000)]
+
+    for workers in [1, 4]:
+        data = c.encrypt_many(m_list, workers)
+        assert len(data) == len(m_list)
+        assert [c.decrypt_str2str(x) for x in data] == m_list
+        assert c.decrypt_many(data, workers) == m_list
+    assert c.encrypt_many([]) == []
+
+    with pytest.raises(InvalidToken):
+        c.decrypt_many(data[:-1] + [Crypt('other').encrypt_str2str('x')], 4)
+
+
+def test_aes_gcm():
+    c = Crypt('password', dict(LEGACY_PARAMETERS, cipher=CIPHER_AES_GCM))
+    fernet = Crypt('password')
+    m_in = 'this is a ñandú'
+
+    data = c.encrypt_str2str(m_in)
+    assert is_aead_token(data)
+    assert len(aead_token_to_bytes(data)) == 1 + 12 + len(m_in.encode()) + 16
+    assert c.decrypt_str2str(data) == m_in
+    assert c.encrypt_str2str(m_in) != data
+
+    # Each token is decrypted with the cipher that produced it
+    assert fernet.decrypt_str2str(data) == m_in
+    assert c.decrypt_str2str(fernet.encrypt_str2str(m_in)) == m_in
+    assert not is_aead_token(fernet.encrypt_str2str(m_in))
+
+    # Tokens that were modified or encrypted with another password are rejected
+    token = bytearray(aead_token_to_bytes(data))
+    token[-1] ^= 1
+    for bad in [aead_token_from_bytes(bytes(token)), data[:-4], Crypt('other', c.parameters).encrypt_str2str(m_in),
+                data[:1] + ('B' if data[1] != 'B' else 'C') + data[2:]]:
+        with pytest.raises(InvalidToken):
+            c.decrypt_str2str(bad)
+    assert c.decrypt_many(c.encrypt_many([m_in] * 1000, 4), 4) == [m_in] * 1000
+
+    with pytest.raises(ValueError):
+        Crypt('password', dict(LEGACY_PARAMETERS, **{CIPHER_KEY: 'unknown'}))
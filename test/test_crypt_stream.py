@@ -0,0 +1,112 @@
+import io
+import json
+import struct
+import pytest
+from crypt import Crypt
+from db import Database
+from crypt_stream import is_chunked, encrypt_chunks, decrypt_chunks, read_header, next_token
+from crypt_stream import EncryptWriter, DecryptReader, CHUNK_MAGIC, read_parameters
+from testing import random_database
+from uid import clear_all
+from test_binary_format import field_values
+
+CRYPT = Crypt('test')
+DATA = b''.join([f'line {n} with some text\n'.encode() for n in range(1000)])
+
+
+def split(data: bytes) -> tuple[bytes, list[bytes]]:
+    """
+    Split encrypted data into the header and the list of chunks (length and token)
+    """
+    f = io.BytesIO(data)
+    read_header(f)
+    header = data[:f.tell()]
+    chunk_list = []
+    for token in next_token(f):
+        chunk_list.append(data[f.tell() - len(token) - 4:f.tell()])
+    return header, chunk_list
+
+
+def test_chunks():
+    for data in [b'', DATA[:1000], DATA[:5000], DATA]:
+        for chunk_size in [1000, 1 << 20]:
+            encrypted = encrypt_chunks(CRYPT, data, chunk_size=chunk_size)
+            assert is_chunked(encrypted)
+            assert len(split(encrypted)[1]) == max(1, (len(data) + chunk_size - 1) // chunk_size)
+            assert decrypt_chunks(CRYPT, encrypted) == data
+            for workers in [1, 3]:
+                reader = io.BufferedReader(DecryptReader(io.BytesIO(encrypted), CRYPT, workers=workers))
+                assert reader.read() == data
+
+
+def test_writer():
+    f = io.BytesIO()
+    writer = EncryptWriter(f, CRYPT, chunk_size=1000)
+    for n in range(0, len(DATA), 333):
+        writer.write(DATA[n:n + 333])
+    writer.close()
+    assert decrypt_chunks(CRYPT, f.getvalue()) == DATA
+
+
+def test_bad_chunks():
+    header, chunk_list = split(encrypt_chunks(CRYPT, DATA, chunk_size=1000))
+
+    # Corrupted chunk
+    bad = bytearray(chunk_list[3])
+    bad[20] ^= 1
+    bad_list = [header + b''.join(chunk_list[:3]) + bytes(bad) + b''.join(chunk_list[4:]),
+                header + b''.join(chunk_list[:3] + chunk_list[4:]),  # missing chunk
+                header + b''.join(chunk_list[:3] + chunk_list[4:5] + chunk_list[3:4] + chunk_list[5:]),  # reordered
+                header + b''.join(chunk_list[:-1]),  # last chunk missing
+                header + b''.join(chunk_list + chunk_list[-1:]),  # chunk after the last one
+                header + b''.join(chunk_list)[:-10]]  # truncated
+    for data in bad_list:
+        with pytest.raises(ValueError):
+            decrypt_chunks(CRYPT, data)
+        with pytest.raises(ValueError):
+            io.BufferedReader(DecryptReader(io.BytesIO(data), CRYPT)).read()
+
+    # Corruption is reported for the chunk where it happened
+    with pytest.raises(ValueError, match='chunk 3'):
+        decrypt_chunks(CRYPT, bad_list[0])
+    with pytest.raises(ValueError):
+        decrypt_chunks(Crypt('other'), header + b''.join(chunk_list))
+
+
+def test_database(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', 'test')
+    random_database(db, 20)
+    db.write()
+    expected = field_values(db.export())
+    with open('test.db', 'rb') as f:
+        assert f.read(len(CHUNK_MAGIC)) == CHUNK_MAGIC
+
+    # Files encrypted as a single token can still be read
+    with open('old.db', 'wb') as f:
+        f.write(CRYPT.encrypt_str2byte(json.dumps(db.export())))
+    for file_name in ['test.db', 'old.db']:
+        for stream in [False, True]:
+            clear_all()
+            db = Database(file_name, 'test')
+            db.read(stream=stream)
+            assert field_values(db.export()) == expected
+
+
+def test_header_parameters(tmp_path):
+    encrypted = encrypt_chunks(CRYPT, DATA, chunk_size=1000)
+    assert read_header(io.BytesIO(encrypted)) == (1000, CRYPT.parameters)
+    file_name = tmp_path / 'test.db'
+    file_name.write_bytes(encrypted)
+    assert read_parameters(str(file_name)) == CRYPT.parameters
+    file_name.write_bytes(DATA)
+    assert read_parameters(str(file_name)) is None
+
+    # Version 1 headers have no parameters
+    header, chunk_list = split(encrypted)
+    old = struct.pack('<4sBI', CHUNK_MAGIC, 1, 1000) + b''.join(chunk_list)
+    assert read_header(io.BytesIO(old)) == (1000, None)
+    assert decrypt_chunks(CRYPT, old) == DATA
+    with pytest.raises(ValueError):
+        read_header(io.BytesIO(header[:-2]))
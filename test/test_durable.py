@@ -0,0 +1,97 @@
+import os
+import stat
+import time
+import threading
+import pytest
+from db import Database
+from durable import DURABILITY_LIST, AtomicFile, GroupCommit
+from items import Item, FieldCollection
+from testing import random_database
+from uid import clear_all
+
+
+def test_atomic_file(tmp_path):
+    file_name = str(tmp_path / 'test.db')
+    with open(file_name, 'wb') as f_out:
+        f_out.write(b'old')
+    os.chmod(file_name, 0o640)
+
+    # Not committed
+    with pytest.raises(RuntimeError):
+        with AtomicFile(file_name) as f:
+            f.write(b'new')
+            raise RuntimeError('write failed')
+    assert os.listdir(tmp_path) == ['test.db']
+    with open(file_name, 'rb') as f_in:
+        assert f_in.read() == b'old'
+
+    for durability in DURABILITY_LIST:
+        with AtomicFile(file_name, durability) as f:
+            assert os.path.dirname(f.temp_name) == str(tmp_path)
+            f.write(durability.encode())
+            f.commit()
+        assert os.listdir(tmp_path) == ['test.db']
+        assert stat.S_IMODE(os.stat(file_name).st_mode) == 0o640
+        with open(file_name, 'rb') as f_in:
+            assert f_in.read() == durability.encode()
+
+    with pytest.raises(ValueError):
+        AtomicFile(file_name, 'unknown')
+
+
+def test_group_commit():
+    calls = []
+
+    def save():
+        calls.append(len(calls))
+        time.sleep(0.05)
+        return len(calls)
+
+    group_commit = GroupCommit(save)
+    result_list = []
+    thread_list = [threading.Thread(target=lambda: result_list.append(group_commit())) for _ in range(10)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    assert len(result_list) == 10
+    assert group_commit.count == len(calls) < 10
+    assert group_commit.served == 10
+
+    # Errors are raised in all the threads served by the save
+    def fail():
+        raise ValueError('save failed')
+
+    with pytest.raises(ValueError):
+        GroupCommit(fail)()
+
+
+def test_concurrent_saves(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database(str(tmp_path / 'data' / 'test.db'))
+    os.mkdir(tmp_path / 'data')
+    db.retention = None
+    random_database(db, 10)
+    db.write()
+
+    def add_and_write(n: int):
+        with db.lock:
+            db.item_collection.add(Item(f'new-{n}', [], '', FieldCollection()))
+        db.write()
+
+    thread_list = [threading.Thread(target=add_and_write, args=(n,)) for n in range(10)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    assert db.group_commit.count <= 11
+    assert os.listdir(tmp_path) == ['data']
+    assert not [x for x in os.listdir(tmp_path / 'data') if x.endswith('.tmp')]
+
+    # Every change was written
+    content_hash = db.digest()
+    clear_all()
+    db = Database(str(tmp_path / 'data' / 'test.db'))
+    db.read()
+    assert db.digest() == content_hash
@@ -0,0 +1,41 @@
+import pytest
+from file_lock import FileLock
+
+
+def test_file_lock(tmp_path):
+    # Locks taken through different files descriptors exclude each other, as in different processes
+    file_name = str(tmp_path / 'test.db')
+    lock, other = FileLock(file_name), FileLock(file_name, timeout=0.05)
+    with lock.shared():
+        with other.shared():
+            pass
+        with pytest.raises(ValueError):
+            other.acquire(exclusive=True)
+    with lock.exclusive():
+        with pytest.raises(ValueError):
+            other.acquire()
+    with other.exclusive():
+        pass
+
+
+def test_file_lock_nesting(tmp_path):
+    file_name = str(tmp_path / 'test.db')
+    lock, other = FileLock(file_name), FileLock(file_name, timeout=0.05)
+    with lock.exclusive():
+        with lock.shared():
+            with lock.exclusive():
+                pass
+        with pytest.raises(ValueError):
+            other.acquire()
+    assert lock.fd is None
+
+    # Back to shared when the exclusive request is released
+    with lock.shared():
+        with lock.exclusive():
+            pass
+        with other.shared():
+            pass
+        with pytest.raises(ValueError):
+            other.acquire(exclusive=True)
+    with other.exclusive():
+        pass
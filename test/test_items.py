@@ -1,7 +1,11 @@
 import pytest
 from testing import random_int, random_string, random_string_list, random_list_element
 from testing import random_item, random_field_list
-from items import ItemCollection, Item
+import items
+from items import ItemCollection, LazyItemCollection, LazyFieldCollection, Item, Field, FieldCollection
+from crypt import Crypt
+from uid import FieldUid
+from common import FIELD_NAME_KEY, FIELD_VALUE_KEY, FIELD_SENSITIVE_KEY, ITEM_FIELDS_KEY
 
 
 def test_item():
@@ -57,3 +61,119 @@ def test_remove_not_existent_item():
     ic = ItemCollection()
     with pytest.raises(KeyError):
         _ = ic.remove('some_key')
+
+
+def test_lazy_item_collection():
+    stored = {}
+    for _ in range(5):
+        it = Item(random_string(), [], random_string(), FieldCollection())
+        stored[it.get_id()] = it
+    loaded = []
+
+    def loader(uid: int) -> Item:
+        loaded.append(uid)
+        return stored[uid]
+
+    uid_list = sorted(stored.keys())
+    ic = LazyItemCollection(uid_list, loader)
+    assert len(ic) == 5
+    assert uid_list[0] in ic
+    assert max(uid_list) + 1 not in ic
+    assert loaded == []
+
+    assert ic.get(uid_list[0]) is stored[uid_list[0]]
+    assert ic.get(uid_list[0]) is stored[uid_list[0]]
+    assert loaded == [uid_list[0]]
+
+    ic.remove(uid_list[1])
+    assert uid_list[1] not in ic
+    with pytest.raises(KeyError):
+        ic.get(uid_list[1])
+
+    it = Item('new', [], '', FieldCollection())
+    ic.add(it)
+    assert len(ic) == 5
+    assert sorted(ic.keys()) == sorted(uid_list[:1] + uid_list[2:] + [it.get_id()])
+
+    ic.update(Item('updated', [], '', FieldCollection(), uid=uid_list[2]))
+    assert ic.get(uid_list[2]).get_name() == 'updated'
+    names = sorted((x.get_name(), x.get_id()) for x in ic.next())
+    assert len(names) == 5
+    assert sorted((name, uid) for uid, name in ic.next_name()) == names
+    assert len(ic.export()) == 5
+
+    # The names of the stored items are taken from the index, without creating the items
+    loaded.clear()
+    ic = LazyItemCollection(uid_list, loader, lambda: [stored[x].get_name() for x in uid_list])
+    ic.update(Item('updated', [], '', FieldCollection(), uid=uid_list[2]))
+    listing = list(ic.next_name())
+    assert [x for _, x in listing] == sorted(x for _, x in listing)
+    assert dict(listing) == {x: 'updated' if x == uid_list[2] else stored[x].get_name() for x in uid_list}
+    assert loaded == []
+
+
+def test_lazy_field_collection():
+    crypt = Crypt('test')
+    fc = FieldCollection()
+    fc.add(Field('user', 'bob'))
+    fc.add(Field('password', crypt.encrypt_str2str('secret'), True))
+    fc.add(Field('pin', 1234))
+    uid_next = FieldUid.uid_next
+
+    lazy = LazyFieldCollection(fc.export())
+    it = Item('item', [], '', lazy)
+    assert len(lazy) == 3
+    assert it.get_field_names() == ['password', 'pin', 'user']
+    assert field_values(lazy.export(crypt)) == field_values(fc.export(crypt))
+    assert not lazy.loaded()
+    assert FieldUid.uid_next == uid_next
+
+    # The fields are created when accessed
+    assert sorted(str(x.get_value()) for x in it.next_field() if not x.get_sensitive()) == ['1234', 'bob']
+    assert lazy.loaded()
+    assert len(lazy) == 3
+    assert it.get_field_names() == ['password', 'pin', 'user']
+    assert field_values(lazy.export(crypt)) == field_values(fc.export(crypt))
+    lazy.add(Field('url', 'x'))
+    assert len(lazy) == 4
+
+
+def test_export_decrypted(monkeypatch):
+    crypt = Crypt('test')
+    monkeypatch.setattr(items, 'EXPORT_BATCH_SIZE', 3)
+    ic = ItemCollection()
+    expected = {}
+    for n in range(10):
+        fc = FieldCollection()
+        fc.add(Field('user', f'user {n}'))
+        fc.add(Field('password', crypt.encrypt_str2str(f'secret {n}'), True))
+        it = Item(f'item {n}', [], '', fc)
+        ic.add(it)
+        expected[it.get_id()] = [('password', f'secret {n}', True), ('user', f'user {n}', False)]
+
+    exported = dict(ic.next_export(crypt=crypt))
+    assert {uid: field_values(d[ITEM_FIELDS_KEY]) for uid, d in exported.items()} == expected
+    assert all(x.get_value().startswith('gAAAA') for it in ic.next() for x in it.next_field() if x.get_sensitive())
+
+    lazy = LazyItemCollection(sorted(ic.keys()), ic.get)
+    assert {uid: field_values(d[ITEM_FIELDS_KEY]) for uid, d in lazy.next_export(crypt=crypt)} == expected
+
+
+def test_decrypted_value(monkeypatch):
+    crypt = Crypt('test')
+    field = Field('password', crypt.encrypt_str2str('secret'), True)
+    assert field.get_decrypted_value(crypt) == 'secret'
+
+    # The value decrypted is kept, until it changes or the cache is cleared
+    monkeypatch.setattr(crypt, 'decrypt_str2str', lambda _: 'decrypted again')
+    assert field.get_decrypted_value(crypt) == 'secret'
+    assert Field('password', field.get_value(), True).get_decrypted_value(crypt) == 'decrypted again'
+    field.value = crypt.encrypt_str2str('other')
+    assert field.get_decrypted_value(crypt) == 'decrypted again'
+    assert len(crypt.value_cache) == 3
+    crypt.value_cache.clear()
+    assert len(crypt.value_cache) == 0
+
+
+def field_values(json_fields: dict) -> list:
+    return sorted((x[FIELD_NAME_KEY], str(x[FIELD_VALUE_KEY]), x[FIELD_SENSITIVE_KEY]) for x in json_fields.values())
@@ -0,0 +1,115 @@
+import pytest
+from crypt import Crypt
+from db import Database
+from items import Item, Field, FieldCollection
+from journal import Journal, make_record, fold_record, RECORD_SEPARATOR, RENAME_OLD_KEY
+from journal import OP_TAG_ADD, OP_TAG_RENAME, OP_TAG_DELETE, OP_ITEM_PUT, OP_ITEM_DELETE
+from common import KEY_NAME, KEY_UID, ITEM_UID_KEY, DB_TAGS_KEY, DB_FIELDS_KEY, DB_ITEMS_KEY
+from uid import TagTableUid, FieldTableUid, FieldUid, ItemUid
+
+
+def clear_uid():
+    for uid_class in [TagTableUid, FieldTableUid, FieldUid, ItemUid]:
+        uid_class.clear()
+
+
+def create_database(file_name: str, password: str, journal: bool) -> Database:
+    clear_uid()
+    db = Database(file_name, password, journal=journal)
+    db.tag_table.add('web')
+    db.field_table.add('user')
+    db.field_table.add('password', sensitive=True)
+    for n in range(3):
+        fc = FieldCollection()
+        fc.add(Field('user', f'user{n}'))
+        item = Item(f'item{n}', [db.tag_table.get_uid('web')], f'note {n}', fc, time_stamp=n)
+        db.item_collection.add(item)
+    db.write()
+    return db
+
+
+def test_journal_records(tmp_path):
+    for crypt_key in [None, Crypt('test')]:
+        j = Journal(str(tmp_path / 'test.journal'), crypt_key, generation='abc')
+        assert len(j) == 0
+        j.append([make_record(OP_TAG_ADD, {KEY_NAME: 'one', KEY_UID: 10})])
+        j.append([make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1000})])
+        assert list(j.next()) == [make_record(OP_TAG_ADD, {KEY_NAME: 'one', KEY_UID: 10}),
+                                  make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1000})]
+        assert len(j) == 2
+        assert j.get_generation() == 'abc'
+        assert j.is_current() is True
+        j.remove()
+        assert j.exists() is False
+
+
+def test_journal_partial_record(tmp_path):
+    j = Journal(str(tmp_path / 'test.journal'))
+    j.append([make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1000})])
+    with open(j.file_name, 'ab') as f:
+        f.write(b'{"op": "item_')
+    assert len(j) == 1
+    j.append([make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1001})])
+    assert len(j) == 2
+    with open(j.file_name, 'rb') as f:
+        assert f.read().count(RECORD_SEPARATOR) == 3
+
+
+def test_journal_generation(tmp_path):
+    j = Journal(str(tmp_path / 'test.journal'), generation='one')
+    j.append([make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1000})])
+    j.generation = 'two'
+    assert j.is_current() is False
+    j.append([make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1001})])
+    assert j.get_generation() == 'two'
+    assert list(j.next()) == [make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1001})]
+
+
+def test_fold_record():
+    json_data = {DB_TAGS_KEY: [], DB_FIELDS_KEY: [], DB_ITEMS_KEY: {'1000': {ITEM_UID_KEY: 1000}}}
+    fold_record(json_data, make_record(OP_TAG_ADD, {KEY_NAME: 'one', KEY_UID: 10}))
+    fold_record(json_data, make_record(OP_TAG_RENAME, {RENAME_OLD_KEY: 'one', KEY_NAME: 'two'}))
+    assert json_data[DB_TAGS_KEY] == [{KEY_NAME: 'two', KEY_UID: 10}]
+    with pytest.raises(KeyError):
+        fold_record(json_data, make_record(OP_TAG_ADD, {KEY_NAME: 'two', KEY_UID: 11}))
+    fold_record(json_data, make_record(OP_TAG_DELETE, {KEY_NAME: 'two'}))
+    assert json_data[DB_TAGS_KEY] == []
+    fold_record(json_data, make_record(OP_ITEM_PUT, {ITEM_UID_KEY: 1001}))
+    fold_record(json_data, make_record(OP_ITEM_DELETE, {ITEM_UID_KEY: 1000}))
+    assert list(json_data[DB_ITEMS_KEY].keys()) == ['1001']
+
+
+def test_journal_replay(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        file_name = f'db{len(password)}.db'
+        db = create_database(file_name, password, True)
+        size = (tmp_path / file_name).stat().st_size
+
+        # Change the database and write the changes to the journal
+        uid_1, uid_2, uid_3 = sorted(db.item_collection.keys())
+        item = db.item_collection.get(uid_2)
+        new_item = Item('renamed', item.get_tags(), item.get_note(), FieldCollection(), uid=item.get_id())
+        db.item_collection.update(new_item)
+        db.record(OP_ITEM_PUT, new_item.export())
+        db.item_collection.remove(uid_3)
+        db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid_3})
+        db.write()
+        assert (tmp_path / file_name).stat().st_size == size
+        assert len(db.journal) == 2
+
+        # Read the database back
+        clear_uid()
+        db = Database(file_name, password, journal=True)
+        db.read()
+        assert sorted(db.item_collection.keys()) == [uid_1, uid_2]
+        assert db.item_collection.get(uid_2).get_name() == 'renamed'
+        assert db.tag_table.count(name='web') == 2
+
+        # A full write folds the journal into the file
+        db.write(snapshot=True)
+        assert db.journal.exists() is False
+        clear_uid()
+        db = Database(file_name, password)
+        db.read()
+        assert sorted(db.item_collection.keys()) == [uid_1, uid_2]
@@ -0,0 +1,105 @@
+import io
+import json
+import pytest
+from db import Database
+from json_stream import JsonStreamReader, encode_object
+from journal import OP_TAG_ADD, OP_ITEM_PUT, OP_ITEM_DELETE
+from items import Item, FieldCollection
+from testing import random_database
+from common import KEY_NAME, KEY_UID, ITEM_UID_KEY, DB_GENERATION_KEY, DB_HASH_KEY, DB_COUNTS_KEY
+from common import DB_DIGESTS_KEY
+from digest import encode_digests
+from uid import clear_all
+from test_binary_format import field_values
+
+DATA = {'one': 1, 'empty': {}, 'many': {'a': [1, 2, 3], 'b': {'c': 3.5, 'd': 'text ü'}}, 'last': 12345}
+
+
+def test_reader():
+    for chunk_size in [1, 3, 1000]:
+        r = JsonStreamReader(io.StringIO(json.dumps(DATA, indent=2)), chunk_size=chunk_size)
+        d = {}
+        for key in r.members():
+            if key == 'many':
+                d[key] = {}
+                for m in r.members():
+                    d[key][m] = r.value()
+            else:
+                d[key] = r.value()
+        assert d == DATA
+
+
+def test_reader_errors():
+    for data in ['', '[1, 2]', '{"a": 1', '{"a": 1 "b": 2}', '{1: 2}', '{"a" 1}', '{"a": [1, 2}']:
+        r = JsonStreamReader(io.StringIO(data), chunk_size=2)
+        with pytest.raises(ValueError):
+            for _ in r.members():
+                r.value()
+
+
+def test_stream_read(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for file_name, password in [('plain.db', ''), ('encrypted.db', 'test')]:
+        clear_all()
+        db = Database(file_name, password, journal=True)
+        random_database(db, 20)
+        db.write()
+        uid_list = sorted(db.item_collection.keys())
+
+        # Journal with table and item changes
+        db.tag_table.add('new_tag')
+        db.record(OP_TAG_ADD, {KEY_NAME: 'new_tag', KEY_UID: db.tag_table.get_uid('new_tag')})
+        db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid_list[0]})
+        item = Item('new', [db.tag_table.get_uid('new_tag')], '', FieldCollection())
+        db.record(OP_ITEM_PUT, item.export())
+        db.write()
+
+        result = []
+        for stream in [False, True]:
+            clear_all()
+            db = Database(file_name, password, journal=True)
+            db.read(stream=stream)
+            assert len(db.item_collection) == 20
+            assert uid_list[0] not in db.item_collection
+            # The field uid depend on the order the items are created
+            result.append((field_values(db.export()), [str(x) for x in db.tag_table.next()],
+                           [str(x) for x in db.field_table.next()]))
+        assert result[0] == result[1]
+
+
+def test_stream_read_bad_data(tmp_path):
+    file_name = str(tmp_path / 'bad.db')
+    with open(file_name, 'w') as f:
+        f.write('{"tags": [], "fields": [], "items": {"1": {"name": ')
+    db = Database(file_name)
+    with pytest.raises(ValueError):
+        db.read()
+    assert len(db.item_collection) == 0
+
+
+def test_encode_object():
+    members = [('one', 1), ('empty', iter([])), ('many', iter([('a', [1, 2, 3]), ('b', {'c': 3.5, 'd': 'text ü'})])),
+               ('last', 12345)]
+    assert json.loads(''.join(encode_object(members))) == DATA
+    assert ''.join(encode_object([])) == '{}'
+
+
+def test_stream_write(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for file_name, password in [('plain.db', ''), ('encrypted.db', 'test')]:
+        clear_all()
+        db = Database(file_name, password)
+        random_database(db, 20)
+        db.write()
+        with open(file_name, 'rb') as f:
+            json_data = db.engine.decode(f.read())
+        assert json_data[DB_GENERATION_KEY] == db.journal.generation
+        assert json_data[DB_HASH_KEY] == db.content_hash == db.digest()
+        assert json_data[DB_COUNTS_KEY] == json.loads(json.dumps(db.counts(db.journal.generation)))
+        assert json_data[DB_DIGESTS_KEY] == encode_digests(db.item_digests())
+        del json_data[DB_GENERATION_KEY], json_data[DB_HASH_KEY], json_data[DB_COUNTS_KEY], json_data[DB_DIGESTS_KEY]
+        assert json_data == json.loads(json.dumps(db.export()))
+
+        db.export_to_json('export.json')
+        with open('export.json') as f:
+            assert json.load(f) == json.loads(json.dumps(db.export(crypt=db.crypt_key)))
@@ -0,0 +1,42 @@
+import pytest
+from kdf import new_parameters, check_parameters, derive_key, calibrate, LEGACY_PARAMETERS
+from kdf import KDF_PBKDF2, KDF_SCRYPT, KDF_SALT_KEY, KDF_ITERATIONS_KEY, KDF_N_KEY, MAX_ITERATIONS
+from kdf import MAX_SCRYPT_N
+
+
+def test_parameters():
+    for algorithm in [KDF_PBKDF2, KDF_SCRYPT]:
+        parameters = new_parameters(algorithm)
+        assert check_parameters(parameters) == parameters
+        assert new_parameters(algorithm)[KDF_SALT_KEY] != parameters[KDF_SALT_KEY]
+    assert check_parameters(LEGACY_PARAMETERS) == LEGACY_PARAMETERS
+    for good in [dict(new_parameters(KDF_SCRYPT), n=MAX_SCRYPT_N), dict(new_parameters(KDF_SCRYPT), r=16, p=4)]:
+        assert check_parameters(good) == good
+    with pytest.raises(ValueError):
+        new_parameters('unknown')
+    for bad in [{}, dict(LEGACY_PARAMETERS, salt='xyz'), dict(LEGACY_PARAMETERS, iterations=MAX_ITERATIONS + 1),
+                dict(LEGACY_PARAMETERS, iterations=True), dict(LEGACY_PARAMETERS, iterations=1000.0),
+                dict(new_parameters(KDF_SCRYPT), n=1000), dict(new_parameters(KDF_SCRYPT), n=None),
+                dict(new_parameters(KDF_SCRYPT), n=MAX_SCRYPT_N, r=16),
+                dict(new_parameters(KDF_SCRYPT), n=MAX_SCRYPT_N, p=2), dict(new_parameters(KDF_SCRYPT), p=True),
+                dict(new_parameters(KDF_SCRYPT), n=1 << 10, r=1 << 20)]:
+        with pytest.raises(ValueError):
+            check_parameters(bad)
+
+
+def test_derive_key():
+    for algorithm, cost in [(KDF_PBKDF2, 1000), (KDF_SCRYPT, 1 << 10)]:
+        parameters = new_parameters(algorithm, cost)
+        key = derive_key('password', parameters)
+        assert derive_key('password', parameters) == key
+        assert derive_key('other', parameters) != key
+        assert derive_key('password', new_parameters(algorithm, cost)) != key
+
+
+def test_calibrate():
+    cost, t = calibrate(KDF_PBKDF2, 0.02)
+    assert cost >= 10000 and t > 0
+    cost, t = calibrate(KDF_SCRYPT, 0.02)
+    assert cost >= 1 << 10 and cost & (cost - 1) == 0
+    assert check_parameters(new_parameters(KDF_SCRYPT, cost))[KDF_N_KEY] == cost
+    assert new_parameters(KDF_PBKDF2, 5000)[KDF_ITERATIONS_KEY] == 5000
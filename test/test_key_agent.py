@@ -0,0 +1,50 @@
+import os
+import threading
+import crypt
+from crypt import Crypt
+from key_agent import KeyAgent, KEY_AGENT_ENV, AGENT_OP_KEY, OP_CLEAR, get_key, put_key, request
+
+
+def start_agent(socket_name: str, timeout=None) -> tuple[KeyAgent, threading.Thread]:
+    agent = KeyAgent(socket_name, timeout)
+    thread = threading.Thread(target=agent.serve, daemon=True)
+    thread.start()
+    return agent, thread
+
+
+def test_key_agent(tmp_path, monkeypatch):
+    socket_name = str(tmp_path / 'agent.sock')
+    monkeypatch.setenv(KEY_AGENT_ENV, socket_name)
+    assert get_key('password', 'test') is None
+    agent, thread = start_agent(socket_name, 0.5)
+    assert os.stat(socket_name).st_mode & 0o077 == 0
+
+    # The key is only returned for the same password and parameters
+    put_key('password', 'test', b'key')
+    assert get_key('password', 'test') == b'key'
+    assert get_key('other', 'test') is None
+    assert get_key('password', 'other') is None
+    assert request({AGENT_OP_KEY: OP_CLEAR})
+    assert get_key('password', 'test') is None
+
+    # The agent stops when idle
+    thread.join(5)
+    assert not thread.is_alive() and not agent.keys
+    assert not os.path.exists(socket_name)
+    assert get_key('password', 'test') is None
+
+
+def test_crypt_agent(tmp_path, monkeypatch):
+    socket_name = str(tmp_path / 'agent.sock')
+    monkeypatch.setenv(KEY_AGENT_ENV, socket_name)
+    agent, thread = start_agent(socket_name)
+    data = Crypt('password').encrypt_str2str('message')
+    assert len(agent.keys) == 1
+
+    # The key is not derived again
+    monkeypatch.setattr(crypt, 'derive_key', None)
+    assert Crypt('password').decrypt_str2str(data) == 'message'
+    agent.running = False
+    request({AGENT_OP_KEY: OP_CLEAR})
+    thread.join(5)
+    assert not thread.is_alive()
@@ -12,6 +12,10 @@ def test_keywords():
     assert lx.token('read') == Token(Tid.READ, 'read')
     assert lx.token('write') == Token(Tid.WRITE, 'write')
     assert lx.token('export') == Token(Tid.EXPORT, 'export')
+    assert lx.token('compact') == Token(Tid.COMPACT, 'compact')
+    assert lx.token('verify') == Token(Tid.VERIFY, 'verify')
+    assert lx.token('restore') == Token(Tid.RESTORE, 'restore')
+    assert lx.token('calibrate') == Token(Tid.CALIBRATE, 'calibrate')
 
     assert lx.token('list') == Token(Tid.LIST, 'list')
     assert lx.token('search') == Token(Tid.SEARCH, 'search')
@@ -36,6 +40,14 @@ def test_switches():
     assert lx.token('-fv') == Token(Tid.SW_FIELD_VALUE, True)
     assert lx.token('-note') == Token(Tid.SW_NOTE, True)
     assert lx.token('-ml') == Token(Tid.SW_MULTILINE_NOTE, True)
+    assert lx.token('-j') == Token(Tid.SW_JOURNAL, True)
+    assert lx.token('-b') == Token(Tid.SW_BINARY, True)
+    assert lx.token('-l') == Token(Tid.SW_LAZY, True)
+    assert lx.token('-z') == Token(Tid.SW_COMPRESS, True)
+    assert lx.token('-d') == Token(Tid.SW_DURABILITY, True)
+    assert lx.token('-e') == Token(Tid.SW_ENGINE, True)
+    assert lx.token('-ro') == Token(Tid.SW_READ_ONLY, True)
+    assert lx.token('-c') == Token(Tid.SW_CIPHER, True)
 
 
 def test_expressions():
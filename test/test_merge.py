@@ -0,0 +1,25 @@
+from merge import merge_entries, duplicate_names
+
+
+def test_merge_entries():
+    base = {1: 'a', 2: 'b', 3: 'c', 4: 'd', 5: 'e'}
+    ours = {1: 'x', 2: 'b', 3: 'y', 4: 'd', 5: 'z', 6: 'o', 7: 's'}
+    theirs = {1: 'a', 2: 'w', 3: 'v', 5: 'z', 6: 't', 7: 's', 8: 'n'}
+    changes, added, conflicts = merge_entries(base, ours, theirs)
+    # Changed only on their side (2), removed on their side (4), added on their side (8)
+    assert changes == {2: 'w', 4: None, 8: 'n'}
+    assert added == [6]
+    assert conflicts == [3]
+
+
+def test_merge_removed():
+    # Removed on one side and changed on the other
+    assert merge_entries({1: 'a'}, {}, {1: 'b'}) == ({}, [], [1])
+    assert merge_entries({1: 'a'}, {1: 'b'}, {}) == ({}, [], [1])
+    # Removed on both sides
+    assert merge_entries({1: 'a'}, {}, {}) == ({}, [], [])
+
+
+def test_duplicate_names():
+    assert duplicate_names([{'name': 'b'}, {'name': 'a'}, {'name': 'b'}], 'name') == ['b']
+    assert duplicate_names([], 'name') == []
@@ -0,0 +1,531 @@
+import os
+import json
+import pytest
+from db import Database, ENGINES
+from storage import StorageEngine, ENGINE_FILE, ENGINE_SQLITE, ENGINE_SHARD
+from shard_engine import SHARD_FILE_KEY, SHARD_COUNT_KEY
+from items import Item, Field, FieldCollection, LazyItemCollection
+from journal import OP_ITEM_PUT, OP_ITEM_DELETE, OP_TAG_ADD
+from common import KEY_NAME, KEY_UID, ITEM_UID_KEY, DB_TAGS_KEY, DB_FIELDS_KEY, FORMAT_JSON, FORMAT_BINARY
+from common import ITEM_NAME_KEY, DB_ITEMS_KEY, DB_DIGESTS_KEY, ITEM_FIELDS_KEY, ITEM_TAG_LIST_KEY
+from common import FIELD_VALUE_KEY, FIELD_SENSITIVE_KEY
+from testing import random_database
+from digest import item_digests
+from file_lock import lock_file_name
+from test_binary_format import field_values
+from uid import clear_all, ItemUid, TagTableUid, FieldTableUid
+from crypt import Crypt, CIPHER_AES_GCM, CIPHER_KEY, is_aead_token
+from kdf import new_parameters, LEGACY_PARAMETERS, KDF_SCRYPT
+
+
+def item_values(json_data: dict) -> dict:
+    """
+    Return the item fields (see field_values()) by uid, as a string
+    """
+    return {str(uid): fields for uid, fields in field_values(json_data).items()}
+
+
+def read_database(file_name: str, password: str, engine: str) -> Database:
+    clear_all()
+    db = Database(file_name, password, engine=engine)
+    db.read()
+    return db
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_engine(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    for password in ['', 'test']:
+        file_name = f'test{password}.db'
+        clear_all()
+        db = Database(file_name, password, engine=engine)
+        assert isinstance(db.engine, StorageEngine)
+        assert db.engine.name == engine
+        assert not db.engine.exists()
+        random_database(db, 20)
+        assert db.write()
+        assert db.engine.exists()
+        assert not db.write()
+        json_data = db.export()
+
+        # Read
+        db = read_database(file_name, password, engine)
+        assert item_values(db.export()) == item_values(json_data)
+        loaded = db.load()
+        assert item_values(loaded) == item_values(json_data)
+        for key in [DB_TAGS_KEY, DB_FIELDS_KEY]:
+            assert loaded[key] == json_data[key]
+
+        # Changes
+        item = Item('new', [], '', FieldCollection())
+        db.item_collection.add(item)
+        db.record(OP_ITEM_PUT, item.export())
+        uid = db.item_collection.keys()[0]
+        db.item_collection.remove(uid)
+        db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid})
+        assert db.write()
+        json_data = db.export()
+        db = read_database(file_name, password, engine)
+        assert item_values(db.export()) == item_values(json_data)
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        Database('test.db', engine='unknown')
+
+
+def test_sqlite_search(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', engine=ENGINE_SQLITE)
+    random_database(db, 50)
+    db.write()
+    # Same contents searched in memory
+    reference = Database('reference.db')
+    reference.tag_table, reference.item_collection = db.tag_table, db.item_collection
+    flag_list = [(True, False, False, False), (False, True, False, False), (False, False, True, False),
+                 (False, False, False, True), (True, True, True, True)]
+    for pattern in ['a', 'e.*o', '^x', 'nothing here']:
+        for item_name_flag, tag_flag, field_name_flag, note_flag in flag_list:
+            expected = [x.uid for x in reference.search(pattern, item_name_flag, tag_flag, field_name_flag, False, note_flag)]
+            assert db.engine.search(pattern, item_name_flag, tag_flag, field_name_flag, False, note_flag) == expected
+
+    # Not searched in SQL
+    assert db.engine.search('a', field_value_flag=True) is None
+    db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: db.item_collection.keys()[0]})
+    assert db.search('.')
+    db.pending_records = []
+
+    # Lazy read
+    expected = [x.uid for x in reference.search('a', True, True, True, False, True)]
+    clear_all()
+    db = Database('test.db', engine=ENGINE_SQLITE)
+    db.read(lazy=True)
+    assert sorted(db.item_collection.next_name()) == sorted((x.uid, x.name) for x in reference.item_collection.next())
+    assert len(db.item_collection.data) == 0
+    assert [x.uid for x in db.search('a', True, True, True, False, True)] == expected
+
+
+def test_sqlite_password(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', 'good', engine=ENGINE_SQLITE)
+    random_database(db, 5)
+    db.write()
+    for password in ['', 'bad']:
+        with pytest.raises(ValueError):
+            read_database('test.db', password, ENGINE_SQLITE)
+    with pytest.raises(FileNotFoundError):
+        read_database('missing.db', '', ENGINE_SQLITE)
+
+
+def test_shards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', 'test', engine=ENGINE_SHARD)
+    db.engine.shard_count = 4
+    random_database(db, 20)
+    db.write()
+    shard_list = db.engine.shard_list
+    assert sorted(os.listdir(tmp_path)) == sorted(['test.db', lock_file_name('test.db')] +
+                                                  [x[SHARD_FILE_KEY] for x in shard_list])
+    assert sum(x[SHARD_COUNT_KEY] for x in shard_list) == 20
+
+    # Shards read by several processes
+    clear_all()
+    db = Database('test.db', 'test', engine=ENGINE_SHARD)
+    db.engine.workers = 2
+    db.read()
+    assert db.engine.shard_count == 4
+    assert len(db.item_collection) == 20
+
+    # Only the shard of the changed item is written
+    uid = db.item_collection.keys()[0]
+    item = db.item_collection.get(uid)
+    item.name = 'changed'
+    db.record(OP_ITEM_PUT, item.export())
+    assert db.write()
+    changed = [n for n in range(4) if db.engine.shard_list[n] != shard_list[n]]
+    assert changed == [uid % 4]
+    assert len(os.listdir(tmp_path)) == 6
+    json_data = db.export()
+    db = read_database('test.db', 'test', ENGINE_SHARD)
+    assert item_values(db.export()) == item_values(json_data)
+
+
+def table_counts(db: Database) -> tuple[dict, dict]:
+    return dict(db.tag_table.count_dict), dict(db.field_table.count_dict)
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_counts(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    count_items = Database.count_items
+    calls = []
+
+    def counted(self):
+        calls.append(self)
+        count_items(self)
+
+    monkeypatch.setattr(Database, 'count_items', counted)
+    for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+        file_name = f'test-{file_format}.db'
+        clear_all()
+        db = Database(file_name, journal=True, file_format=file_format, engine=engine)
+        random_database(db, 30)
+        # Item added without updating the counters, as the commands do
+        fc = FieldCollection()
+        fc.add(Field(db.field_table.export()[0][KEY_NAME], 'value'))
+        db.item_collection.add(Item('new', [db.tag_table.export()[0][KEY_UID]], '', fc))
+        db.write()
+
+        # Counted again
+        clear_all()
+        db = Database(file_name, engine=engine)
+        db.recount = True
+        db.read()
+        expected = table_counts(db)
+        assert sum(expected[1].values()) == db.field_table.total() > 0
+
+        # Stored counters
+        calls.clear()
+        db = read_database(file_name, '', engine)
+        assert table_counts(db) == expected
+        assert not calls
+
+        # Changes not included in the stored counters
+        uid = db.item_collection.keys()[0]
+        db.update_tables(db.item_collection.get(uid), n=-1)
+        db.item_collection.remove(uid)
+        db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid})
+        db.journal_enabled = True
+        db.write()
+        expected = table_counts(db)
+        db = read_database(file_name, '', engine)
+        assert table_counts(db) == expected
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_read_only(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', 'test', engine=engine)
+    random_database(db, 20)
+    db.write()
+    json_data = db.export()
+
+    clear_all()
+    db = Database('test.db', 'test', engine=engine, read_only=True)
+    db.read()
+    assert item_values(db.export()) == item_values(json_data)
+    assert ItemUid.uid_list == [] and TagTableUid.uid_list == [] and FieldTableUid.uid_list == []
+    assert len(db.search('.')) == 20
+    for item in db.item_collection.next():
+        assert len(list(item.next_field())) == len(item.get_field_names())
+    with pytest.raises(ValueError):
+        db.write()
+    with pytest.raises(ValueError):
+        db.save(force=True)
+
+
+@pytest.mark.parametrize('engine', [ENGINE_FILE, ENGINE_SQLITE])
+def test_refresh_lazy(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', engine=engine, file_format=FORMAT_BINARY)
+    random_database(db, 20)
+    db.write()
+
+    clear_all()
+    reader = Database('test.db', engine=engine, read_only=True)
+    reader.read(lazy=True)
+    assert isinstance(reader.item_collection, LazyItemCollection)
+
+    # Another process writes the database, and it's read again lazily
+    item = Item('new', [], '', FieldCollection())
+    db.item_collection.add(item)
+    db.record(OP_ITEM_PUT, item.export())
+    db.write()
+    assert reader.refresh()
+    assert isinstance(reader.item_collection, LazyItemCollection)
+    assert len(reader.item_collection.data) == 0
+    assert item_values(reader.export()) == item_values(db.export())
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_verify(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', 'test', engine=engine)
+    random_database(db, 20)
+    db.write()
+    assert db.verify() == (True, [], [])
+
+    # Only the items changed since the database was read are hashed when writing
+    db = read_database('test.db', 'test', engine)
+    hashed = []
+
+    def spy(items):
+        items = list(items)
+        hashed.extend(x for x, _ in items)
+        return item_digests(items)
+
+    monkeypatch.setattr('db.item_digests', spy)
+    uid = db.item_collection.keys()[0]
+    db.record(OP_ITEM_PUT, db.item_collection.get(uid).export())
+    assert len(db.item_digests()) == 20
+    assert hashed == [uid]
+
+    # Incremental writes keep the item hashes
+    db.write()
+    root_ok, corrupted, missing = db.verify(workers=2)
+    assert root_ok is (True if engine == ENGINE_FILE else None) and corrupted == [] and missing == []
+
+
+@pytest.mark.parametrize('file_format', [FORMAT_JSON, FORMAT_BINARY])
+def test_verify_corrupted(tmp_path, monkeypatch, file_format):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('digest.MIN_ITEMS_PER_WORKER', 5)
+    clear_all()
+    db = Database('test.db', file_format=file_format)
+    random_database(db, 20)
+    db.write()
+    uid_list = sorted(db.item_collection.keys())
+
+    # Change an item and remove the hash of another one behind the engine
+    json_data = db.load()
+    json_data[DB_ITEMS_KEY][str(uid_list[3])][ITEM_NAME_KEY] = 'changed'
+    del json_data[DB_DIGESTS_KEY][str(uid_list[5])]
+    with open('test.db', 'wb') as f:
+        f.write(db.engine.encode(json_data))
+    assert db.verify(workers=2) == (False, [uid_list[3]], [uid_list[5]])
+
+    # Changes in the journal are not covered by the content hash
+    clear_all()
+    db = Database('test.db', journal=True)
+    db.read()
+    db.item_collection.remove(uid_list[3])
+    db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid_list[3]})
+    db.write()
+    assert db.verify() == (None, [], [uid_list[5]])
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_changed(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', engine=engine, journal=True)
+    random_database(db, 20)
+    db.write()
+    assert not db.changed()
+    assert not db.refresh()
+
+    # Another process writes the database
+    clear_all()
+    other = Database('test.db', engine=engine, journal=True)
+    other.read()
+    item = Item('new', [], '', FieldCollection())
+    other.item_collection.add(item)
+    other.record(OP_ITEM_PUT, item.export())
+    other.write()
+    assert db.changed() and not other.changed()
+
+    # Read it again
+    assert db.refresh()
+    assert not db.changed()
+    assert item_values(db.export()) == item_values(other.export())
+    db.item_collection.remove(item.uid)
+    db.record(OP_ITEM_DELETE, {ITEM_UID_KEY: item.uid})
+    assert db.write()
+    assert other.changed()
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+@pytest.mark.parametrize('read_only', [False, True])
+def test_readers_unchanged(tmp_path, monkeypatch, engine, read_only):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', engine=engine)
+    random_database(db, 20)
+    db.write()
+
+    # Opening the database from other processes is not a change
+    readers = []
+    for _ in range(2):
+        clear_all()
+        reader = Database('test.db', engine=engine, read_only=read_only)
+        reader.read()
+        readers.append(reader)
+    assert not any(x.changed() for x in [db] + readers)
+
+
+def test_failed_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', journal=True)
+    random_database(db, 20)
+    db.write()
+    item = Item('new', [], '', FieldCollection())
+    db.item_collection.add(item)
+    db.record(OP_ITEM_PUT, item.export())
+
+    # The changes are kept if the snapshot cannot be written
+    def fail(self):
+        raise OSError('disk full')
+    with monkeypatch.context() as patch:
+        patch.setattr('durable.AtomicFile.commit', fail)
+        with pytest.raises(Exception):
+            db.write(snapshot=True)
+    assert db.pending_records
+    assert db.write()
+    stored = read_database('test.db', '', ENGINE_FILE)
+    assert item.uid in stored.item_collection
+    assert item_values(stored.export()) == item_values(db.export())
+
+
+def rename_item(db: Database, uid: int, name: str):
+    item = db.item_collection.get(uid)
+    item.name = name
+    db.record(OP_ITEM_PUT, item.export())
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_merge(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', engine=engine, journal=True)
+    random_database(db, 20)
+    db.write()
+    clear_all()
+    other = Database('test.db', engine=engine, journal=True)
+    other.read()
+    uid_list = db.item_collection.keys()
+    new_uid = max(uid_list) + 1
+
+    # Each side changes different items, adds a tag, and adds an item with the same uid
+    rename_item(db, uid_list[0], 'ours')
+    rename_item(other, uid_list[1], 'theirs')
+    other.item_collection.remove(uid_list[2])
+    other.record(OP_ITEM_DELETE, {ITEM_UID_KEY: uid_list[2]})
+    for side, name in [(db, 'ours'), (other, 'theirs')]:
+        side.tag_table.add(f'tag {name}')
+        tag_uid = side.tag_table.get_uid(f'tag {name}')
+        side.record(OP_TAG_ADD, {KEY_NAME: f'tag {name}', KEY_UID: tag_uid})
+        item = Item(f'new {name}', [tag_uid], '', FieldCollection(), uid=new_uid)
+        side.item_collection.add(item)
+        side.record(OP_ITEM_PUT, item.export())
+    assert other.write()
+    assert db.write()
+    assert not db.changed() and other.changed()
+
+    names = sorted(item.name for item in db.item_collection.next())
+    assert len(names) == 21 and {'ours', 'theirs', 'new ours', 'new theirs'} <= set(names)
+    assert uid_list[2] not in db.item_collection
+    assert db.item_collection.get(new_uid).name == 'new theirs'
+    assert {'tag ours', 'tag theirs'} <= set(db.tag_table.name_dict)
+    stored = read_database('test.db', '', engine)
+    assert item_values(stored.export()) == item_values(db.export())
+    assert table_counts(stored) == table_counts(db)
+
+    # The same item changed on both sides
+    other = read_database('test.db', '', engine)
+    rename_item(other, uid_list[3], 'theirs')
+    assert other.write()
+    rename_item(db, uid_list[3], 'ours')
+    with pytest.raises(ValueError):
+        db.write()
+    assert db.item_collection.get(uid_list[3]).name == 'ours'
+    assert db.changed()
+
+
+@pytest.mark.parametrize('engine', [ENGINE_FILE, ENGINE_SQLITE])
+def test_merge_records(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db', engine=engine, journal=True)
+    random_database(db, 20)
+    db.write()
+    clear_all()
+    other = Database('test.db', engine=engine, journal=True)
+    other.read()
+    new_uid = max(db.item_collection.keys()) + 1
+
+    # Both sides add a tag and an item with the same uid
+    for side, name in [(db, 'ours'), (other, 'theirs')]:
+        side.tag_table.add(f'tag {name}')
+        tag_uid = side.tag_table.get_uid(f'tag {name}')
+        side.record(OP_TAG_ADD, {KEY_NAME: f'tag {name}', KEY_UID: tag_uid})
+        item = Item(f'new {name}', [tag_uid], '', FieldCollection(), uid=new_uid)
+        side.item_collection.add(item)
+        side.record(OP_ITEM_PUT, item.export())
+    assert other.write()
+
+    # The changes not written yet refer to the new uid of the tag and the item
+    db.merge()
+    ours = next(x for x in db.item_collection.next() if x.name == 'new ours')
+    assert ours.get_id() != new_uid
+    puts = [x['data'] for x in db.pending_records if x['op'] == OP_ITEM_PUT]
+    assert [(x[ITEM_UID_KEY], x[ITEM_TAG_LIST_KEY]) for x in puts] == [(ours.get_id(), ours.get_tags())]
+
+    # And they can be applied to the version they were merged with
+    db.signature = db.engine.signature()
+    assert db.write()
+    stored = read_database('test.db', '', engine)
+    assert item_values(stored.export()) == item_values(db.export())
+    assert table_counts(stored) == table_counts(db)
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_kdf(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    parameters = new_parameters(KDF_SCRYPT, 1 << 10)
+    db = Database('test.db', 'test', engine=engine, kdf=parameters)
+    random_database(db, 10)
+    db.write()
+    assert db.engine.kdf_parameters() == parameters
+
+    # The stored parameters are used instead of those specified
+    clear_all()
+    other = Database('test.db', 'test', engine=engine, kdf=new_parameters(KDF_SCRYPT, 1 << 11))
+    assert other.crypt_key.parameters == parameters
+    other.read()
+    assert item_values(other.export()) == item_values(db.export())
+
+
+@pytest.mark.parametrize('engine', list(ENGINES.keys()))
+def test_cipher(tmp_path, monkeypatch, engine):
+    monkeypatch.chdir(tmp_path)
+    for file_format in [FORMAT_JSON, FORMAT_BINARY]:
+        file_name = f'test-{file_format}.db'
+        clear_all()
+        db = Database(file_name, 'test', engine=engine, file_format=file_format, cipher=CIPHER_AES_GCM)
+        random_database(db, 20)
+        db.write()
+        assert db.engine.kdf_parameters()[CIPHER_KEY] == CIPHER_AES_GCM
+        sensitive = [f[FIELD_VALUE_KEY] for x in db.export()[DB_ITEMS_KEY].values()
+                     for f in x[ITEM_FIELDS_KEY].values() if f[FIELD_SENSITIVE_KEY]]
+        assert sensitive and all(is_aead_token(x) for x in sensitive)
+
+        # The stored cipher is used, and the values read are the same tokens
+        clear_all()
+        other = Database(file_name, 'test', engine=engine)
+        assert other.crypt_key.cipher == CIPHER_AES_GCM
+        other.read()
+        assert item_values(other.export()) == item_values(db.export())
+        assert item_values(other.export(other.crypt_key)) == item_values(db.export(db.crypt_key))
+
+
+def test_kdf_legacy(tmp_path, monkeypatch):
+    # Files encrypted as a single token have no parameters
+    monkeypatch.chdir(tmp_path)
+    clear_all()
+    db = Database('test.db')
+    random_database(db, 10)
+    with open('test.db', 'wb') as f:
+        f.write(Crypt('test').encrypt_byte2byte(json.dumps(db.export()).encode()))
+    clear_all()
+    legacy = Database('test.db', 'test')
+    assert legacy.crypt_key.parameters == LEGACY_PARAMETERS
+    legacy.read()
+    assert item_values(legacy.export()) == item_values(db.export())
@@ -0,0 +1,52 @@
+from value_cache import ValueCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru():
+    cache = ValueCache(max_size=2, ttl=10, clock=Clock())
+    cache.put((1, 'a'), 'one')
+    cache.put((2, 'b'), 'two')
+    assert cache.get((1, 'a')) == 'one'
+
+    # The least recently used value is dropped
+    cache.put((3, 'c'), 'three')
+    assert len(cache) == 2
+    assert cache.get((2, 'b')) is None
+    assert cache.get((1, 'a')) == 'one'
+    assert cache.get((3, 'c')) == 'three'
+    assert cache.get((1, 'x')) is None
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get((1, 'a')) is None
+
+
+def test_ttl():
+    clock = Clock()
+    cache = ValueCache(max_size=10, ttl=10, clock=clock)
+    cache.put((1, 'a'), 'one')
+    clock.now = 5
+    cache.put((2, 'b'), 'two')
+    assert cache.get((1, 'a')) == 'one'
+
+    # Using a value doesn't keep it longer
+    clock.now = 10
+    assert cache.get((1, 'a')) is None
+    assert cache.get((2, 'b')) == 'two'
+    assert len(cache) == 1
+    clock.now = 15
+    assert cache.get((2, 'b')) is None
+
+
+def test_disabled():
+    cache = ValueCache(max_size=0)
+    cache.put((1, 'a'), 'one')
+    assert cache.get((1, 'a')) is None
+    assert len(cache) == 0
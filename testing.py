@@ -1,5 +1,6 @@
 import random
 import string
+from db import Database
 from items import Item, Field, FieldCollection
 
 RANDOM_WORDS = ['cow', 'horse', 'sheep', 'duck', 'chicken', 'donkey',
@@ -139,6 +140,34 @@ def random_item() -> Item:
                 random_field_collection())
 
 
+def random_database(db: Database, n_items: int, n_tags=20, n_fields=40):
+    """
+    Fill a database with random tags, fields and items. The item fields are taken
+    from the field table and sensitive values are encrypted if the database has a key.
+    :param db: database
+    :param n_items: number of items
+    :param n_tags: number of tags
+    :param n_fields: number of fields
+    """
+    for n in range(n_tags):
+        db.tag_table.add(f'tag-{n}')
+    for n in range(n_fields):
+        db.field_table.add(f'field-{n}', sensitive=(n % 4 == 0))
+    tag_uid_list = [uid for uid, _, _ in db.tag_table.next()]
+    field_list = [(name, sensitive) for _, name, _, sensitive in db.field_table.next()]
+    for _ in range(n_items):
+        fc = FieldCollection()
+        for f_name, f_sensitive in random.sample(field_list, random.randrange(2, 6)):
+            f_value = random_list_element([random_email(), random_password(), random_web_server(), random_int()])
+            if f_sensitive and db.crypt_key is not None:
+                f_value = db.crypt_key.encrypt_str2str(str(f_value))
+            fc.add(Field(f_name, f_value, f_sensitive))
+        item = Item(random_string('name-'), random.sample(tag_uid_list, random.randrange(1, 3)),
+                    random_string('note-', max_length=80), fc, time_stamp=random_int(max_int=2 ** 31))
+        db.item_collection.add(item)
+        db.update_tables(item)
+
+
 if __name__ == '__main__':
     print('email', random_email())
     print('password', random_password())
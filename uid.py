@@ -98,5 +98,16 @@ class ItemUid(_Uid):
     uid_list = []
 
 
+def clear_all():
+    """
+    Clear all the uid classes and set the counters back to their starting values.
+    Used when the same process reads a database more than once (e.g. testing).
+    """
+    for uid_class, first_uid in [(TagTableUid, FIRST_TAG_TABLE_UID), (FieldTableUid, FIRST_FIELD_TABLE_UID),
+                                 (FieldUid, FIRST_FIELD_UID), (ItemUid, FIRST_ITEM_UID)]:
+        uid_class.clear()
+        uid_class.reset(first_uid)
+
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,93 @@
+"""
+Cache of decrypted sensitive values.
+
+Printing an item with its sensitive values decrypts them every time. The values decrypted
+are kept for a while in a small cache, so looking up the same credentials again doesn't
+decrypt them again. Each encryption key has its own cache (see Crypt.decrypt_value()), where
+the values are looked up by field uid and encrypted value, so a value that changes is never
+returned from the cache.
+
+The cache is bounded: the least recently used values are dropped when it's full, and values
+are dropped when they were decrypted too long ago. It's cleared when the session ends. Python
+strings cannot be overwritten, so clearing only drops the references to the decrypted values.
+"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional
+
+# Default maximum number of values kept
+DEFAULT_CACHE_SIZE = 256
+
+# Default time a decrypted value is kept (seconds)
+DEFAULT_CACHE_TTL = 300.0
+
+
+class ValueCache:
+    """
+    Least recently used cache whose entries expire after a fixed time
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, clock: Callable[[], float] = time.monotonic):
+        """
+        :param max_size: maximum number of values kept (nothing is kept if zero)
+        :param ttl: time a value is kept after it's added (seconds)
+        :param clock: function returning the current time (seconds)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        # Expiration time and value, by key, from the least to the most recently used
+        self.entries: OrderedDict[Hashable, tuple[float, str]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: Hashable) -> Optional[str]:
+        """
+        Return a value kept in the cache
+        :param key: key
+        :return: value (None if not found or expired)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= self.clock():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Hashable, value: str):
+        """
+        Keep a value in the cache, dropping the least recently used ones if it's full
+        :param key: key
+        :param value: value
+        """
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop all the values
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+if __name__ == '__main__':
+    cache = ValueCache(max_size=2, ttl=0.1)
+    cache.put((1, 'a'), 'one')
+    cache.put((2, 'b'), 'two')
+    print(cache.get((1, 'a')))
+    cache.put((3, 'c'), 'three')
+    print(cache.get((2, 'b')), len(cache))
+    time.sleep(0.2)
+    print(cache.get((1, 'a')), len(cache))